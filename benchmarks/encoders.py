@@ -0,0 +1,194 @@
+"""Benchmark the subprocess encoder backend against the in-process one.
+
+Each pair of backends does the same job: one as a command per track and
+one as a Python function in a thread. They encode the same generated
+tracks, several at once like a rip does, through Rip's own encoding
+stage:
+
+    python benchmarks/encoders.py -o results.json
+
+The wav pair copies the PCM into a new file, which is mostly the cost of
+starting a process against that of a thread. The flac pair compares the
+flac command with libsndfile, and only runs if both are there.
+"""
+import os
+import sys
+import tempfile
+
+if __name__ == '__main__':
+    # Don't let the user's configuration skew the results. This has to
+    # happen before cdparacord reads XDG_CONFIG_HOME on import.
+    os.environ['XDG_CONFIG_HOME'] = tempfile.mkdtemp(
+        prefix='cdparacord-bench-config-')
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import resource
+import shutil
+import statistics
+import time
+from cdparacord import encoders, image, plugin
+from cdparacord.rip import Rip
+
+
+# name -> (command encoder, python encoder)
+PAIRS = {
+    'wav': ({'cp': ['${one_file}', '${out_file}']},
+            {'python': 'cdparacord.encoders:wav'}),
+    'flac': ({'flac': ['--silent', '--force', '-o', '${out_file}',
+                       '${one_file}']},
+             {'python': 'cdparacord.encoders:flac'})
+}
+
+
+class FakeDeps:
+    def __init__(self, encoder):
+        self.encoder = encoder
+
+    def plugin(self, spec):
+        return plugin.load(spec)
+
+
+class FakeConfig:
+    def __init__(self, encoder):
+        self._encoder = encoder
+
+    def get(self, key):
+        if key == 'encoder':
+            return self._encoder
+        elif key == 'post_encode':
+            return []
+        return None
+
+
+class FakeTrack:
+    def __init__(self, number):
+        self.tracknumber = number
+        self.filename = '{}.out'.format(number)
+
+
+def available(encoder):
+    """Tell whether an encoder can be run here."""
+    if plugin.is_plugin(encoder):
+        try:
+            func = plugin.load(encoder[plugin.TASK_KEY])
+        except plugin.PluginError:
+            return False
+        return not encoders.missing_modules(func)
+    return shutil.which(list(encoder.keys())[0]) is not None
+
+
+def make_tracks(directory, tracks, seconds):
+    """Write tracks wavs of noise-ish audio and return their names."""
+    # Noise doesn't compress, a short repeating pattern would too well
+    block = os.urandom(4096) * 4 + bytes(16384)
+    size = int(seconds * 44100) * 4
+    data = (block * (size // len(block) + 1))[:size]
+    filenames = []
+    for n in range(1, tracks + 1):
+        filename = os.path.join(directory, '{}.wav'.format(n))
+        with open(filename, 'wb') as f:
+            f.write(image.wav_header(len(data)) + data)
+        filenames.append(filename)
+    return filenames
+
+
+def _cpu(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_backend(encoder, wavs, work, jobs):
+    """Encode wavs jobs at a time and return the measurements."""
+    name = list(encoder.keys())[0]
+    executable = None if plugin.is_plugin(encoder) else shutil.which(name)
+    rip = Rip(None, FakeDeps(executable), FakeConfig(encoder), 1,
+              len(wavs), False)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def encode(n, wav):
+        async with semaphore:
+            await rip._run_encoder(
+                FakeTrack(n), wav, os.path.join(work, '{}.out'.format(n)),
+                None)
+
+    self_cpu = _cpu(resource.RUSAGE_SELF)
+    children_cpu = _cpu(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            loop.run_until_complete(asyncio.gather(*[
+                encode(n, wav) for n, wav in enumerate(wavs, 1)]))
+    wall = time.perf_counter() - start
+    loop.close()
+    return {
+        'wall': wall,
+        'cpu_self': _cpu(resource.RUSAGE_SELF) - self_cpu,
+        'cpu_children': _cpu(resource.RUSAGE_CHILDREN) - children_cpu,
+        'tracks_per_second': len(wavs) / wall
+    }
+
+
+def run(pairs, repeat, *, tracks=12, seconds=10.0, jobs=None):
+    """Run both backends of each pair and keep the medians."""
+    jobs = max(1, jobs or os.cpu_count() or 1)
+    work = tempfile.mkdtemp(prefix='cdparacord-bench-')
+    results = {}
+    try:
+        wavs = make_tracks(work, tracks, seconds)
+        for name in pairs:
+            if not all(available(e) for e in PAIRS[name]):
+                continue
+            for kind, encoder in zip(('command', 'python'), PAIRS[name]):
+                runs = [run_backend(encoder, wavs, work, jobs)
+                        for _ in range(repeat)]
+                results['{}-{}'.format(name, kind)] = {
+                    key: statistics.median(r[key] for r in runs)
+                    for key in runs[0]}
+    finally:
+        shutil.rmtree(work)
+    return {
+        'python': platform.python_version(),
+        'parameters': {'tracks': tracks, 'seconds': seconds, 'jobs': jobs,
+                       'repeat': repeat},
+        'backends': results
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('pairs', nargs='*',
+                        help='pairs to run, out of {} (default: all)'
+                            .format(', '.join(sorted(PAIRS))))
+    parser.add_argument('-o', '--output', help='write results to this file')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tracks', type=int, default=12)
+    parser.add_argument('--seconds', type=float, default=10.0,
+                        help='length of each track')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='tracks encoded at once (default: CPUs)')
+    args = parser.parse_args(argv)
+    for name in args.pairs:
+        if name not in PAIRS:
+            parser.error('unknown pair {}'.format(name))
+
+    results = run(args.pairs or sorted(PAIRS), args.repeat,
+                  tracks=args.tracks, seconds=args.seconds, jobs=args.jobs)
+    for name, result in sorted(results['backends'].items()):
+        print('{:<14} wall {:7.2f}s  {:7.1f} tracks/s  '
+              'cpu {:6.2f}s + {:6.2f}s children'.format(
+                  name, result['wall'], result['tracks_per_second'],
+                  result['cpu_self'], result['cpu_children']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""Benchmark the rip pipeline against a fake drive and a fake encoder.
+
+This runs the real Rip.rip_pipeline, with cdparanoia and the encoder
+replaced by generated shell scripts that sleep for a fixed time and
+write a file of a fixed size. Everything else (tagging, publishing,
+albumdata and filename generation) is the real thing. The results are
+deterministic enough to compare between revisions:
+
+    python benchmarks/pipeline.py -o before.json
+    (change things)
+    python benchmarks/pipeline.py -o after.json --compare before.json
+
+For each disc shape the wall time, the time the drive sat idle and the
+CPU time used by cdparacord itself and by its children is recorded.
+Drive idle time is what matters most: a rip can't be faster than the
+drive, so anything that keeps it waiting is wasted.
+"""
+import os
+import sys
+import tempfile
+
+if __name__ == '__main__':
+    # Don't let the user's configuration skew the results. This has to
+    # happen before cdparacord reads XDG_CONFIG_HOME on import.
+    os.environ['XDG_CONFIG_HOME'] = tempfile.mkdtemp(
+        prefix='cdparacord-bench-config-')
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import resource
+import shutil
+import stat
+import statistics
+import subprocess
+import time
+from cdparacord.albumdata import Albumdata
+from cdparacord.config import Config
+from cdparacord.rip import Rip
+
+
+# name -> (discs, tracks per disc)
+SHAPES = {
+    'album': (1, 12),
+    'long-album': (1, 30),
+    'full-disc': (1, 99),
+    'box-set': (100, 12)
+}
+
+
+class FakeDeps:
+    def __init__(self, cdparanoia, encoder):
+        self.cdparanoia = cdparanoia
+        self.encoder = encoder
+        self.editor = 'true'
+
+
+def _write_script(filename, body):
+    with open(filename, 'w') as f:
+        f.write('#!/bin/sh\n{}\n'.format(body))
+    os.chmod(filename, stat.S_IRWXU)
+
+
+def make_tools(directory, *, rip_latency, encode_latency, wav_bytes):
+    """Write the fake cdparanoia and encoder; return FakeDeps."""
+    cdparanoia = os.path.join(directory, 'cdparanoia')
+    # Called as cdparanoia -- <span> <file>
+    _write_script(cdparanoia, 'sleep {}\nhead -c {} /dev/zero > "$3"'.format(
+        rip_latency, wav_bytes))
+    encoder = os.path.join(directory, 'encoder')
+    # Just enough of an mp3 for mutagen to tag: an empty ID3 header
+    _write_script(encoder, "sleep {}\nprintf 'ID3\\003{}' > \"$2\"".format(
+        encode_latency, '\\000' * 6))
+    return FakeDeps(cdparanoia, encoder)
+
+
+def make_config(work, deps, overrides=()):
+    config = Config()
+    config.update({
+        'encoder': {deps.encoder: ['${one_file}', '${out_file}']},
+        'post_rip': [],
+        'post_encode': [],
+        'post_finished': [],
+        'target_template': os.path.join(
+            work, 'library', '${album}', '${tracknumber} - ${track}.mp3'),
+        'wav_dir': 'ripdir',
+        'keep_ripdir': False,
+        'analyse_audio': False,
+        'ripdir_budget': 0,
+        'storage': {'backend': 'local'},
+        'checksum_manifest': None,
+        # The disk the benchmark runs on shouldn't be benchmarked
+        'fsync_published': False,
+        'resource_report': False,
+        'metrics_textfile': None,
+        'metrics_listen': None,
+        'trace_dir': os.path.join(work, 'traces'),
+        'library_index': os.path.join(work, 'library.sqlite3')
+    })
+    config.update(dict(overrides))
+    return config
+
+
+def make_albumdata(work, config, disc, tracks, wav_bytes):
+    ripdir = os.path.join(work, 'rip', str(disc))
+    data = {
+        'source': 'Benchmark',
+        'title': 'Disc {}'.format(disc),
+        'date': '2018',
+        'albumartist': 'Artist',
+        'cd_number': disc,
+        'cd_count': 1,
+        'discid': 'bench{}'.format(disc),
+        'ripdir': ripdir,
+        'wavdir': ripdir,
+        'pregap': 0,
+        'toc': [[0, wav_bytes // 2352]] * tracks,
+        'tracks': [{'title': 'Track {}'.format(n), 'artist': 'Artist'}
+                   for n in range(1, tracks + 1)]
+    }
+    for n, track in enumerate(data['tracks'], 1):
+        track['filename'] = Albumdata._generate_filename(
+            data, track, n, config)
+    os.makedirs(ripdir, exist_ok=True)
+    return Albumdata(data)
+
+
+def _cpu(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_shape(discs, tracks, *, rip_latency=0.02, encode_latency=0.03,
+              wav_bytes=176400, overrides=()):
+    """Rip a fake shape once and return the measurements as a dict."""
+    work = tempfile.mkdtemp(prefix='cdparacord-bench-')
+    try:
+        deps = make_tools(work, rip_latency=rip_latency,
+                          encode_latency=encode_latency, wav_bytes=wav_bytes)
+        config = make_config(work, deps, overrides)
+
+        wall = 0.0
+        drive_busy = 0.0
+        self_cpu = _cpu(resource.RUSAGE_SELF)
+        children_cpu = _cpu(resource.RUSAGE_CHILDREN)
+        for disc in range(1, discs + 1):
+            albumdata = make_albumdata(work, config, disc, tracks, wav_bytes)
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            rip = Rip(albumdata, deps, config, 1, tracks, False)
+            start = time.perf_counter()
+            # The progress output isn't interesting here
+            with open(os.devnull, 'w') as devnull:
+                with contextlib.redirect_stdout(devnull):
+                    rip.rip_pipeline()
+            wall += time.perf_counter() - start
+
+            # The drive is busy exactly when cdparanoia runs
+            summary = os.path.join(
+                work, 'traces', '{}-summary.json'.format(disc))
+            with open(summary) as f:
+                drive_busy += json.load(f)['stages']['rip']['total']
+
+        return {
+            'discs': discs,
+            'tracks': discs * tracks,
+            'wall': wall,
+            'drive_busy': drive_busy,
+            'drive_idle': wall - drive_busy,
+            'cpu_self': _cpu(resource.RUSAGE_SELF) - self_cpu,
+            'cpu_children': _cpu(resource.RUSAGE_CHILDREN) - children_cpu,
+            'tracks_per_second': discs * tracks / wall
+        }
+    finally:
+        shutil.rmtree(work)
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(shapes, repeat, **kwargs):
+    """Run each shape repeat times and keep the median of each number."""
+    results = {}
+    for name in shapes:
+        discs, tracks = SHAPES[name]
+        runs = [run_shape(discs, tracks, **kwargs) for _ in range(repeat)]
+        results[name] = {key: statistics.median(r[key] for r in runs)
+                         for key in runs[0]}
+        results[name].update(discs=discs, tracks=discs * tracks)
+    return {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'parameters': dict(kwargs, repeat=repeat),
+        'shapes': results
+    }
+
+
+def compare(old, new):
+    """Return lines comparing two results, new against old."""
+    lines = ['{:<12} {:>14} {:>14} {:>14}'.format(
+        'shape', 'wall', 'drive idle', 'cpu self')]
+    for name, result in sorted(new['shapes'].items()):
+        if name not in old['shapes']:
+            continue
+        before = old['shapes'][name]
+        cells = []
+        for key in ('wall', 'drive_idle', 'cpu_self'):
+            if before[key] > 0:
+                cells.append('{:+.1f}%'.format(
+                    100 * (result[key] - before[key]) / before[key]))
+            else:
+                cells.append('n/a')
+        lines.append('{:<12} {:>14} {:>14} {:>14}'.format(name, *cells))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('shapes', nargs='*',
+                        help='disc shapes to run, out of {} (default: all)'
+                            .format(', '.join(sorted(SHAPES))))
+    parser.add_argument('-o', '--output', help='write results to this file')
+    parser.add_argument('--compare', help='compare against earlier results')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--rip-latency', type=float, default=0.02,
+                        help='seconds the fake drive takes per track')
+    parser.add_argument('--encode-latency', type=float, default=0.03,
+                        help='seconds the fake encoder takes per track')
+    parser.add_argument('--wav-bytes', type=int, default=176400,
+                        help='size of each ripped track')
+    args = parser.parse_args(argv)
+    for name in args.shapes:
+        if name not in SHAPES:
+            parser.error('unknown shape {}'.format(name))
+
+    results = run(args.shapes or sorted(SHAPES), args.repeat,
+                  rip_latency=args.rip_latency,
+                  encode_latency=args.encode_latency,
+                  wav_bytes=args.wav_bytes)
+
+    for name, result in sorted(results['shapes'].items()):
+        print('{:<12} {:>4} tracks  wall {:7.2f}s  drive idle {:6.2f}s  '
+              'cpu {:6.2f}s + {:6.2f}s children'.format(
+                  name, result['tracks'], result['wall'],
+                  result['drive_idle'], result['cpu_self'],
+                  result['cpu_children']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(json.load(f), results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Accounting for the resources the processes of a rip use.
+
+asyncio reaps its children itself and throws their resource usage away,
+so processes that are accounted for are instead started and waited for
+with os.wait4 in a thread of their own, which hands us their rusage.
+Every process gets its own thread rather than one from the default
+executor, which is small and shared with everything else; a long encode
+sitting in it would hold up the rest of the rip.
+"""
+import asyncio
+import os
+import subprocess
+import threading
+import time
+
+
+def _exit_status(status):
+    """Turn a wait status into a returncode like subprocess's."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _spawn_and_wait(args):
+    """Run a process to completion; return its returncode and rusage."""
+    proc = subprocess.Popen(args)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    # Let Popen know it's been reaped, so it won't try again
+    proc.returncode = _exit_status(status)
+    return proc.returncode, rusage
+
+
+def _settle(future, result, error):
+    # The waiter may have given up meanwhile
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def _in_thread(func, *args):
+    """Run func in a thread of its own; return a future of its result."""
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def work():
+        try:
+            result = func(*args)
+        except Exception as e:
+            loop.call_soon_threadsafe(_settle, future, None, e)
+        else:
+            loop.call_soon_threadsafe(_settle, future, result, None)
+
+    threading.Thread(target=work, daemon=True).start()
+    return future
+
+
+class Usage:
+    """Resources used by a number of processes, summed."""
+    __slots__ = ('runs', 'wall', 'user', 'sys', 'maxrss', 'inblock',
+                 'oublock')
+
+    def __init__(self):
+        self.runs = 0
+        self.wall = 0.0
+        self.user = 0.0
+        self.sys = 0.0
+        # Kilobytes, the largest of any one process
+        self.maxrss = 0
+        # 512 byte blocks
+        self.inblock = 0
+        self.oublock = 0
+
+    def add(self, wall, rusage):
+        self.runs += 1
+        self.wall += wall
+        self.user += rusage.ru_utime
+        self.sys += rusage.ru_stime
+        self.maxrss = max(self.maxrss, rusage.ru_maxrss)
+        self.inblock += rusage.ru_inblock
+        self.oublock += rusage.ru_oublock
+
+    @property
+    def cpu(self):
+        return self.user + self.sys
+
+
+class Accounting:
+    """Collects the resource usage of processes per stage and per tool."""
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._stages = {}
+        self._tools = {}
+
+    @property
+    def stages(self):
+        """Return a dict of stage -> Usage."""
+        return self._stages
+
+    @property
+    def tools(self):
+        """Return a dict of tool -> Usage."""
+        return self._tools
+
+    def record(self, stage, tool, wall, rusage):
+        self._stages.setdefault(stage, Usage()).add(wall, rusage)
+        self._tools.setdefault(tool, Usage()).add(wall, rusage)
+
+    async def run(self, stage, tool, args):
+        """Run a process, account for it and return its exit status."""
+        start = time.perf_counter()
+        status, rusage = await _in_thread(_spawn_and_wait, args)
+        self.record(stage, tool, time.perf_counter() - start, rusage)
+        return status
+
+    def report(self):
+        """Return a report of everything accounted for, as a string."""
+        elapsed = time.perf_counter() - self._start
+        lines = []
+        header = '{:<16} {:>5} {:>9} {:>9} {:>9} {:>8} {:>9} {:>9}'
+        row = ('{:<16} {:>5} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.1f} {:>9.1f} '
+               '{:>9.1f}')
+        for title, usages in (('Stage', self._stages), ('Tool', self._tools)):
+            lines.append(header.format(
+                title, 'runs', 'wall s', 'user s', 'sys s', 'RSS MiB',
+                'read MiB', 'write MiB'))
+            for name in sorted(usages):
+                u = usages[name]
+                lines.append(row.format(
+                    name, u.runs, u.wall, u.user, u.sys, u.maxrss / 1024,
+                    u.inblock / 2048, u.oublock / 2048))
+            lines.append('')
+
+        # The drive is only ever used by one rip at a time, so the rip
+        # wall times don't overlap
+        rip = self._stages.get('rip')
+        if rip is not None and elapsed > 0:
+            lines.append('Drive busy {:.0f}% of {:.1f}s'.format(
+                100 * rip.wall / elapsed, elapsed))
+        encode = self._stages.get('encode')
+        if encode is not None and encode.wall > 0 and elapsed > 0:
+            # CPU seconds per wall second of encoding: 1.0 is a single
+            # threaded encoder that never waits. The second number is
+            # how many cores the encoders kept busy on average.
+            lines.append(
+                'Encoder CPU efficiency {:.0f}%, {:.2f} cores busy on '
+                'average'.format(
+                    100 * encode.cpu / encode.wall, encode.cpu / elapsed))
+        return '\n'.join(lines)
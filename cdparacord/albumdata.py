@@ -1,4 +1,5 @@
 """Tools for dealing with album data."""
+import copy
 import musicbrainzngs
 import os
 import os.path
@@ -8,8 +9,11 @@ import subprocess
 import sys
 import tempfile
 import textwrap
+import time
 import unicodedata
 import yaml
+from . import metrics
+from . import placement
 from .appinfo import __version__, __url__
 from .error import CdparacordError
 from .xdg import XDG_MUSIC_DIR
@@ -21,6 +25,7 @@ class AlbumdataError(CdparacordError):
 
 class Track:
     def __init__(self, trackdata):
+        self._dict = trackdata
         self._title = trackdata['title']
         self._artist = trackdata['artist']
         self._filename = trackdata['filename']
@@ -46,6 +51,19 @@ class Track:
         """Print track number for this track."""
         return self._tracknumber
 
+    @property
+    def analysis(self):
+        """Return audio analysis of this track, or None."""
+        return self._dict.get('analysis')
+
+    def record_analysis(self, analysis):
+        """Record audio analysis of this track.
+
+        This is stored in the track data so it ends up in albumdata.yaml
+        and can be reused when a rip is continued.
+        """
+        self._dict['analysis'] = analysis
+
 
 class Albumdata:
     def __init__(self, albumdata):
@@ -191,16 +209,19 @@ class Albumdata:
     def _albumdata_from_musicbrainz(cls, disc):
         """Convert MusicBrainz result to list of usable albumdata."""
         musicbrainzngs.set_useragent('cdparacord', __version__, __url__)
+        start = time.perf_counter()
         try:
             result = musicbrainzngs.get_releases_by_discid(
                 disc, includes=['recordings', 'artist-credits'])
+            metrics.STAGE_SECONDS.observe(
+                time.perf_counter() - start, stage='musicbrainz')
 
             if 'cdstub' in result:
                 return [cls._albumdata_from_cdstub(result['cdstub'])]
             elif 'disc' in result:
                 return cls._albumdata_from_disc(result['disc'])
         except musicbrainzngs.MusicBrainzError:
-            pass
+            metrics.STAGE_FAILURES.inc(stage='musicbrainz')
         # If we hit the exception or there's *neither* cdstub *nor*
         # disc, we get here.
         return []
@@ -219,29 +240,46 @@ class Albumdata:
                 return loaded_albumdata
 
     @classmethod
-    def _get_track_count(cls, cdparanoia):
-        """Find track count by running cdparanoia."""
-        # Let's do a dirty hack to find the track count!
+    def _get_toc(cls, cdparanoia):
+        """Find the table of contents by running cdparanoia.
+
+        Returns a list of (begin, length) tuples in sectors, one per
+        track, or None if cdparanoia didn't give us a TOC.
+        """
+        start = time.perf_counter()
         proc = subprocess.run([cdparanoia, '-sQ'],
                               universal_newlines=True,
                               stdout=subprocess.PIPE,
                               stderr=subprocess.STDOUT)
         # Error if it failed
         proc.check_returncode()
+        metrics.STAGE_SECONDS.observe(
+            time.perf_counter() - start, stage='toc')
+
+        toc = []
+        found_total = False
+        for line in proc.stdout.split('\n'):
+            if line[0:5] == 'TOTAL':
+                found_total = True
+                break
+            # Track lines look like
+            #   1.    1000 [00:10.00]        150 [00:01.50]    no   no  2
+            parts = line.split()
+            if (len(parts) >= 4 and parts[0].endswith('.')
+                    and parts[0][:-1].isdigit()):
+                toc.append((int(parts[3]), int(parts[1])))
+
+        if not found_total or not toc:
+            return None
+        return toc
 
-        output = proc.stdout
-        extract_next = False
-        lines = output.split('\n')
-        # Go through lines in reverse until we find TOTAL
-        # The line above that has the number
-        for i in reversed(range(len(lines))):
-            line = lines[i]
-            if extract_next:
-                parts = line.split(".")
-                num = int(parts[0].strip())
-                return num
-            elif line[0:5] == 'TOTAL':
-                extract_next = True
+    @classmethod
+    def _get_track_count(cls, cdparanoia):
+        """Find track count by running cdparanoia."""
+        toc = cls._get_toc(cdparanoia)
+        if toc is None:
+            return None
+        return len(toc)
 
     @classmethod
     def _select_albumdata(cls, results):
@@ -473,37 +511,62 @@ class Albumdata:
                 state = input("> ").strip()
 
     @classmethod
-    def from_user_input(cls, deps, config):
+    def read_disc(cls, disc_image=None):
+        """Read the disc id of the disc in the drive or disc_image."""
+        if disc_image is not None:
+            return disc_image.discid
+        # Only called once dependencies are checked, so discid exists
+        import discid
+
+        try:
+            return discid.read()
+        except discid.DiscError:  # pragma: no cover
+            raise AlbumdataError('Could not read CD')
+
+    @classmethod
+    def from_user_input(cls, deps, config, *, disc=None, disc_image=None):
         """Initialises an Albumdata object from interactive user input.
 
+        If disc_image is given, the disc id and the table of contents
+        come from it instead of the drive. disc is the disc id if it
+        has already been read.
+
         Returns None if the user chose to abort the selection.
         """
-
-        # Since we're given deps, discid exists
-        import discid
-
         use_musicbrainz = config.get('use_musicbrainz')
         reuse_albumdata = config.get('reuse_albumdata')
 
-        try:
-            disc = discid.read()
-        except discid.DiscError:  # pragma: no cover
-            raise AlbumdataError('Could not read CD')
+        if disc is None:
+            disc = cls.read_disc(disc_image)
+        if disc_image is None:
+            toc = cls._get_toc(deps.cdparanoia)
+        else:
+            toc = disc_image.toc
 
-        ripdir = '{tmp}/cdparacord/{uid}-{discid}'.format(
-            tmp=tempfile.gettempdir(), uid=os.getuid(), discid=disc)
+        ripdir = placement.default_ripdir(disc)
         albumdata_file = os.path.join(ripdir, 'albumdata.yaml')
 
-        track_count = cls._get_track_count(deps.cdparanoia)
-
-        if track_count is None:
+        if toc is None:
             raise AlbumdataError('Could not figure out track count')
+        track_count = len(toc)
+
+        wavdir = placement.choose_wavdir(
+            config, ripdir, disc,
+            sum(length for begin, length in toc) * placement.SECTOR_BYTES)
 
         # Data to be merged to the albumdata we select
         common_albumdata = {
             'discid': str(disc),
-            'ripdir': ripdir
+            'ripdir': ripdir,
+            'wavdir': wavdir,
+            # Sectors before track one. Anything but 0 means there's a
+            # pregap that might hide audio.
+            'pregap': toc[0][0],
+            'toc': [list(entry) for entry in toc]
         }
+        if disc_image is not None:
+            # The rip reads from this instead of the drive
+            common_albumdata['image'] = os.path.abspath(disc_image.filename)
         results = []
 
         # If we are reusing albumdata and it exists, recommend that as a
@@ -555,6 +618,10 @@ class Albumdata:
                 continue
             # Merge in the common data
             result.update(common_albumdata)
+            if disc_image is None:
+                # A previous rip may have been from an image, but this
+                # one reads the drive
+                result.pop('image', None)
             # Template filenames for the songs
             counter = 0
             for track in result['tracks']:
@@ -573,11 +640,38 @@ class Albumdata:
         # Edit albumdata
         return cls._edit_albumdata(selected, track_count, deps.editor, config)
 
+    @classmethod
+    def from_library(cls, data, config):
+        """Initialises an Albumdata object from a disc's stored albumdata.
+
+        This is for ripping a disc again without asking, so the ripdir
+        and filenames are worked out anew for the current configuration.
+        """
+        data = copy.deepcopy(data)
+        disc = data['discid']
+        data['ripdir'] = placement.default_ripdir(disc)
+        data['wavdir'] = placement.choose_wavdir(
+            config, data['ripdir'], disc,
+            sum(length for begin, length in data.get('toc', []))
+            * placement.SECTOR_BYTES)
+        for n, track in enumerate(data['tracks'], 1):
+            track['filename'] = cls._generate_filename(
+                data, track, n, config)
+        return cls(data)
+
     @property
     def ripdir(self):
         """Return the directory this album's rip should be in."""
         return self._ripdir
 
+    @property
+    def wavdir(self):
+        """Return the directory ripped wav files should be in.
+
+        This is the ripdir unless configured otherwise.
+        """
+        return self._dict.get('wavdir', self._ripdir)
+
     @property
     def track_count(self):
         """Return the directory this album's rip should be in."""
@@ -0,0 +1,178 @@
+"""Analysis of ripped audio.
+
+Everything here works on the PCM that cdparanoia writes: 16-bit signed
+little-endian stereo at 44.1kHz. NumPy is only needed when analysis is
+enabled, so it's imported inside the functions that use it.
+"""
+import math
+import struct
+from .error import CdparacordError
+
+
+class AnalysisError(CdparacordError):
+    pass
+
+
+# Red Book audio is always this
+SAMPLE_RATE = 44100
+CHANNELS = 2
+FRAME_BYTES = 4
+# One CD sector holds 588 stereo frames (2352 bytes)
+SECTOR_FRAMES = 588
+
+# How many windows we look at at once when hunting for the first and
+# last non-silent windows. A minute of audio at a time keeps the
+# temporary arrays small while still letting NumPy do the heavy lifting.
+_WINDOWS_PER_CHUNK = 75 * 60
+
+
+def find_pcm(filename):
+    """Find the PCM data of a WAV file.
+
+    Returns (offset, length) of the data chunk in bytes. Raises
+    AnalysisError if the file isn't CD audio.
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(12)
+        if (len(header) < 12 or header[0:4] != b'RIFF'
+                or header[8:12] != b'WAVE'):
+            raise AnalysisError('{} is not a WAV file'.format(filename))
+
+        offset = 12
+        fmt_ok = False
+        while True:
+            f.seek(offset)
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise AnalysisError(
+                    'No data chunk found in {}'.format(filename))
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            offset += 8
+
+            if chunk_id == b'fmt ':
+                audio_format, channels, rate, _, _, bits = struct.unpack(
+                    '<HHIIHH', f.read(16))
+                if (audio_format != 1 or channels != CHANNELS
+                        or rate != SAMPLE_RATE or bits != 16):
+                    raise AnalysisError(
+                        '{} is not 16-bit stereo 44.1kHz PCM'.format(
+                            filename))
+                fmt_ok = True
+            elif chunk_id == b'data':
+                if not fmt_ok:
+                    raise AnalysisError(
+                        'Data before format chunk in {}'.format(filename))
+                # cdparanoia writes the header before it knows the
+                # size, so trust the file size over the header if the
+                # rip was cut short
+                f.seek(0, 2)
+                length = min(chunk_size, f.tell() - offset)
+                return offset, length - length % FRAME_BYTES
+
+            # Chunks are padded to even sizes
+            offset += chunk_size + chunk_size % 2
+
+
+def _window_power(pcm, first, last, window):
+    """Return mean square of windows [first, last) of pcm."""
+    import numpy
+
+    block = pcm[first * window:last * window]
+    # Partial window at the end of the track gets padded with silence,
+    # which can only make it look quieter than it is by a hair.
+    if len(block) < (last - first) * window:
+        padded = numpy.zeros(((last - first) * window, CHANNELS),
+                             dtype=block.dtype)
+        padded[:len(block)] = block
+        block = padded
+    samples = block.reshape(last - first, window * CHANNELS)
+    # float32 is plenty for a threshold check and halves the memory
+    # traffic compared to float64
+    samples = samples.astype(numpy.float32)
+    return numpy.einsum('ij,ij->i', samples, samples) / (window * CHANNELS)
+
+
+def analyse_pcm(pcm, *, threshold=-90.0, window=SECTOR_FRAMES):
+    """Find where the audio in pcm starts and ends.
+
+    pcm is an array of shape (frames, 2). threshold is the RMS level in
+    dBFS below which a window counts as silence.
+
+    Returns a dict with the total frame count and the frame offsets
+    audio_start and audio_end (exclusive) of the non-silent part, both
+    aligned to the window size. A completely silent track has both
+    offsets at 0.
+
+    Only the silent parts at either end of the track are ever read (and
+    one chunk beyond them), so a normal track takes next to no time no
+    matter its length.
+    """
+    frames = len(pcm)
+    windows = int(math.ceil(frames / window))
+    # Compare against mean square so we never need a square root
+    limit = (10 ** (threshold / 20) * 32768) ** 2
+
+    start = None
+    for first in range(0, windows, _WINDOWS_PER_CHUNK):
+        last = min(first + _WINDOWS_PER_CHUNK, windows)
+        # Digital silence is all zeroes, which is much cheaper to check
+        # for than computing the power
+        if not pcm[first * window:last * window].any():
+            continue
+        loud = (_window_power(pcm, first, last, window) > limit).nonzero()[0]
+        if len(loud):
+            start = first + int(loud[0])
+            break
+
+    if start is None:
+        return {'frames': frames, 'audio_start': 0, 'audio_end': 0}
+
+    end = None
+    for last in range(windows, start, -_WINDOWS_PER_CHUNK):
+        first = max(last - _WINDOWS_PER_CHUNK, start)
+        if not pcm[first * window:last * window].any():
+            continue
+        loud = (_window_power(pcm, first, last, window) > limit).nonzero()[0]
+        if len(loud):
+            end = first + int(loud[-1]) + 1
+            break
+
+    return {
+        'frames': frames,
+        'audio_start': start * window,
+        'audio_end': min(end * window, frames)
+    }
+
+
+def analyse_wav(filename, *, threshold=-90.0, window=SECTOR_FRAMES):
+    """Analyse a ripped WAV file for leading and trailing silence.
+
+    The file is memory-mapped rather than read so the analysis only
+    touches the pages it actually needs. See analyse_pcm for the return
+    value.
+    """
+    import numpy
+
+    offset, length = find_pcm(filename)
+    if length == 0:
+        return {'frames': 0, 'audio_start': 0, 'audio_end': 0}
+
+    pcm = numpy.memmap(filename, dtype='<i2', mode='r', offset=offset,
+                       shape=(length // FRAME_BYTES, CHANNELS))
+    try:
+        return analyse_pcm(pcm, threshold=threshold, window=window)
+    finally:
+        # Drop the mapping eagerly so the file can be removed
+        del pcm
+
+
+def sector_span(analysis):
+    """Return the inclusive sector range that contains the audio.
+
+    The range is widened to whole sectors so trimming on it never cuts
+    into anything the analysis considered audio.
+    """
+    first = analysis['audio_start'] // SECTOR_FRAMES
+    last = max(first,
+        int(math.ceil(analysis['audio_end'] / SECTOR_FRAMES)) - 1)
+    return first, last
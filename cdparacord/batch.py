@@ -0,0 +1,61 @@
+"""Running a command once for a batch of files instead of each file.
+
+Tracks come out of the encoder one at a time, so a batch is what's
+ready within a window: it's run when it's full, when the window since
+its first file has passed, or when every file that's going to come has.
+That keeps the wait of any one track bounded.
+"""
+import asyncio
+
+
+class Batch:
+    """Collects items and runs them in batches.
+
+    run is a coroutine function called with a list of items. It
+    should raise if the batch fails, and then every item in the batch
+    fails with the same exception. size is the most items in a batch,
+    timeout the most seconds the first item of a batch waits for
+    others, and expected how many items there are in all, if known.
+    """
+    def __init__(self, run, *, size, timeout, expected=None):
+        self._run = run
+        self._size = max(1, size)
+        self._timeout = timeout
+        self._expected = expected
+        self._submitted = 0
+        # (item, future) of the batch being collected
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, item):
+        """Add item to a batch and wait for the batch to be run."""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        self._submitted += 1
+        if (len(self._pending) >= self._size
+                or self._submitted == self._expected):
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._timeout, self._flush)
+        await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        try:
+            await self._run([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
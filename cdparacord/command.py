@@ -0,0 +1,131 @@
+"""Command templates: task arguments with placeholders, parsed once.
+
+Each argument is split into its literal text and the placeholders in it
+when the command is first seen, so expanding it for a file is just
+filling in a list. ${all_files} is special: it has to be an argument of
+its own, and turns into one argument for each file.
+
+The placeholders are those of string.Template, $name or ${name}, with
+$$ for a dollar sign.
+"""
+import functools
+import string
+from .error import CdparacordError
+
+
+class CommandError(CdparacordError):
+    pass
+
+
+# Every placeholder a task can have, though not every task can have
+# every one
+ONE_FILE = 'one_file'
+ALL_FILES = 'all_files'
+OUT_FILE = 'out_file'
+AUDIO = frozenset(('audio_start', 'audio_end'))
+PLACEHOLDERS = frozenset((ONE_FILE, ALL_FILES, OUT_FILE)) | AUDIO
+
+# What each kind of task can have
+ENCODER = PLACEHOLDERS
+DECODER = frozenset((ONE_FILE, OUT_FILE))
+POST_TASK = frozenset((ONE_FILE, ALL_FILES))
+STORAGE = frozenset((ONE_FILE, OUT_FILE))
+
+
+class Command:
+    """The arguments of a task, ready to be expanded.
+
+    placeholders is the set of placeholders the arguments have.
+    Raises CommandError if an argument isn't a valid template.
+    """
+    def __init__(self, args):
+        self.args = tuple(args)
+        self.placeholders = set()
+        # Each slot is a str that's used as is, None for all_files, or
+        # a list of str and (name,) to join
+        self._slots = []
+        for arg in self.args:
+            parts = self._split(arg)
+            if len(parts) == 1 and parts[0] == (ALL_FILES,):
+                self._slots.append(None)
+            elif (ALL_FILES,) in parts:
+                raise CommandError(
+                    '${{all_files}} has to be an argument of its own, '
+                    'not part of {}'.format(arg))
+            elif all(type(part) is str for part in parts):
+                self._slots.append(''.join(parts))
+            else:
+                self._slots.append(parts)
+
+    def _split(self, arg):
+        parts = []
+        position = 0
+        for match in string.Template.pattern.finditer(arg):
+            if match.start() > position:
+                parts.append(arg[position:match.start()])
+            position = match.end()
+            if match.group('escaped') is not None:
+                parts.append('$')
+            elif match.group('invalid') is not None:
+                raise CommandError(
+                    'Invalid placeholder in {}'.format(arg))
+            else:
+                name = match.group('named') or match.group('braced')
+                self.placeholders.add(name)
+                parts.append((name,))
+        if position < len(arg):
+            parts.append(arg[position:])
+        return parts or ['']
+
+    @property
+    def takes_all_files(self):
+        return ALL_FILES in self.placeholders
+
+    def check(self, allowed, what):
+        """Raise CommandError if there are placeholders not in allowed.
+
+        what says whose arguments these are, for the error.
+        """
+        unknown = self.placeholders - allowed
+        if unknown:
+            raise CommandError('{} can not have {}'.format(
+                what, ', '.join(
+                    '${{{}}}'.format(name) for name in sorted(unknown))))
+
+    def expand(self, one_file=None, *, all_files=None, out_file=None,
+            extra=None):
+        """Return the arguments with the placeholders filled in.
+
+        Anything in extra is filled in as is. Raises CommandError if a
+        placeholder has no value.
+        """
+        values = {ONE_FILE: one_file, OUT_FILE: out_file}
+        if extra is not None:
+            values.update(extra)
+        result = []
+        try:
+            for slot in self._slots:
+                if type(slot) is str:
+                    result.append(slot)
+                elif slot is None:
+                    if all_files is None:
+                        raise KeyError(ALL_FILES)
+                    result.extend(all_files)
+                else:
+                    result.append(''.join(
+                        part if type(part) is str else values[part[0]]
+                        for part in slot))
+        except (KeyError, TypeError) as e:
+            raise CommandError('Nothing to fill in for a placeholder in '
+                               '{}'.format(' '.join(self.args))) from e
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def _parse(args):
+    return Command(args)
+
+
+def parse(args):
+    """Return the Command of args, parsing them only the first time."""
+    return _parse(tuple(args))
@@ -28,7 +28,10 @@ class Config:
     # references cannot be currently accessed but they would be
     # ${all_files}.
     __default_config = {
-        # Config for the encoder
+        # Config for the encoder. Instead of a command, it can be a
+        # Python function that's given the ripped audio in memory, like
+        # {python: 'cdparacord.encoders:flac'} (which needs soundfile).
+        # See encoders.py.
         'encoder': {
             'lame': [
                 '-V2',
@@ -36,7 +39,44 @@ class Config:
                 '${out_file}'
             ]
         },
-        # Tasks follow the format of encoder
+        # Config for the decoder that turns archived lossless files back
+        # into wav files, for cdparacord-reencode. Same format as the
+        # encoder: ${one_file} is the archived file and ${out_file} the
+        # wav to write.
+        'decoder': {
+            'flac': [
+                '--decode',
+                '--silent',
+                '--force',
+                '-o',
+                '${out_file}',
+                '${one_file}'
+            ]
+        },
+        # The extension of the files the decoder reads. Only files with
+        # it can be re-encoded instead of ripped again (on_duplicate),
+        # and cdparacord-reencode looks for them by default.
+        'decoder_extension': 'flac',
+        # Decode each encoded track again and check that it gives back
+        # exactly the ripped audio, failing the rip if it doesn't. Only
+        # for lossless encoders, and not together with an encoder that
+        # skips silence with ${audio_start} and ${audio_end}.
+        'verify_lossless': False,
+        # The decoder that verify_lossless uses. It has to write a wav
+        # of ${one_file}, the encoded file, to standard output.
+        'verify_decoder': {
+            'flac': [
+                '--decode',
+                '--silent',
+                '--stdout',
+                '${one_file}'
+            ]
+        },
+        # Tasks follow the format of encoder, except that a task can
+        # also be a Python function, like {python: 'module:function'},
+        # which is called inside cdparacord instead of starting a
+        # process for each file. See plugin.py for what it gets. In
+        # post_finished it's called once, with all the files.
         # post_rip are run after an individual file has been ripped to a
         # wav file. The actions are expected to operate on the raw audio
         # data somehow. Can be used to add an additional encoder pass if
@@ -50,18 +90,39 @@ class Config:
         # previous file format! Scheduled on a per-file basis.
         'post_encode': [
         ],
+        # An encoder or a post_rip or post_encode task that has
+        # ${all_files} as one of its arguments is run for many tracks
+        # at once, like 'mp3gain ${all_files}'. An encoder like that
+        # has to write each file next to its wav with the extension of
+        # target_template, the way 'flac ${all_files}' does.
+        # A batch is run when batch_size tracks are ready, when every
+        # track is, or when its first track has waited batch_timeout
+        # seconds, whichever comes first.
+        'batch_size': 8,
+        'batch_timeout': 5.0,
+        # Instead of a list run one after another, post_rip,
+        # post_encode and post_finished can be a graph of tasks that
+        # say what they depend on, so that whatever doesn't depend on
+        # each other runs at the same time. See graph.py.
+        # task_resources is how many tasks of each resource class can
+        # run at once, over all the tracks; 0 for as many as there are
+        # CPUs. drive tasks take turns with ripping.
+        'task_resources': {
+            'cpu': 0,
+            'io': 2,
+            'network': 2,
+            'drive': 1
+        },
         # post_finished tasks run on all files once all files have been
         # ripped and encoded. It is given the filenames of each encoded
         # file either individually, in which case it runs per-file, or
         # in aggregate, in which case it is run once for all files. If
         # both arguments are given, both will be expanded but the
         # command will be run once for each file. Scheduled exactly
-        # once. NOTE: currently we try to find ${one_file} just by naive
-        # string search so hope you didn't need that in your paths.
-        # NOTE: ${all_files} is really hacky and probably won't work
-        # unless it's the only thing in its parameter. Which should make
-        # sense considering they're all separate parameters (this isn't
-        # shell, spaces aren't separators)
+        # once. ${all_files} has to be a parameter of its own, since
+        # each file becomes a parameter (this isn't shell, spaces aren't
+        # separators). Use $$ for a dollar sign; anything else after a
+        # $ that isn't a placeholder the task can have is an error.
         'post_finished': [
         ],
         # Only path to be configured for cdparanoia
@@ -126,7 +187,177 @@ class Config:
         'reuse_albumdata': True,
         # If True, temporary rip directory is deleted after rip
         # succesfully finished (but not otherwise)
-        'keep_ripdir': False
+        'keep_ripdir': False,
+        # Analyse each ripped track for leading and trailing silence
+        # before encoding it, and rip the pregap before track one (if
+        # the disc has one) to look for hidden audio. The results are
+        # saved in albumdata.yaml. Requires NumPy.
+        #
+        # When analysis is enabled, the encoder also gets two extra
+        # placeholders: ${audio_start} and ${audio_end}, the first and
+        # one-past-last sample of the non-silent part of the file it is
+        # encoding. For instance, flac can be given
+        # '--skip=${audio_start}' and '--until=${audio_end}' to leave
+        # the silence out.
+        'analyse_audio': False,
+        # RMS level in dBFS below which audio is considered silence.
+        # Pure digital silence is minus infinity; the default also
+        # catches the odd stray bit.
+        'silence_threshold': -90.0,
+        # If True and a track already has analysis from a previous rip
+        # (i.e. reuse_albumdata), silence at either end of the track is
+        # not read from the disc at all.
+        'trim_silence': False,
+        # Where the ripped wav files go. These are the bulk of the data
+        # written during a rip, and they're only read back by the
+        # encoder, so there's no point in them hitting the disk.
+        # Options:
+        # ripdir - always the ripdir
+        # auto - a RAM-backed directory ($XDG_RUNTIME_DIR or /dev/shm)
+        #        if it has room for the whole disc, otherwise the ripdir
+        # Anything else is taken as a directory to put them under.
+        'wav_dir': 'ripdir',
+        # If True, encoded files are written next to their final
+        # location under a hidden temporary name and renamed into place
+        # once done, instead of being written to the ripdir and copied
+        # over. Avoids copying every file when the ripdir and the music
+        # library are on different filesystems. Note that an aborted rip
+        # may then leave hidden .cdparacord-part files in the library.
+        'stage_encoded': False,
+        # Maximum number of bytes of ripped wav files to keep around at
+        # once, or 0 for no limit. When the next track wouldn't fit,
+        # ripping pauses until the encoder catches up. Unless
+        # keep_ripdir is set, each wav is deleted as soon as its track
+        # has been encoded and tagged, so with a budget of a few tracks
+        # (a track is about 10 megabytes a minute) a box set doesn't
+        # need gigabytes of temporary space. Has no effect with
+        # keep_ripdir.
+        'ripdir_budget': 0,
+        # How many files may be moved into the music library at once.
+        # If there are no post_finished tasks, each file is published
+        # as soon as it's tagged; otherwise all of them are published
+        # once the post_finished tasks are done.
+        'publish_jobs': 2,
+        # Write a checksum manifest next to the published files, named
+        # after the directory they're in (for instance "Album.sha256"),
+        # in the same format as sha256sum or md5sum. The checksums are
+        # computed as the files are moved, so this costs no extra
+        # reads. Options: sha256, md5 or null for no manifest.
+        'checksum_manifest': None,
+        # Ensure published files are on disk before the rip is
+        # considered done. Directories are synced once at the end
+        # rather than once per file.
+        'fsync_published': True,
+        # Where the music library actually lives. target_template still
+        # decides the names; for anything but local storage, the target
+        # paths are taken relative to root (default $xdgmusic) and the
+        # files put under that name somewhere else. Options:
+        #
+        # backend: local - just move the files in place.
+        #
+        # backend: command - run a command for each file, like scp or
+        #   rclone. put is an action like the encoder, which gets the
+        #   local file as ${one_file} and the name relative to root as
+        #   ${out_file}. get is optional and does the reverse; it's only
+        #   used to merge existing checksum manifests. retries (default
+        #   3) is how many times to retry a failed command.
+        #   For instance:
+        #     backend: command
+        #     put: {rclone: ['copyto', '${one_file}', 'nas:${out_file}']}
+        #
+        # backend: s3 - upload to an S3-compatible object store. Needs
+        #   endpoint (an http or https URL) and bucket; optional are
+        #   prefix (prepended to the names), region (default us-east-1),
+        #   access_key and secret_key (default to AWS_ACCESS_KEY_ID and
+        #   AWS_SECRET_ACCESS_KEY), part_size (bytes; files bigger than
+        #   this are uploaded in parts that survive an interrupted rip,
+        #   default 8 MiB), retries (default 3) and connections (the
+        #   number of keep-alive connections, default 4).
+        'storage': {
+            'backend': 'local'
+        },
+        # Record how long each stage of each track takes (and each
+        # command run in it, and how it exited), and write it out as a
+        # Chrome trace (<ripdir name>-trace.json, for chrome://tracing
+        # or ui.perfetto.dev) and a per-stage summary
+        # (<ripdir name>-summary.json). Set to a directory to write them
+        # there, or to ripdir to write them into the ripdir (where they
+        # are only kept with keep_ripdir). null turns tracing off.
+        'trace_dir': None,
+        # Print a report of the resources (CPU time, memory, disk I/O)
+        # the commands of each stage used at the end of the rip, along
+        # with how busy the drive was and how well the encoders used
+        # the CPU. Useful for deciding whether encoding is holding the
+        # drive up.
+        'resource_report': False,
+        # Write metrics in the Prometheus text format to this file, for
+        # node_exporter's textfile collector. The file is rewritten as
+        # tracks finish, and the counters in it keep counting from one
+        # run to the next. null for no file.
+        'metrics_textfile': None,
+        # Serve the same metrics over HTTP at this host:port (like
+        # 127.0.0.1:9357) while cdparacord runs. null to not serve.
+        'metrics_listen': None,
+        # With --profile, event loop callbacks that run longer than
+        # this many seconds are listed in the profile report
+        'profile_slow_callback': 0.1,
+        # With --profile, also trace memory allocations with this many
+        # frames of traceback each and report what grew between
+        # choosing albumdata and the end of the rip. 0 to not trace
+        # them; tracing slows everything down quite a bit.
+        'profile_tracemalloc_frames': 0,
+        # How many files cdparacord-reencode decodes and encodes at
+        # once. 0 for as many as there are CPUs.
+        'reencode_jobs': 0,
+        # Profiles for cdparacord-sync, by name. Each has an encoder
+        # (an action like the encoder above) and a template for naming
+        # the files under the destination, like target_template. The
+        # extension of the template is that of the transcodes. A
+        # profile can also have its own decoder; by default the one
+        # above is used. For instance:
+        #   portable:
+        #     encoder: {lame: ['-V5', '${one_file}', '${out_file}']}
+        #     template: '${albumartist}/${album}/${tracknumber} - ${track}.mp3'
+        'sync_profiles': {},
+        # Where cdparacord-sync keeps transcodes so they don't have to
+        # be made again. null for $XDG_CACHE_HOME/cdparacord/sync.
+        'sync_cache_dir': None,
+        # How many bytes of transcodes to keep, or 0 for no limit. The
+        # least recently used ones are removed first.
+        'sync_cache_size': 2 * 1024 ** 3,
+        # How many files cdparacord-sync transcodes at once. 0 for as
+        # many as there are CPUs. Copying to the player is done
+        # publish_jobs files at a time.
+        'sync_jobs': 0,
+        # SQLite database where every rip is recorded along with its
+        # albumdata and files, for cdparacord-library. null for
+        # $XDG_DATA_HOME/cdparacord/library.sqlite3, false to not keep
+        # one.
+        'library_index': None,
+        # What to do when a disc that's in the library index is ripped
+        # again: ask, skip it, rip it again, or reencode the files of
+        # the earlier rip (decoding them with the decoder above, so
+        # this is for rips kept in a lossless format). The disc is
+        # looked up before anything else is done with it.
+        'on_duplicate': 'ask',
+        # What to do instead of asking when there's nobody to ask,
+        # that is, standard input isn't a terminal: skip, rip or
+        # reencode
+        'on_duplicate_unattended': 'skip',
+        # Fingerprint each ripped track, keep the fingerprints in the
+        # library index and tell which tracks sound like ones ripped
+        # before, like the same recording on a compilation. Needs NumPy
+        # and library_index.
+        'fingerprint': False,
+        # How alike fingerprints have to be, from 0 to 1, for tracks to
+        # count as the same recording. Unrelated tracks are around 0.5.
+        'fingerprint_threshold': 0.85,
+        # What to do with a track that's the same recording as one
+        # ripped before with the same encoder settings: null to encode
+        # it anyway, copy to copy the earlier file and tag it, or
+        # hardlink to link the earlier file into place as it is, tags
+        # and all, which only makes sense if they're the same.
+        'fingerprint_reuse': None
     }
 
     def __init__(self):
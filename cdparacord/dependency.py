@@ -1,6 +1,10 @@
 """The module for finding external dependencies."""
 
 import os
+from . import command
+from . import encoders
+from . import graph
+from . import plugin
 from .error import CdparacordError
 
 
@@ -13,9 +17,14 @@ class Dependency:
 
     This essentially performs partial configuration validation, because
     most of the external dependencies are configurable.
+
+    If ripping is False, the dependencies of working on files already
+    ripped are discovered instead: the decoder, but not cdparanoia or
+    libdiscid.
     """
-    def __init__(self, config):
+    def __init__(self, config, *, ripping=True):
         self._config = config
+        self._ripping = ripping
         self._discover()
 
     def _find_executable(self, name):
@@ -63,34 +72,164 @@ class Dependency:
                     'Found {} parameter {} with type {} (str expected)'
                         .format(action_key, item, type(item).__name__))
 
+    def _check_command(self, action, allowed, what):
+        """Parse the arguments of an action and check its placeholders.
+
+        Returns the parsed command.
+        """
+        try:
+            parsed = command.parse(list(action.values())[0])
+            parsed.check(allowed, what)
+        except command.CommandError as e:
+            raise DependencyError(str(e)) from e
+        return parsed
+
+    def _load_plugin(self, spec):
+        """Import the function of a python task and return it."""
+        if spec not in self._plugins:
+            try:
+                self._plugins[spec] = plugin.load(spec)
+            except plugin.PluginError as e:
+                raise DependencyError(str(e)) from e
+        return self._plugins[spec]
+
     def _discover(self):
         """Discover dependencies and ensure they exist."""
 
+        # Python tasks are imported now so a typo shows up before the
+        # rip starts
+        self._plugins = {}
+
         # Find the executables, and verify parameters for post-actions
         # and encoder
-        self._encoder = self._find_executable(
-            list(self._config.get('encoder').keys())[0])
-
-        self._verify_action_params(self._config.get('encoder'))
+        encoder = self._config.get('encoder')
+        if plugin.is_plugin(encoder):
+            self._encoder = None
+            missing = encoders.missing_modules(
+                self._load_plugin(encoder[plugin.TASK_KEY]))
+            if missing:
+                raise DependencyError('The encoder requires {}'.format(
+                    ', '.join(missing)))
+            placeholders = set()
+        else:
+            self._encoder = self._find_executable(list(encoder.keys())[0])
+            self._verify_action_params(encoder)
+            placeholders = self._check_command(
+                encoder, command.ENCODER, 'The encoder').placeholders
+            # It names the files it writes itself, from the wavs, and
+            # nothing is known of any one of them
+            if command.ALL_FILES in placeholders:
+                self._check_command(
+                    encoder, {command.ALL_FILES},
+                    'An encoder that takes ${all_files}')
 
         self._editor = self._find_executable(self._config.get('editor'))
-        self._cdparanoia = self._find_executable(
-            self._config.get('cdparanoia'))
+        self._verify_decoder = None
+        if self._ripping:
+            self._cdparanoia = self._find_executable(
+                self._config.get('cdparanoia'))
+            self._decoder = None
+            if self._config.get('verify_lossless'):
+                self._verify_decoder = self._find_executable(
+                    list(self._config.get('verify_decoder').keys())[0])
+                self._verify_action_params(
+                    self._config.get('verify_decoder'))
+                self._check_command(
+                    self._config.get('verify_decoder'), {command.ONE_FILE},
+                    'verify_decoder')
+                # A trimmed encode can't decode back to the whole rip
+                if placeholders & command.AUDIO:
+                    raise DependencyError(
+                        'verify_lossless can not check an encoder that '
+                        'skips silence')
+        else:
+            self._cdparanoia = None
+            self._decoder = self._find_executable(
+                list(self._config.get('decoder').keys())[0])
+            self._verify_action_params(self._config.get('decoder'))
+            self._check_command(
+                self._config.get('decoder'), command.DECODER, 'The decoder')
 
         for post_action in ('post_rip', 'post_encode', 'post_finished'):
-            for action in self._config.get(post_action):
+            try:
+                tasks = graph.parse(self._config.get(post_action), post_action)
+            except graph.TaskGraphError as e:
+                raise DependencyError(str(e)) from e
+            for action in (task.action for task in tasks):
+                if plugin.is_plugin(action):
+                    self._load_plugin(action[plugin.TASK_KEY])
+                    continue
                 self._find_executable(list(action.keys())[0])
                 self._verify_action_params(action)
+                self._check_command(
+                    action, command.POST_TASK, '{} task {}'.format(
+                        post_action, list(action.keys())[0]))
+
+        # Storage backends that run commands need them to exist too
+        storage = self._config.get('storage')
+        if type(storage) is not dict:
+            raise DependencyError(
+                'storage configuration has type {} (dict expected)'
+                    .format(type(storage).__name__))
+        if storage.get('backend') == 'command':
+            if 'put' not in storage:
+                raise DependencyError(
+                    'command storage needs a put command')
+            for name in ('put', 'get'):
+                if name in storage:
+                    self._verify_action_params(storage[name])
+                    self._find_executable(list(storage[name].keys())[0])
+                    self._check_command(
+                        storage[name], command.STORAGE,
+                        'The storage {} command'.format(name))
 
         # Ensure discid is importable
         try:
-            import discid
+            if self._ripping:
+                import discid
         # We don't need to coverage test this exception automatically;
         # it would be ridiculous as it only depends on documented
         # behaviour and only raises a further exception.
         except OSError as e:  # pragma: no cover
             raise DependencyError('Could not find libdiscid') from e
 
+        # NumPy is only needed for analysis
+        if self._ripping and self._config.get('fingerprint'):
+            try:
+                import numpy
+            except ImportError as e:
+                raise DependencyError(
+                    'fingerprint requires NumPy') from e
+            if self._config.get('fingerprint_reuse') not in (
+                    None, 'copy', 'hardlink'):
+                raise DependencyError(
+                    'fingerprint_reuse must be null, copy or hardlink')
+        # What to do with a disc that's been ripped before. Unattended
+        # there's nobody to ask.
+        if self._ripping:
+            if self._config.get('on_duplicate') not in (
+                    'ask', 'skip', 'rip', 'reencode'):
+                raise DependencyError(
+                    'on_duplicate must be ask, skip, rip or reencode')
+            if self._config.get('on_duplicate_unattended') not in (
+                    'skip', 'rip', 'reencode'):
+                raise DependencyError(
+                    'on_duplicate_unattended must be skip, rip or '
+                    'reencode')
+        if self._config.get('analyse_audio'):
+            try:
+                import numpy
+            except ImportError as e:
+                raise DependencyError(
+                    'analyse_audio requires NumPy') from e
+        else:
+            # The analysis placeholders can't be filled without it
+            if placeholders & command.AUDIO:
+                raise DependencyError(
+                    'Encoder arguments {} require analyse_audio'.format(
+                        ', '.join('${{{}}}'.format(name) for name in
+                                  sorted(placeholders & command.AUDIO))))
+
     @property
     def encoder(self):
         return self._encoder
@@ -102,3 +241,15 @@ class Dependency:
     @property
     def cdparanoia(self):
         return self._cdparanoia
+
+    @property
+    def decoder(self):
+        return self._decoder
+
+    @property
+    def verify_decoder(self):
+        return self._verify_decoder
+
+    def plugin(self, spec):
+        """Return the function of a python task."""
+        return self._plugins[spec]
@@ -0,0 +1,142 @@
+"""Encoder backends.
+
+The encoder is normally a command run for every track. It can also be
+a Python function, configured like a Python post task:
+
+    encoder:
+      python: cdparacord.encoders:flac
+
+That runs in a thread instead of a process. It's given the PCM of the
+ripped wav straight from memory, with keyword arguments:
+
+- pcm: a memoryview of the 16-bit little-endian stereo samples, only
+  valid during the call
+- in_file: the ripped wav
+- out_file: where the encoded file goes
+- extra: the audio_start and audio_end of the track as strings when
+  analyse_audio is on, or None
+
+The function should take **kwargs like post tasks do. Both kinds of
+backend go through the same stages: post_encode, tagging and all.
+"""
+import importlib
+import mmap
+import os.path
+from . import analysis
+from . import image
+from . import plugin
+from .error import CdparacordError
+
+
+class EncoderError(CdparacordError):
+    pass
+
+
+class SubprocessEncoder:
+    """An encoder that's a command, with args to expand for each track."""
+    in_process = False
+
+    def __init__(self, executable, name, args):
+        self.executable = executable
+        self.name = name
+        self.args = args
+
+
+def batch_output(in_file, out_file):
+    """Return where an encoder given many files writes in_file.
+
+    That's next to in_file, with the extension out_file should have,
+    like flac does.
+    """
+    return os.path.splitext(in_file)[0] + os.path.splitext(out_file)[1]
+
+
+class PythonEncoder:
+    """An encoder that's a Python function."""
+    in_process = True
+
+    def __init__(self, spec, func):
+        self.name = spec
+        self._func = func
+
+    async def encode(self, in_file, out_file, *, extra=None):
+        """Encode in_file into out_file.
+
+        Raises EncoderError if it fails.
+        """
+        offset, length = analysis.find_pcm(in_file)
+        with open(in_file, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pcm = memoryview(mapped)[offset:offset + length]
+            try:
+                await plugin.run(
+                    self._func, self.name, pcm=pcm, in_file=in_file,
+                    out_file=out_file, extra=extra)
+            except plugin.PluginError as e:
+                raise EncoderError(str(e)) from e
+            finally:
+                try:
+                    pcm.release()
+                except BufferError:
+                    # Something made from it, like a NumPy array, is
+                    # still around
+                    pass
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # The function held on to the PCM; the map goes when it
+                # lets go
+                pass
+
+
+def from_config(config, deps):
+    """Return the backend of the configured encoder."""
+    encoder = config.get('encoder')
+    if plugin.is_plugin(encoder):
+        spec = encoder[plugin.TASK_KEY]
+        return PythonEncoder(spec, deps.plugin(spec))
+    name = list(encoder.keys())[0]
+    return SubprocessEncoder(deps.encoder, name, encoder[name])
+
+
+def wav(pcm, out_file, **kwargs):
+    """Write the PCM as a plain WAV file.
+
+    cdparanoia's headers vary a bit, so this is for keeping the rip
+    as it is but with a clean header.
+    """
+    with open(out_file, 'wb') as f:
+        f.write(image.wav_header(len(pcm)))
+        f.write(pcm)
+
+
+def flac(pcm, out_file, **kwargs):
+    """Encode the PCM into FLAC with libsndfile.
+
+    Needs the soundfile module, which lets go of the GIL while encoding
+    so tracks can be encoded in parallel.
+    """
+    import numpy
+    import soundfile
+
+    samples = numpy.frombuffer(pcm, dtype='<i2').reshape(
+        -1, analysis.CHANNELS)
+    soundfile.write(out_file, samples, analysis.SAMPLE_RATE,
+                    format='FLAC', subtype='PCM_16')
+
+
+# Modules the built-in encoders need, checked by Dependency
+REQUIREMENTS = {flac: ('numpy', 'soundfile')}
+
+
+def missing_modules(func):
+    """Return the modules func needs that can't be imported."""
+    missing = []
+    for name in REQUIREMENTS.get(func, ()):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            missing.append(name)
+    return missing
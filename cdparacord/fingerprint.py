@@ -0,0 +1,169 @@
+"""Audio fingerprints for finding the same recording on different discs.
+
+A fingerprint is a 32-bit word for every few hundredths of a second of
+audio, after Haitsma and Kalker: the audio is mixed to mono and
+downsampled, the spectrum of overlapping frames taken and each bit says
+whether the energy difference of two neighbouring bands grew or shrank
+from the previous frame. The same recording gives nearly the same bits
+however it was mastered onto the disc, while different recordings agree
+on only about half of them.
+
+Like analysis, this needs NumPy, which is imported where it's used.
+"""
+import math
+from . import analysis
+from .error import CdparacordError
+
+
+class FingerprintError(CdparacordError):
+    pass
+
+
+# Averaging this many samples into one takes 44.1kHz to about 5.5kHz,
+# which is plenty for the bands below
+DECIMATE = 8
+RATE = analysis.SAMPLE_RATE / DECIMATE
+FRAME = 2048
+HOP = 256
+# 33 bands give 32 bits a frame
+BANDS = 33
+LOW_HZ = 300
+HIGH_HZ = 2000
+
+# How many frames go through the FFT at once, which bounds the memory
+# used no matter how long the track is
+_FRAMES_PER_CHUNK = 1024
+
+# How far apart the same recording may start on different discs, in
+# seconds. Tracks further apart in length than this aren't compared.
+MAX_SHIFT = 5.0
+
+# Bits set in every byte, for counting differing bits
+_POPCOUNT = None
+
+
+def frames_per_second():
+    return RATE / HOP
+
+
+def _band_edges():
+    """Return the FFT bins that start each band, and where the last ends."""
+    edges = [LOW_HZ * (HIGH_HZ / LOW_HZ) ** (n / BANDS)
+             for n in range(BANDS + 1)]
+    return [int(round(hz * FRAME / RATE)) for hz in edges]
+
+
+def fingerprint_pcm(pcm):
+    """Return the fingerprint of pcm, an array of shape (frames, 2).
+
+    The fingerprint is a uint32 array. Silence gives all zero bits,
+    which is fine since silence is trimmed off before comparing.
+    """
+    import numpy
+    from numpy.lib.stride_tricks import as_strided
+
+    samples = len(pcm) // DECIMATE
+    # Mixing and downsampling in one go
+    mono = pcm[:samples * DECIMATE].reshape(samples, DECIMATE * 2).mean(
+        axis=1, dtype=numpy.float32)
+    frames = (samples - FRAME) // HOP + 1
+    if frames < 2:
+        return numpy.zeros(0, dtype=numpy.uint32)
+
+    edges = _band_edges()
+    window = numpy.hanning(FRAME).astype(numpy.float32)
+    energies = numpy.empty((frames, BANDS), dtype=numpy.float32)
+    for first in range(0, frames, _FRAMES_PER_CHUNK):
+        count = min(_FRAMES_PER_CHUNK, frames - first)
+        # Overlapping frames as a view, without copying
+        chunk = as_strided(
+            mono[first * HOP:], shape=(count, FRAME),
+            strides=(mono.strides[0] * HOP, mono.strides[0]))
+        spectrum = numpy.fft.rfft(chunk * window, axis=1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2)[
+            :, edges[0]:edges[-1]]
+        energies[first:first + count] = numpy.add.reduceat(
+            power, [e - edges[0] for e in edges[:-1]], axis=1)
+
+    difference = energies[:, :-1] - energies[:, 1:]
+    bits = (difference[1:] - difference[:-1]) > 0
+    return numpy.packbits(bits, axis=1).view('>u4').ravel().astype(
+        numpy.uint32)
+
+
+def fingerprint_wav(filename):
+    """Fingerprint a ripped WAV file.
+
+    Only the part between leading and trailing silence is used, so
+    pregaps of different lengths don't matter. Returns the length of
+    that part in seconds and the fingerprint.
+    """
+    import numpy
+
+    offset, length = analysis.find_pcm(filename)
+    if length == 0:
+        return 0.0, numpy.zeros(0, dtype=numpy.uint32)
+    pcm = numpy.memmap(filename, dtype='<i2', mode='r', offset=offset,
+                       shape=(length // analysis.FRAME_BYTES,
+                              analysis.CHANNELS))
+    try:
+        span = analysis.analyse_pcm(pcm)
+        audio = pcm[span['audio_start']:span['audio_end']]
+        return (len(audio) / analysis.SAMPLE_RATE, fingerprint_pcm(audio))
+    finally:
+        del pcm
+
+
+def to_bytes(fingerprint):
+    """Return fingerprint as bytes for storing."""
+    return fingerprint.astype('<u4').tobytes()
+
+
+def from_bytes(data):
+    import numpy
+    return numpy.frombuffer(data, dtype='<u4').astype(numpy.uint32)
+
+
+def similarity(a, b, *, max_shift=MAX_SHIFT):
+    """Return how alike two fingerprints are, from 0 to 1.
+
+    That's the share of bits that agree where the fingerprints overlap,
+    with one moved against the other by up to max_shift seconds to where
+    they agree best. Unrelated audio comes out around 0.5.
+    """
+    import numpy
+
+    global _POPCOUNT
+    if _POPCOUNT is None:
+        _POPCOUNT = numpy.array(
+            [bin(n).count('1') for n in range(256)], dtype=numpy.uint8)
+
+    shifts = int(math.ceil(max_shift * frames_per_second()))
+    best = 0.0
+    for shift in range(-shifts, shifts + 1):
+        x = a[max(shift, 0):]
+        y = b[max(-shift, 0):]
+        n = min(len(x), len(y))
+        # Overlaps shorter than the shift window say too little
+        if n == 0 or n < min(len(a), len(b)) // 2:
+            continue
+        differing = int(_POPCOUNT[
+            numpy.bitwise_xor(x[:n], y[:n]).view(numpy.uint8)].sum(
+                dtype=numpy.uint64))
+        best = max(best, 1 - differing / (n * 32))
+    return best
+
+
+def best_match(fingerprint, candidates, threshold):
+    """Find the candidate most like fingerprint.
+
+    candidates are (something, fingerprint) pairs. Returns
+    (something, similarity) of the best one at least threshold alike,
+    or None if there is none.
+    """
+    best = None
+    for key, other in candidates:
+        score = similarity(fingerprint, other)
+        if score >= threshold and (best is None or score > best[1]):
+            best = (key, score)
+    return best
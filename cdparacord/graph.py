@@ -0,0 +1,191 @@
+"""Post tasks as a graph of what depends on what.
+
+A post_rip, post_encode or post_finished list can hold tasks like
+
+    post_encode:
+      - name: checksum
+        run: {sha256sum-to: ['${one_file}']}
+        outputs: [checksum]
+        resource: io
+      - name: replaygain
+        run: {mp3gain: ['${one_file}']}
+      - name: upload
+        run: {python: mytasks:upload}
+        inputs: [checksum]
+        after: [replaygain]
+        resource: network
+
+A task runs once the tasks named in its after, and those whose outputs
+it has as inputs, are done; everything else runs at the same time, as
+far as its resource class allows. Inputs and outputs are just names
+for what a task leaves behind for others.
+
+The resource classes are cpu (the default), io, network and drive,
+and task_resources says how many tasks of each can run at once over
+the whole rip. drive tasks take turns with ripping.
+
+A task written the old way, as just the command, runs after the entry
+before it and isn't limited by any class, like it always has.
+"""
+import asyncio
+import os
+from .error import CdparacordError
+
+
+class TaskGraphError(CdparacordError):
+    pass
+
+
+RESOURCES = ('cpu', 'io', 'network', 'drive')
+DEFAULT_RESOURCE = 'cpu'
+_KEYS = frozenset(('name', 'run', 'after', 'inputs', 'outputs', 'resource'))
+
+
+class Task:
+    """A post task in the graph.
+
+    action is the command or Python task in the usual format, depends
+    the names of the tasks it waits for and resource its class, or None
+    if it isn't limited.
+    """
+    def __init__(self, name, action, depends, resource):
+        self.name = name
+        self.action = action
+        self.depends = depends
+        self.resource = resource
+
+
+def is_declared(entry):
+    """Tell whether a list entry is a task with a run key.
+
+    A run key with a list of arguments is an executable called run.
+    """
+    return isinstance(entry, dict) and isinstance(entry.get('run'), dict)
+
+
+def _names(entry, key, name):
+    value = entry.get(key, [])
+    if (not isinstance(value, list)
+            or not all(isinstance(v, str) for v in value)):
+        raise TaskGraphError(
+            '{} of task {} must be a list of names'.format(key, name))
+    return value
+
+
+def parse(entries, stage):
+    """Return the tasks of a stage in an order they can be started in.
+
+    Raises TaskGraphError if the tasks don't make a graph.
+    """
+    tasks = []
+    outputs = {}
+    inputs = {}
+    previous = None
+    for n, entry in enumerate(entries, 1):
+        if not is_declared(entry):
+            name = '{} task {}'.format(stage, n)
+            after = [] if previous is None else [previous]
+            tasks.append(Task(name, entry, after, None))
+        else:
+            name = entry.get('name', '{} task {}'.format(stage, n))
+            unknown = set(entry) - _KEYS
+            if unknown:
+                raise TaskGraphError('Task {} has unknown keys {}'.format(
+                    name, ', '.join(sorted(unknown))))
+            resource = entry.get('resource', DEFAULT_RESOURCE)
+            if resource not in RESOURCES:
+                raise TaskGraphError(
+                    'Task {} has resource {}, which is not one of {}'
+                        .format(name, resource, ', '.join(RESOURCES)))
+            after = list(_names(entry, 'after', name))
+            for output in _names(entry, 'outputs', name):
+                outputs.setdefault(output, []).append(name)
+            inputs[name] = _names(entry, 'inputs', name)
+            tasks.append(Task(name, entry['run'], after, resource))
+        if name in [task.name for task in tasks[:-1]]:
+            raise TaskGraphError('There are two tasks called {}'.format(
+                name))
+        previous = name
+
+    by_name = {task.name: task for task in tasks}
+    for task in tasks:
+        for name in inputs.get(task.name, ()):
+            task.depends.extend(
+                producer for producer in outputs.get(name, ())
+                if producer != task.name)
+        for name in task.depends:
+            if name not in by_name:
+                raise TaskGraphError('Task {} is after {}, which is not '
+                                     'a task of {}'.format(
+                                         task.name, name, stage))
+        task.depends = frozenset(task.depends)
+
+    # Order them so that everything comes after what it depends on
+    ordered = []
+    done = set()
+    visiting = set()
+
+    def visit(task):
+        if task.name in done:
+            return
+        if task.name in visiting:
+            raise TaskGraphError(
+                'Tasks of {} depend on each other in a cycle through {}'
+                    .format(stage, task.name))
+        visiting.add(task.name)
+        for name in sorted(task.depends):
+            visit(by_name[name])
+        visiting.discard(task.name)
+        done.add(task.name)
+        ordered.append(task)
+
+    for task in tasks:
+        visit(task)
+    return ordered
+
+
+async def run(tasks, run_task):
+    """Run tasks with run_task, each once what it depends on is done.
+
+    tasks are as parse returns them. If a task fails, the ones that
+    depend on it don't run, and the first failure is raised once the
+    rest are done.
+    """
+    futures = {}
+
+    async def start(task):
+        for name in task.depends:
+            await futures[name]
+        await run_task(task)
+
+    for task in tasks:
+        futures[task.name] = asyncio.ensure_future(start(task))
+    results = await asyncio.gather(
+        *futures.values(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+class Resources:
+    """How many tasks of each resource class can run at once.
+
+    limits maps classes to their limits, 0 or missing for as many as
+    there are CPUs. drive, if given, is the lock ripping holds.
+    """
+    def __init__(self, limits, *, drive=None):
+        self._semaphores = {}
+        for name in RESOURCES:
+            limit = (limits or {}).get(name) or os.cpu_count() or 1
+            self._semaphores[name] = asyncio.Semaphore(limit)
+        if drive is not None:
+            self._semaphores['drive'] = drive
+
+    def get(self, resource):
+        """Return what to hold while running a task of resource.
+
+        That's None if there's nothing to hold.
+        """
+        if resource is None:
+            return None
+        return self._semaphores[resource]
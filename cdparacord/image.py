@@ -0,0 +1,252 @@
+"""Disc images as a source of audio, instead of a drive.
+
+An image is described by a cue sheet that points at one or more audio
+files: raw CD audio (BINARY or MOTOROLA, like cdrdao and friends write)
+or WAVE files. The table of contents and the MusicBrainz disc id are
+worked out from the cue sheet, and tracks are extracted by slicing the
+memory-mapped files, so an image "rips" at the speed of the disk it's
+on.
+"""
+import base64
+import hashlib
+import mmap
+import os
+import os.path
+import shlex
+import struct
+from . import analysis
+from .error import CdparacordError
+from .placement import SECTOR_BYTES
+
+
+class ImageError(CdparacordError):
+    pass
+
+
+# Frames (sectors) per second in cue sheet timestamps
+SECTORS_PER_SECOND = 75
+# Sectors before the first track on a disc; MusicBrainz counts them
+LEAD_IN = 150
+
+
+def _parse_timestamp(stamp):
+    """Parse mm:ss:ff into sectors."""
+    try:
+        minutes, seconds, sectors = (int(x) for x in stamp.split(':'))
+    except ValueError:
+        raise ImageError('Invalid cue sheet timestamp {}'.format(stamp))
+    return (minutes * 60 + seconds) * SECTORS_PER_SECOND + sectors
+
+
+def wav_header(data_bytes):
+    """Return a 44 byte WAV header for data_bytes of CD audio."""
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_bytes, b'WAVE',
+        b'fmt ', 16, 1, analysis.CHANNELS, analysis.SAMPLE_RATE,
+        analysis.SAMPLE_RATE * analysis.FRAME_BYTES, analysis.FRAME_BYTES, 16,
+        b'data', data_bytes)
+
+
+def musicbrainz_discid(first, last, offsets, leadout):
+    """Compute a MusicBrainz disc id.
+
+    offsets are the start sectors of the tracks first to last and
+    leadout the sector after the last, all including the lead-in.
+    """
+    h = hashlib.sha1()
+    h.update('{:02X}{:02X}{:08X}'.format(first, last, leadout).encode())
+    for i in range(99):
+        h.update('{:08X}'.format(
+            offsets[i] if i < len(offsets) else 0).encode())
+    # MusicBrainz's URL safe flavour of base64
+    return base64.b64encode(h.digest()).decode('ascii').translate(
+        str.maketrans('+/=', '._-'))
+
+
+class _AudioFile:
+    """One file of an image, memory-mapped."""
+
+    def __init__(self, filename, kind):
+        self.filename = filename
+        # Big-endian samples need their bytes swapped
+        self.swap = kind == 'MOTOROLA'
+        try:
+            if kind == 'WAVE':
+                self.offset, length = analysis.find_pcm(filename)
+            elif kind in ('BINARY', 'MOTOROLA'):
+                self.offset = 0
+                length = os.path.getsize(filename)
+            else:
+                raise ImageError('Unsupported file type {} for {}'.format(
+                    kind, filename))
+        except (OSError, analysis.AnalysisError) as e:
+            raise ImageError('Could not open {}: {}'.format(
+                filename, e)) from e
+        # A partial sector at the end isn't a sector
+        self.sectors = length // SECTOR_BYTES
+        self._map = None
+
+    def slice(self, first, count):
+        """Return a buffer of count sectors starting from first."""
+        if self._map is None:
+            with open(self.filename, 'rb') as f:
+                self._map = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = self.offset + first * SECTOR_BYTES
+        data = memoryview(self._map)[start:start + count * SECTOR_BYTES]
+        if self.swap:
+            data = bytearray(data)
+            data[0::2], data[1::2] = data[1::2], data[0::2]
+        return data
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class DiscImage:
+    """A disc image described by a cue sheet.
+
+    toc is a list of (begin, length) in sectors for each audio track,
+    like Albumdata._get_toc gives for a real disc, and discid is the
+    MusicBrainz disc id of the disc the image was made of.
+    """
+
+    def __init__(self, cue_filename, files, tracks, leadout):
+        self.filename = cue_filename
+        self._files = files
+        self.toc = tracks
+        self._leadout = leadout
+        self.discid = musicbrainz_discid(
+            1, len(tracks), [begin + LEAD_IN for begin, _ in tracks],
+            leadout + LEAD_IN)
+
+    @classmethod
+    def open(cls, filename):
+        """Open the image of a cue sheet.
+
+        A WAV file is also accepted, and taken to be a single track.
+        """
+        if filename.lower().endswith('.wav'):
+            return cls._from_files(
+                filename, [_AudioFile(filename, 'WAVE')], [(0, 0, 'AUDIO')])
+        if filename.lower().endswith('.iso'):
+            raise ImageError(
+                '{} is a data image with no audio tracks; give the cue '
+                'sheet of an audio image instead'.format(filename))
+
+        try:
+            with open(filename, 'r', encoding='utf-8',
+                      errors='surrogateescape') as f:
+                text = f.read()
+        except OSError as e:
+            raise ImageError('Could not read {}: {}'.format(filename, e))
+        return cls._from_cue(filename, text)
+
+    @classmethod
+    def _from_cue(cls, filename, text):
+        directory = os.path.dirname(filename)
+        files = []
+        # (file index, sector in file, track type) for INDEX 01 of each
+        tracks = []
+        track_type = None
+        for line in text.splitlines():
+            words = line.split()
+            if not words:
+                continue
+            command = words[0].upper()
+            if command == 'FILE':
+                # Only file names are quoted in ways that matter; titles
+                # and such can have stray apostrophes
+                try:
+                    words = shlex.split(line)
+                except ValueError:
+                    raise ImageError('Invalid cue sheet line: {}'.format(
+                        line))
+                if len(words) < 3:
+                    raise ImageError('Invalid cue sheet line: {}'.format(
+                        line))
+                files.append(_AudioFile(
+                    os.path.join(directory, words[1]), words[2].upper()))
+            elif command == 'TRACK' and len(words) >= 3:
+                track_type = words[2].upper()
+            elif (command == 'INDEX' and len(words) >= 3
+                    and words[1].lstrip('0') == '1'):
+                if not files or track_type is None:
+                    raise ImageError('INDEX before FILE or TRACK in {}'
+                                     .format(filename))
+                tracks.append((len(files) - 1, _parse_timestamp(words[2]),
+                               track_type))
+        if not tracks:
+            raise ImageError('No tracks in {}'.format(filename))
+        return cls._from_files(filename, files, tracks)
+
+    @classmethod
+    def _from_files(cls, filename, files, tracks):
+        # Where each file starts on the disc
+        starts = []
+        position = 0
+        for f in files:
+            starts.append(position)
+            position += f.sectors
+        end = position
+
+        begins = [starts[file_index] + sector
+                  for file_index, sector, _ in tracks]
+        types = [track_type for _, _, track_type in tracks]
+
+        # Enhanced CDs have a data track at the end, which isn't ripped
+        # and which the disc id leaves out. On the disc there's a gap
+        # between the sessions, but images don't have it, so the audio
+        # simply ends where the data starts.
+        if types[-1] != 'AUDIO':
+            end = begins[-1]
+            begins, types = begins[:-1], types[:-1]
+        leadout = end
+        if not begins or any(t != 'AUDIO' for t in types):
+            raise ImageError(
+                'Only audio tracks (and a data track at the end) are '
+                'supported in {}'.format(filename))
+
+        toc = [(begin, following - begin)
+               for begin, following in zip(begins, begins[1:] + [end])]
+        if any(length <= 0 for _, length in toc):
+            raise ImageError('Tracks out of order or past the end of the '
+                             'files in {}'.format(filename))
+        return cls(filename, files, toc, leadout)
+
+    def extract(self, first, count, filename):
+        """Write count sectors starting from first to a WAV file.
+
+        Sectors are counted from the start of the disc, as in the toc,
+        so a span can cross files and track boundaries.
+        """
+        with open(filename, 'wb') as out:
+            out.write(wav_header(count * SECTOR_BYTES))
+            position = 0
+            for f in self._files:
+                if count <= 0:
+                    break
+                if first < position + f.sectors:
+                    skip = max(0, first - position)
+                    take = min(count, f.sectors - skip)
+                    out.write(f.slice(skip, take))
+                    first += take
+                    count -= take
+                position += f.sectors
+        if count > 0:
+            raise ImageError('Span runs past the end of {}'.format(
+                self.filename))
+
+    def extract_track(self, tracknumber, filename, *, first=0, last=None):
+        """Write a track, or sectors first to last of it, to a WAV file."""
+        begin, length = self.toc[tracknumber - 1]
+        if last is None:
+            last = length - 1
+        self.extract(begin + first, last - first + 1, filename)
+
+    def close(self):
+        for f in self._files:
+            f.close()
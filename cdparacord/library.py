@@ -0,0 +1,518 @@
+"""An index of everything that has been ripped.
+
+The albumdata of a rip only lives in its ripdir, which is removed after
+the rip unless keep_ripdir is set. Every rip is also recorded in an
+SQLite database along with the files it produced, so what's been ripped
+can be looked up afterwards by disc id, artist, album or path.
+"""
+import click
+import hashlib
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import time
+import yaml
+from .config import Config
+from .error import CdparacordError
+from .xdg import XDG_DATA_HOME
+
+
+class LibraryError(CdparacordError):
+    pass
+
+
+DEFAULT_INDEX = os.path.join(XDG_DATA_HOME, 'cdparacord', 'library.sqlite3')
+
+# How many discs are imported in one transaction
+IMPORT_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS discs (
+    id INTEGER PRIMARY KEY,
+    discid TEXT UNIQUE,
+    albumartist TEXT,
+    album TEXT,
+    date TEXT,
+    albumdata TEXT NOT NULL,
+    encoder_hash TEXT,
+    ripped_at REAL,
+    rip_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS discs_albumartist
+    ON discs (albumartist COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS discs_album ON discs (album COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    disc INTEGER NOT NULL REFERENCES discs (id) ON DELETE CASCADE,
+    tracknumber INTEGER NOT NULL,
+    artist TEXT,
+    title TEXT,
+    size INTEGER,
+    checksum TEXT
+);
+CREATE INDEX IF NOT EXISTS files_disc ON files (disc, tracknumber);
+CREATE INDEX IF NOT EXISTS files_artist ON files (artist COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS scanned_dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT
+);
+CREATE INDEX IF NOT EXISTS scanned_dirs_parent ON scanned_dirs (parent);
+CREATE TABLE IF NOT EXISTS scanned (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    artist TEXT,
+    album TEXT,
+    albumartist TEXT,
+    title TEXT,
+    tracknumber TEXT,
+    date TEXT,
+    discnumber TEXT
+);
+CREATE INDEX IF NOT EXISTS scanned_directory ON scanned (directory);
+CREATE INDEX IF NOT EXISTS scanned_artist
+    ON scanned (artist COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS scanned_album ON scanned (album COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    duration REAL NOT NULL,
+    encoder_hash TEXT,
+    fingerprint BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fingerprints_duration
+    ON fingerprints (duration);
+"""
+
+# The tags of scanned files that are indexed, in the order of the columns
+SCANNED_TAGS = ('artist', 'album', 'albumartist', 'title', 'tracknumber',
+                'date', 'discnumber')
+
+
+def encoder_hash(config, extension):
+    """Hash the settings that decide what an encoded file is like."""
+    profile = {
+        'encoder': config.get('encoder'),
+        'post_encode': config.get('post_encode'),
+        'extension': extension
+    }
+    return hashlib.sha256(
+        json.dumps(profile, sort_keys=True).encode()).hexdigest()
+
+
+def index_filename(config):
+    """Return the index configured, or None if there's to be none."""
+    filename = config.get('library_index')
+    if filename is None:
+        return DEFAULT_INDEX
+    if not filename:
+        return None
+    return os.path.expanduser(filename)
+
+
+class Library:
+    """The index database.
+
+    Files are given as (tracknumber, path, size, checksum); size and
+    checksum can be None when they aren't known.
+    """
+    def __init__(self, filename):
+        try:
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(filename)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute('PRAGMA foreign_keys = ON')
+            self._db.executescript(SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            raise LibraryError(
+                'Could not open library index {}: {}'.format(filename, e))
+
+    def close(self):
+        self._db.close()
+
+    def _record(self, data, files, encoder_hash, ripped_at, rip_seconds):
+        values = (data.get('albumartist'), data.get('title'),
+                  data.get('date'), json.dumps(data, sort_keys=True),
+                  encoder_hash, ripped_at, rip_seconds)
+        row = None
+        if data.get('discid'):
+            row = self._db.execute(
+                'SELECT id FROM discs WHERE discid = ?',
+                (data['discid'],)).fetchone()
+        if row is None:
+            disc = self._db.execute(
+                'INSERT INTO discs (albumartist, album, date, albumdata, '
+                'encoder_hash, ripped_at, rip_seconds, discid) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                values + (data.get('discid'),)).lastrowid
+        else:
+            disc = row['id']
+            self._db.execute(
+                'UPDATE discs SET albumartist = ?, album = ?, date = ?, '
+                'albumdata = ?, encoder_hash = ?, ripped_at = ?, '
+                'rip_seconds = ? WHERE id = ?', values + (disc,))
+
+        tracks = data.get('tracks', [])
+        for tracknumber, path, size, checksum in files:
+            track = (tracks[tracknumber - 1]
+                     if 0 < tracknumber <= len(tracks) else {})
+            # A track ripped again may have a new name
+            self._db.execute(
+                'DELETE FROM files WHERE disc = ? AND tracknumber = ?',
+                (disc, tracknumber))
+            self._db.execute(
+                'INSERT OR REPLACE INTO files (path, disc, tracknumber, '
+                'artist, title, size, checksum) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, disc, tracknumber, track.get('artist'),
+                 track.get('title'), size, checksum))
+        return disc
+
+    def record(self, data, files, *, encoder_hash=None, ripped_at=None,
+            rip_seconds=None):
+        """Record a rip of the disc with albumdata data.
+
+        A disc that's already in the index is updated, as are the files
+        of its tracks that are given.
+        """
+        with self._db:
+            return self._record(
+                data, files, encoder_hash,
+                time.time() if ripped_at is None else ripped_at,
+                rip_seconds)
+
+    def import_albumdata(self, filenames, *, batch=IMPORT_BATCH):
+        """Import albumdata.yaml files, batch files per transaction.
+
+        The tracks' files are recorded with their sizes if they exist.
+        Returns the number of files imported and a list of
+        (filename, error) for the ones that couldn't be.
+        """
+        imported = 0
+        failed = []
+        filenames = iter(filenames)
+        while True:
+            count = 0
+            with self._db:
+                for filename in filenames:
+                    try:
+                        data, files = _read_albumdata(filename)
+                    except LibraryError as e:
+                        failed.append((filename, e))
+                        continue
+                    self._record(data, files, None,
+                                 os.path.getmtime(filename), None)
+                    count += 1
+                    if count == batch:
+                        break
+            imported += count
+            if count < batch:
+                return imported, failed
+
+    def _files(self, disc):
+        return [dict(row) for row in self._db.execute(
+            'SELECT path, tracknumber, artist, title, size, checksum '
+            'FROM files WHERE disc = ? ORDER BY tracknumber', (disc,))]
+
+    def get(self, discid):
+        """Return the disc with discid, or None if it hasn't been ripped."""
+        discs = self.find(discid=discid)
+        return discs[0] if discs else None
+
+    def find(self, *, discid=None, artist=None, album=None, path=None):
+        """Return the discs that match everything given.
+
+        artist matches the album artist or the artist of any track and
+        album the title, both ignoring case. path matches a file or
+        everything under a directory. Each disc is a dict with its
+        albumdata and files.
+        """
+        where = []
+        params = []
+        if discid is not None:
+            where.append('discid = ?')
+            params.append(discid)
+        if artist is not None:
+            where.append(
+                '(albumartist = ? COLLATE NOCASE OR id IN ('
+                'SELECT disc FROM files WHERE artist = ? COLLATE NOCASE))')
+            params.extend((artist, artist))
+        if album is not None:
+            where.append('album = ? COLLATE NOCASE')
+            params.append(album)
+        if path is not None:
+            path = os.path.abspath(path)
+            # A range rather than LIKE so the primary key is used
+            prefix = path.rstrip(os.sep) + os.sep
+            where.append(
+                'id IN (SELECT disc FROM files WHERE path = ? '
+                'OR (path >= ? AND path < ?))')
+            params.extend((path, prefix,
+                           prefix[:-1] + chr(ord(os.sep) + 1)))
+
+        query = 'SELECT * FROM discs'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        discs = []
+        for row in self._db.execute(
+                query + ' ORDER BY albumartist, album', params):
+            disc = dict(row)
+            disc['albumdata'] = json.loads(disc['albumdata'])
+            disc['files'] = self._files(disc['id'])
+            discs.append(disc)
+        return discs
+
+    def rename_files(self, renames):
+        """Update the paths of files that have been moved.
+
+        renames are (old path, new path). Paths that aren't in the index
+        are left alone, so doing it twice is harmless.
+        """
+        renames = [(new, old) for old, new in renames]
+        with self._db:
+            for table in ('files', 'fingerprints'):
+                self._db.executemany(
+                    'UPDATE OR REPLACE {} SET path = ? '
+                    'WHERE path = ?'.format(table), renames)
+
+    def record_fingerprints(self, fingerprints):
+        """Record the fingerprints of files.
+
+        fingerprints are (path, duration, fingerprint, encoder_hash),
+        with the fingerprint as bytes.
+        """
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO fingerprints (path, duration, '
+                'fingerprint, encoder_hash) VALUES (?, ?, ?, ?)',
+                fingerprints)
+
+    def fingerprints_near(self, duration, tolerance):
+        """Return the fingerprinted files of about duration seconds.
+
+        Each is a dict of path, duration, fingerprint and encoder_hash.
+        """
+        return [dict(row) for row in self._db.execute(
+            'SELECT * FROM fingerprints WHERE duration BETWEEN ? AND ?',
+            (duration - tolerance, duration + tolerance))]
+
+    def scan_state(self, directory):
+        """Return what's known of a scanned directory.
+
+        That's a dict of the names of its files to (inode, size, mtime)
+        and a set of the paths of its subdirectories.
+        """
+        files = {
+            os.path.basename(row['path']): (
+                row['inode'], row['size'], row['mtime'])
+            for row in self._db.execute(
+                'SELECT path, inode, size, mtime FROM scanned '
+                'WHERE directory = ?', (directory,))}
+        dirs = {row['path'] for row in self._db.execute(
+            'SELECT path FROM scanned_dirs WHERE parent = ?', (directory,))}
+        return files, dirs
+
+    def update_scan(self, files=(), removed=(), dirs=(), removed_dirs=()):
+        """Write a batch of scan results in one transaction.
+
+        files are (path, directory, (inode, size, mtime), tags) with
+        tags a dict, dirs (path, parent). Removing a directory removes
+        everything under it.
+        """
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO scanned (path, directory, inode, '
+                'size, mtime, {}) VALUES (?, ?, ?, ?, ?, {})'.format(
+                    ', '.join(SCANNED_TAGS),
+                    ', '.join('?' * len(SCANNED_TAGS))),
+                ((path, directory) + state +
+                 tuple(tags.get(tag) for tag in SCANNED_TAGS)
+                 for path, directory, state, tags in files))
+            self._db.executemany(
+                'DELETE FROM scanned WHERE path = ?',
+                ((path,) for path in removed))
+            self._db.executemany(
+                'INSERT OR REPLACE INTO scanned_dirs (path, parent) '
+                'VALUES (?, ?)', dirs)
+            for path in removed_dirs:
+                prefix = path.rstrip(os.sep) + os.sep
+                end = prefix[:-1] + chr(ord(os.sep) + 1)
+                self._db.execute(
+                    'DELETE FROM scanned WHERE directory = ? '
+                    'OR (directory >= ? AND directory < ?)',
+                    (path, prefix, end))
+                self._db.execute(
+                    'DELETE FROM scanned_dirs WHERE path = ? '
+                    'OR (path >= ? AND path < ?)', (path, prefix, end))
+
+    def find_scanned(self, *, artist=None, album=None):
+        """Return the scanned files that match everything given.
+
+        Both ignore case. Each file is a dict of its path and tags.
+        """
+        where = []
+        params = []
+        if artist is not None:
+            where.append('artist = ? COLLATE NOCASE')
+            params.append(artist)
+        if album is not None:
+            where.append('album = ? COLLATE NOCASE')
+            params.append(album)
+        query = 'SELECT path, {} FROM scanned'.format(', '.join(SCANNED_TAGS))
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        return [dict(row) for row in self._db.execute(
+            query + ' ORDER BY path', params)]
+
+
+def _read_albumdata(filename):
+    try:
+        with open(filename, 'r') as f:
+            data = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        raise LibraryError('Could not read {}: {}'.format(filename, e))
+    if type(data) is not dict or 'tracks' not in data:
+        raise LibraryError('{} is not albumdata'.format(filename))
+
+    files = []
+    for n, track in enumerate(data['tracks'], 1):
+        if not track.get('filename'):
+            continue
+        try:
+            size = os.path.getsize(track['filename'])
+        except OSError:
+            size = None
+        files.append((n, track['filename'], size, None))
+    return data, files
+
+
+def find_albumdata(paths):
+    """Yield albumdata.yaml files from paths, searching directories."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            if 'albumdata.yaml' in filenames:
+                yield os.path.join(dirpath, 'albumdata.yaml')
+
+
+def _open_library(index):
+    if index is None:
+        index = index_filename(Config())
+        if index is None:
+            raise LibraryError('The library index is turned off')
+    return Library(index)
+
+
+@click.group()
+@click.option('--index', type=click.Path(dir_okay=False), default=None,
+    help="""The index to use (default: library_index from the
+    configuration).""")
+@click.pass_context
+def main(ctx, index):
+    """Look up and maintain the index of ripped discs."""
+    ctx.obj = index
+
+
+@main.command('import')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.pass_obj
+def import_command(index, paths):
+    """Add earlier rips to the index.
+
+    PATHS are albumdata.yaml files, or directories that are searched for
+    them.
+    """
+    library = _open_library(index)
+    try:
+        imported, failed = library.import_albumdata(find_albumdata(paths))
+    finally:
+        library.close()
+    for filename, error in failed:
+        print(error, file=sys.stderr)
+    print('Imported {} albumdata files, {} failed'.format(
+        imported, len(failed)))
+
+
+@main.command()
+@click.option('--discid', default=None, help="""Find the disc with this id.""")
+@click.option('--artist', default=None,
+    help="""Find discs by this artist.""")
+@click.option('--album', default=None, help="""Find discs with this title.""")
+@click.option('--path', default=None,
+    help="""Find the discs with this file, or files under this
+    directory.""")
+@click.pass_obj
+def find(index, discid, artist, album, path):
+    """Look up ripped discs and their files."""
+    library = _open_library(index)
+    try:
+        discs = library.find(discid=discid, artist=artist, album=album,
+                             path=path)
+    finally:
+        library.close()
+    for disc in discs:
+        print('{} - {} ({}) [{}]'.format(
+            disc['albumartist'], disc['album'], disc['date'] or '',
+            disc['discid'] or 'no disc id'))
+        for f in disc['files']:
+            print('  {:2d} {}'.format(f['tracknumber'], f['path']))
+
+
+@main.command('scan')
+@click.argument('directories', nargs=-1, required=True,
+                type=click.Path(exists=True, file_okay=False))
+@click.option('--jobs', '-j', type=int, default=None,
+    help="""How many files to read the tags of at once (default: one per
+    CPU).""")
+@click.option('--watch', is_flag=True, default=False,
+    help="""Keep watching DIRECTORIES after the scan and scan whatever
+    changes in them (needs inotify).""")
+@click.pass_obj
+def scan_command(index, directories, jobs, watch):
+    """Index the music files under DIRECTORIES.
+
+    Only files that are new or have changed since the last scan have
+    their tags read, so scanning again is quick.
+    """
+    # scan needs reencode, which needs us
+    from . import scan
+
+    library = _open_library(index)
+    watcher = None
+    try:
+        if watch:
+            watcher = scan.Watcher()
+        scanner = scan.Scanner(
+            library, jobs=jobs,
+            on_directory=watcher.add if watcher is not None else None)
+
+        def report():
+            print('{} new, {} changed, {} removed, {} unchanged, '
+                  '{} unreadable'.format(
+                      scanner.added, scanner.changed, scanner.removed,
+                      scanner.unchanged, scanner.failed))
+
+        scanner.scan(directories)
+        report()
+        if watcher is not None:
+            print('Watching for changes')
+            scan.watch(scanner, watcher, directories, report=report)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.close()
+        library.close()
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
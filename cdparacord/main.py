@@ -1,12 +1,21 @@
+import asyncio
 import os
 import click
 import shutil
+import sys
+import textwrap
+import time
 import yaml
+from . import image
+from . import library
+from . import metrics
+from . import profiling
 from .albumdata import Albumdata
 from .config import Config
 from .dependency import Dependency
 from .error import CdparacordError
-from .rip import Rip
+from .rip import Rip, expand_args
+from .util import run_process
 
 
 @click.command()
@@ -25,6 +34,17 @@ from .rip import Rip
 @click.option('--submit', 'submit_to_musicbrainz', is_flag=True, default=False,
     help="""Ignore all other options and instead open the MusicBrainz
     submission page.""")
+@click.option('--profile', is_flag=True, default=False,
+    help="""Profile cdparacord itself and write the results into the
+    ripdir (which is then kept).""")
+@click.option('--image', 'image_file',
+    type=click.Path(exists=True, dir_okay=False), default=None,
+    help="""Rip from a disc image (a cue sheet or a WAV file) instead
+    of the drive.""")
+@click.option('--on-duplicate', 'on_duplicate',
+    type=click.Choice(['ask', 'skip', 'rip', 'reencode']), default=None,
+    help="""What to do with a disc that has been ripped before: ask,
+    skip it, rip it again or re-encode the files ripped before.""")
 def main(begin_track, end_track, **options):
     """Rip, encode and tag CDs and fetch albumdata from MusicBrainz.
 
@@ -34,8 +54,9 @@ def main(begin_track, end_track, **options):
     neither is specified, the whole CD will be ripped.
 
     Cdparacord creates a temporary directory under /tmp, runs cdparanoia
-    to rip discs into it and copies the resulting encoded files to the
-    target directory configured in the configuration file.
+    to rip discs into it (or into RAM, if there's room) and moves the
+    resulting encoded files to the target directory configured in the
+    configuration file.
 
     See documentation for more.
     """
@@ -45,9 +66,38 @@ def main(begin_track, end_track, **options):
     # config is added is by adding new elements to the default config)
     config.update(options)
 
+    if not options['profile']:
+        _session(config, begin_track, end_track, options, None)
+        return
+
+    # The profile is written into the ripdir, so it can't be removed
+    options['keep_ripdir'] = True
+    config.update({'keep_ripdir': True})
+    profiler = profiling.profiler_from_config(config)
+    profiler.start()
+    try:
+        _session(config, begin_track, end_track, options, profiler)
+    finally:
+        profiler.stop()
+        if profiler.directory is None:
+            print('No ripdir was created, so the profile was not written')
+        else:
+            print('Wrote profile to {}'.format(profiler.write()))
+
+
+def _session(config, begin_track, end_track, options, profiler):
+    """Do everything main does after reading configuration."""
     # Discover dependencies
     deps = Dependency(config)
 
+    # Keep counting from where the last run left off
+    metrics_textfile = config.get('metrics_textfile')
+    if metrics_textfile:
+        metrics_textfile = os.path.expanduser(metrics_textfile)
+        metrics.load_textfile(metrics_textfile)
+    if config.get('metrics_listen'):
+        metrics.serve(config.get('metrics_listen'))
+
     # We're done with dependencies so we know discid is there
     if options['submit_to_musicbrainz']:
         print('Submitting discid to MusicBrainz')
@@ -56,19 +106,55 @@ def main(begin_track, end_track, **options):
         webbrowser.open(discid.read().submission_url)
         return
 
-    # Read albumdata from user and MusicBrainz
-    albumdata = Albumdata.from_user_input(deps, config)
+    disc_image = None
+    if options['image_file']:
+        disc_image = image.DiscImage.open(options['image_file'])
+
+    try:
+        disc = Albumdata.read_disc(disc_image)
+        # Before anything slow happens, see if this is a disc we've
+        # already got
+        ripped = _ripped_before(config, str(disc))
+        action = 'rip'
+        if ripped is not None:
+            action = _duplicate_action(config, ripped)
+        if action == 'skip':
+            print('Skipping the disc.')
+            return
+        elif action == 'reencode':
+            albumdata = Albumdata.from_library(ripped['albumdata'], config)
+        else:
+            # Read albumdata from user and MusicBrainz
+            albumdata = Albumdata.from_user_input(
+                deps, config, disc=disc, disc_image=disc_image)
+    finally:
+        # The rip opens the image again itself
+        if disc_image is not None:
+            disc_image.close()
     if albumdata is None:
         print('User aborted albumdata selection.')
         return
 
     # Create the ripdir if we got albumdata
     os.makedirs(albumdata.ripdir, 0o700, exist_ok=True)
+    # The wavs might live somewhere else, like on a tmpfs
+    os.makedirs(albumdata.wavdir, 0o700, exist_ok=True)
     # Save albumdata in a file
     albumdata_file = os.path.join(albumdata.ripdir, 'albumdata.yaml')
     with open(albumdata_file, 'w') as f:
         yaml.safe_dump(albumdata.dict, f)
 
+    if action == 'reencode':
+        _decode_ripped(config, albumdata, ripped['files'])
+        # The wavs are there, so the rip goes straight to encoding
+        options['continue_rip'] = True
+
+    if profiler is not None:
+        # Rip runs on the default loop
+        profiler.directory = albumdata.ripdir
+        profiler.snapshot('albumdata')
+        profiler.configure_loop(asyncio.get_event_loop())
+
     # Choose which tracks to rip based on the command line.  The logic
     # is pretty straightforward: If we get neither argument, rip all. If
     # we get one argument, rip only that track. Otherwise rip the
@@ -95,13 +181,117 @@ def main(begin_track, end_track, **options):
     # It deals with the rip queue, encoding, tagging
     rip = Rip(albumdata, deps, config, begin_track, end_track,
             options['continue_rip'])
-    rip.rip_pipeline()
+    try:
+        rip.rip_pipeline()
+    finally:
+        # The rip records analysis results in albumdata, so save it
+        # again whether or not the rip succeeded
+        with open(albumdata_file, 'w') as f:
+            yaml.safe_dump(albumdata.dict, f)
 
     # We have a flag to keep ripdir
     if not options['keep_ripdir']:
         print('Removing ripdir')
         shutil.rmtree(albumdata.ripdir)
+        if albumdata.wavdir != albumdata.ripdir:
+            shutil.rmtree(albumdata.wavdir)
+        if metrics_textfile:
+            metrics.RIPDIR_BYTES.set(0)
+            metrics.write_textfile(metrics_textfile)
     print('\n\nCdparacord finished.')
 
+def _ripped_before(config, disc):
+    """Return the disc from the library index if it's been ripped."""
+    filename = library.index_filename(config)
+    # No index, no rips to know about
+    if filename is None or not os.path.exists(filename):
+        return None
+    index = library.Library(filename)
+    try:
+        return index.get(disc)
+    finally:
+        index.close()
+
+
+def _duplicate_action(config, ripped):
+    """Decide what to do with a disc that has been ripped before.
+
+    Returns skip, rip or reencode.
+    """
+    print('{} - {} was already ripped on {}.'.format(
+        ripped['albumartist'], ripped['album'],
+        time.strftime('%Y-%m-%d %H:%M',
+                      time.localtime(ripped['ripped_at'] or 0))))
+    policy = config.get('on_duplicate')
+    if policy == 'ask' and not sys.stdin.isatty():
+        # Nobody there to answer
+        policy = config.get('on_duplicate_unattended')
+    if policy in ('skip', 'rip'):
+        return policy
+    elif policy == 'reencode':
+        if not ripped['files']:
+            raise CdparacordError(
+                'No files of the earlier rip to re-encode')
+        undecodable = _undecodable(config, ripped['files'])
+        if undecodable:
+            raise CdparacordError(
+                'Can not re-encode {}: the decoder reads .{} files '
+                '(decoder_extension)'.format(
+                    undecodable[0], config.get('decoder_extension')))
+        return policy
+    elif policy != 'ask':
+        raise CdparacordError(
+            'Unknown on_duplicate policy {}'.format(policy))
+
+    choices = {'s': 'skip', 'r': 'rip'}
+    print(textwrap.dedent("""\
+        s: skip it
+        r: rip it again"""))
+    if ripped['files'] and not _undecodable(config, ripped['files']):
+        choices['e'] = 'reencode'
+        print('e: re-encode the {} files ripped before'.format(
+            len(ripped['files'])))
+    while True:
+        choice = input('> ').strip()
+        if choice in choices:
+            return choices[choice]
+
+
+def _undecodable(config, files):
+    """Return the paths of files the decoder doesn't read.
+
+    Decoding a lossy file and encoding it again would only lose more,
+    so only files in the decoder's format are re-encoded.
+    """
+    suffix = '.' + config.get('decoder_extension').lstrip('.').lower()
+    return [f['path'] for f in files
+            if not f['path'].lower().endswith(suffix)]
+
+
+def _decode_ripped(config, albumdata, files):
+    """Decode the files of an earlier rip into the wavs of a new one.
+
+    files are the files of the disc from the library index.
+    """
+    deps = Dependency(config, ripping=False)
+    decoder = config.get('decoder')
+    decoder_name = list(decoder.keys())[0]
+    jobs = asyncio.Semaphore(
+        max(1, config.get('reencode_jobs') or os.cpu_count() or 1))
+
+    async def decode(f):
+        # Where Rip looks for the ripped wavs
+        wav = os.path.join(
+            albumdata.wavdir, '{}.wav'.format(f['tracknumber']))
+        async with jobs:
+            await run_process(
+                deps.decoder,
+                expand_args(decoder[decoder_name], f['path'], out_file=wav),
+                'Decoding {}'.format(f['path']))
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.gather(*[decode(f) for f in files]))
+
+
 if __name__ == "__main__": # pragma: no cover
     main()
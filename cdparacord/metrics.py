@@ -0,0 +1,329 @@
+"""Metrics for monitoring ripping stations, in the Prometheus format.
+
+The metrics live in a module-level registry and are fed from wherever
+the thing being measured happens. They can be written to a file for
+node_exporter's textfile collector, or served over HTTP for as long as
+cdparacord runs.
+
+Each run of cdparacord is a new process, so counters would start over
+from zero each time. To keep them counting, the counters and
+histograms in an existing textfile are read back in before a rip and
+added to.
+"""
+import http.server
+import math
+import os
+import os.path
+import re
+import socketserver
+import threading
+from .error import CdparacordError
+
+
+class MetricsError(CdparacordError):
+    pass
+
+
+# Stages take from milliseconds (tagging) to minutes (ripping a long
+# track on a bad disc)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\')
+                               .replace('"', r'\"')
+                               .replace('\n', r'\n'))
+        for k, v in labels))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = registry.lock
+        # Sorted label items -> value
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise MetricsError('{} takes labels {}, got {}'.format(
+                self.name, ', '.join(self.labelnames),
+                ', '.join(labels) or 'none'))
+        return tuple(sorted(labels.items()))
+
+    def get(self, **labels):
+        """Return the current value, mostly for tests."""
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def samples(self):
+        """Return a list of (name, labels, value) for the exposition."""
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self._values.items())]
+
+    def load(self, name, labels, value):
+        """Add a sample read back from a previous exposition."""
+        pass
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def load(self, name, labels, value):
+        if name == self.name:
+            self.inc(value, **dict(labels))
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), *,
+                 buckets=STAGE_BUCKETS):
+        self.buckets = tuple(buckets) + (math.inf,)
+        super().__init__(registry, name, documentation, labelnames)
+
+    def _empty(self):
+        return {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            h = self._values.setdefault(key, self._empty())
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h['buckets'][i] += 1
+            h['sum'] += value
+            h['count'] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, h in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, h['buckets']):
+                    samples.append(('{}_bucket'.format(self.name),
+                                    key + (('le', _format_value(bound)),),
+                                    count))
+                samples.append(('{}_sum'.format(self.name), key, h['sum']))
+                samples.append(('{}_count'.format(self.name), key,
+                                h['count']))
+        return samples
+
+    def load(self, name, labels, value):
+        if name == '{}_bucket'.format(self.name):
+            labels = dict(labels)
+            bound = labels.pop('le', None)
+            if bound is None:
+                return
+            bound = math.inf if bound == '+Inf' else float(bound)
+            if bound not in self.buckets:
+                # Buckets changed between versions; can't merge that
+                return
+            field, index = 'buckets', self.buckets.index(bound)
+        elif name == '{}_sum'.format(self.name):
+            labels, field, index = dict(labels), 'sum', None
+        elif name == '{}_count'.format(self.name):
+            labels, field, index = dict(labels), 'count', None
+        else:
+            return
+        key = self._key(labels)
+        with self._lock:
+            h = self._values.setdefault(key, self._empty())
+            if index is None:
+                h[field] += value
+            else:
+                h[field][index] += value
+
+
+class Registry:
+    """A set of metrics that are exposed together."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def expose(self):
+        """Return every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(
+                metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    _sample_re = re.compile(
+        r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+    _label_re = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+    def load(self, text):
+        """Add counters and histograms from an earlier exposition.
+
+        Gauges are current values, not totals, so they're not loaded.
+        """
+        for line in text.split('\n'):
+            match = self._sample_re.match(line)
+            if line.startswith('#') or match is None:
+                continue
+            name, labels, value = match.groups()
+            labels = tuple(
+                (k, v.replace(r'\n', '\n').replace(r'\"', '"')
+                     .replace(r'\\', '\\'))
+                for k, v in self._label_re.findall(labels or ''))
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            for metric in self._metrics:
+                if name.startswith(metric.name):
+                    try:
+                        metric.load(name, labels, value)
+                    except MetricsError:
+                        # Labels changed between versions
+                        pass
+
+
+REGISTRY = Registry()
+
+DISCS_COMPLETED = Counter(
+    REGISTRY, 'cdparacord_discs_completed_total',
+    'Discs ripped to completion.')
+TRACKS = Counter(
+    REGISTRY, 'cdparacord_tracks_total',
+    'Tracks that made it through each stage.', ['stage'])
+STAGE_FAILURES = Counter(
+    REGISTRY, 'cdparacord_stage_failures_total',
+    'Stages that failed.', ['stage'])
+STAGE_SECONDS = Histogram(
+    REGISTRY, 'cdparacord_stage_seconds',
+    'Time taken by each stage, per track or per disc.', ['stage'])
+DRIVE_READ_BYTES = Counter(
+    REGISTRY, 'cdparacord_drive_read_bytes_total',
+    'Audio bytes read from the drive.')
+DRIVE_READ_SPEED = Gauge(
+    REGISTRY, 'cdparacord_drive_read_bytes_per_second',
+    'Read speed of the drive over the last track ripped.')
+ENCODED_AUDIO_SECONDS = Counter(
+    REGISTRY, 'cdparacord_encoded_audio_seconds_total',
+    'Seconds of audio encoded.')
+ENCODE_SPEED = Gauge(
+    REGISTRY, 'cdparacord_encode_speed_ratio',
+    'Seconds of audio encoded per wall second, for the last track.')
+RIPDIR_BYTES = Gauge(
+    REGISTRY, 'cdparacord_ripdir_bytes',
+    'Bytes in the ripdir (and the wav directory, if separate).')
+
+
+def enabled(config):
+    """Return whether metrics are exposed at all."""
+    return bool(config.get('metrics_textfile') or config.get('metrics_listen'))
+
+
+def observe_span(event):
+    """Record a finished trace span; see trace.Tracer."""
+    STAGE_SECONDS.observe(event['end'] - event['start'], stage=event['stage'])
+    if event['status'] not in (None, 0):
+        STAGE_FAILURES.inc(stage=event['stage'])
+
+
+def directory_size(*directories):
+    """Return the total size of the files in the given directories."""
+    total = 0
+    for directory in set(directories):
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except FileNotFoundError:
+                    # Removed while we were looking
+                    pass
+    return total
+
+
+def write_textfile(filename, registry=REGISTRY):
+    """Atomically write the metrics to filename."""
+    temp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp, 'w') as f:
+        f.write(registry.expose())
+    os.rename(temp, filename)
+
+
+def load_textfile(filename, registry=REGISTRY):
+    """Load totals from a textfile written by an earlier run, if any."""
+    try:
+        with open(filename, 'r') as f:
+            registry.load(f.read())
+    except FileNotFoundError:
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(address, registry=REGISTRY):
+    """Serve the metrics over HTTP from a daemon thread.
+
+    address is "host:port". Returns the server; call shutdown on it to
+    stop serving.
+    """
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise MetricsError('Invalid metrics address {}'.format(address))
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header(
+                'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = _Server((host or '127.0.0.1', port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,184 @@
+"""Deciding where files live during a rip and moving them into place."""
+import errno
+import os
+import os.path
+import re
+import shutil
+import tempfile
+
+
+# Bytes per CD sector of audio
+SECTOR_BYTES = 2352
+
+# Directories that are usually RAM-backed, in order of preference
+_RAM_DIRS = (os.environ.get('XDG_RUNTIME_DIR'), '/dev/shm')
+
+_OCTAL_ESCAPE = re.compile(br'\\([0-7]{3})')
+
+
+def _unescape(match):
+    return bytes((int(match.group(1), 8),))
+
+
+def _mounts(filename='/proc/self/mounts'):
+    """Return a dict of mount point -> filesystem type."""
+    mounts = {}
+    try:
+        with open(filename, 'rb') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3:
+                    # Space, tab, newline and backslash in mount points
+                    # are octal escaped; the rest is as it is on disk
+                    mount_point = os.fsdecode(
+                        _OCTAL_ESCAPE.sub(_unescape, parts[1]))
+                    mounts[mount_point] = os.fsdecode(parts[2])
+    except OSError:
+        # Not Linux, or no /proc. We just won't find any RAM then.
+        pass
+    return mounts
+
+
+def is_ram_backed(path):
+    """Find out whether path is on tmpfs or ramfs."""
+    path = os.path.realpath(path)
+    mounts = _mounts()
+    # The mount point a path is on is the longest one that prefixes it
+    best = None
+    for mount_point in mounts:
+        prefix = mount_point.rstrip('/') + '/'
+        if ((path + '/').startswith(prefix)
+                and (best is None or len(mount_point) > len(best))):
+            best = mount_point
+    return best is not None and mounts[best] in ('tmpfs', 'ramfs')
+
+
+def free_space(path):
+    """Return bytes available to us on the filesystem of path."""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def rip_subdir(base, discid):
+    """Return the per-user, per-disc directory under base."""
+    return os.path.join(
+        base, 'cdparacord', '{uid}-{discid}'.format(
+            uid=os.getuid(), discid=discid))
+
+
+def default_ripdir(discid):
+    """Return the ripdir for discid."""
+    return rip_subdir(tempfile.gettempdir(), discid)
+
+
+def choose_wavdir(config, ripdir, discid, needed_bytes):
+    """Decide where the ripped wav files should go.
+
+    Depending on the wav_dir setting this is either the ripdir, a
+    RAM-backed directory if one has room for needed_bytes, or a
+    directory of the user's choosing.
+    """
+    setting = config.get('wav_dir')
+    if setting in (None, 'ripdir'):
+        return ripdir
+    elif setting == 'auto':
+        # Leave some headroom; running tmpfs out of space is not fun for
+        # anyone else using it
+        needed_bytes = int(needed_bytes * 1.1)
+        for candidate in _RAM_DIRS:
+            if not candidate or not os.path.isdir(candidate):
+                continue
+            if not os.access(candidate, os.W_OK | os.X_OK):
+                continue
+            if not is_ram_backed(candidate):
+                continue
+            if free_space(candidate) < needed_bytes:
+                continue
+            return rip_subdir(candidate, discid)
+        return ripdir
+    else:
+        return rip_subdir(os.path.expanduser(setting), discid)
+
+
+def staging_filename(target_file):
+    """Return where to stage an encoded file headed for target_file.
+
+    The staged file is hidden next to its target so that publishing it
+    is a rename within one filesystem.
+    """
+    directory, name = os.path.split(target_file)
+    stem, ext = os.path.splitext(name)
+    # Keep the extension last so format detection still works
+    return os.path.join(
+        directory, '.{}.cdparacord-part{}'.format(stem, ext))
+
+
+def fast_copy(src, dst):
+    """Copy src to dst in the kernel where possible.
+
+    Tries copy_file_range (which can even reflink on some filesystems),
+    then sendfile, then falls back to a plain read/write copy. Metadata
+    is copied like shutil.copy2 does.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+        size = os.fstat(infd).st_size
+        copied = 0
+
+        # Each of these either copies everything or nothing, so on
+        # failure we can just try the next one from the start
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(infd, outfd, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                if copied or e.errno not in (
+                        errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+
+        if copied == 0 and size > 0 and hasattr(os, 'sendfile'):
+            try:
+                while copied < size:
+                    n = os.sendfile(outfd, infd, copied, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                if copied or e.errno not in (
+                        errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+
+        if copied == 0 and size > 0:
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
+def publish(src, dst):
+    """Move src to dst atomically.
+
+    This is a plain rename if they're on the same filesystem. Otherwise
+    src is copied next to dst under a temporary name first, so dst
+    either doesn't exist or is complete.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    temp = staging_filename(dst)
+    try:
+        fast_copy(src, temp)
+        os.rename(temp, dst)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    os.remove(src)
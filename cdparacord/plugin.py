@@ -0,0 +1,106 @@
+"""Post tasks written in Python and run inside cdparacord.
+
+A task like
+
+    post_encode:
+      - python: mypackage.tasks:write_checksum
+
+calls write_checksum instead of starting a process for every file.
+Instead of module:function, the name of an entry point in the
+cdparacord.tasks group can be given, so installed packages can offer
+tasks by name.
+
+The function is called with keyword arguments:
+
+- stage: post_rip, post_encode or post_finished
+- albumdata: the Albumdata of the rip, or None when re-encoding
+- track: the Track the file belongs to, or None
+- one_file: the file to work on, or None in post_finished
+- all_files: in post_finished, the list of all the files
+
+A function should take **kwargs so that later additions don't break it.
+Coroutine functions are awaited; everything else is run in a thread so
+the rip goes on meanwhile. The task fails if the function raises.
+"""
+import asyncio
+import functools
+import importlib
+from .error import CdparacordError
+
+
+class PluginError(CdparacordError):
+    pass
+
+
+# The key that marks a task as a plugin
+TASK_KEY = 'python'
+ENTRY_POINT_GROUP = 'cdparacord.tasks'
+
+
+def is_plugin(task):
+    """Tell whether a post task is a plugin.
+
+    A python key with a list of arguments is still just an executable
+    called python.
+    """
+    return TASK_KEY in task and isinstance(task[TASK_KEY], str)
+
+
+def _entry_point(name):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # Before Python 3.8
+        import pkg_resources
+        points = pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name)
+    else:
+        points = entry_points()
+        if hasattr(points, 'select'):
+            points = points.select(group=ENTRY_POINT_GROUP, name=name)
+        else:
+            points = [p for p in points.get(ENTRY_POINT_GROUP, ())
+                      if p.name == name]
+    for point in points:
+        return point.load()
+    raise PluginError('No task called {} is installed'.format(name))
+
+
+def load(spec):
+    """Return the function spec names.
+
+    Raises PluginError if there's no such function.
+    """
+    if ':' not in spec:
+        func = _entry_point(spec)
+    else:
+        module_name, _, attr = spec.partition(':')
+        try:
+            func = importlib.import_module(module_name)
+        except ImportError as e:
+            raise PluginError('Could not import {}: {}'.format(
+                module_name, e)) from e
+        for part in attr.split('.'):
+            try:
+                func = getattr(func, part)
+            except AttributeError:
+                raise PluginError('{} has no {}'.format(
+                    module_name, attr)) from None
+    if not callable(func):
+        raise PluginError('{} is not a function'.format(spec))
+    return func
+
+
+async def run(func, spec, **kwargs):
+    """Run a plugin function with kwargs.
+
+    Raises PluginError if it fails.
+    """
+    try:
+        if asyncio.iscoroutinefunction(func):
+            await func(**kwargs)
+        else:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                None, functools.partial(func, **kwargs))
+    except Exception as e:
+        raise PluginError('Task {} failed: {}'.format(spec, e)) from e
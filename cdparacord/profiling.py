@@ -0,0 +1,117 @@
+"""Profiling cdparacord itself, for when the Python side is slow.
+
+The whole session runs under cProfile, the event loop runs in debug
+mode so callbacks that hog it get logged, and optionally tracemalloc
+snapshots are taken between phases. Everything is written into one
+directory at the end.
+"""
+import cProfile
+import io
+import logging
+import os
+import os.path
+import pstats
+import time
+import tracemalloc
+
+
+class _ListHandler(logging.Handler):
+    """Keeps the records it's given."""
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class Profiler:
+    """Profiles a session.
+
+    slow_callback is the number of seconds a callback may run before
+    asyncio complains about it. If tracemalloc_frames is more than 0,
+    memory allocations are traced with that many frames each and
+    snapshot takes a snapshot.
+    """
+    def __init__(self, *, slow_callback=0.1, tracemalloc_frames=0):
+        self._profile = cProfile.Profile()
+        self._slow_callback = slow_callback
+        self._tracemalloc_frames = tracemalloc_frames
+        self._snapshots = []
+        self._handler = _ListHandler()
+        self._start = None
+        self._elapsed = None
+        # Where to write the reports; set once we know
+        self.directory = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        logging.getLogger('asyncio').addHandler(self._handler)
+        if self._tracemalloc_frames > 0:
+            tracemalloc.start(self._tracemalloc_frames)
+            self.snapshot('start')
+        self._profile.enable()
+
+    def configure_loop(self, loop):
+        """Put loop into debug mode so slow callbacks are logged."""
+        loop.set_debug(True)
+        loop.slow_callback_duration = self._slow_callback
+
+    def snapshot(self, label):
+        """Take a tracemalloc snapshot, if tracing allocations."""
+        if tracemalloc.is_tracing():
+            self._snapshots.append((label, tracemalloc.take_snapshot()))
+
+    def stop(self):
+        self._profile.disable()
+        self._elapsed = time.perf_counter() - self._start
+        if self._tracemalloc_frames > 0:
+            self.snapshot('end')
+            tracemalloc.stop()
+        logging.getLogger('asyncio').removeHandler(self._handler)
+
+    def report(self):
+        """Return the text report."""
+        out = io.StringIO()
+        out.write('Profiled {:.2f}s\n\n'.format(self._elapsed or 0.0))
+
+        stats = pstats.Stats(self._profile, stream=out)
+        stats.strip_dirs()
+        for sort in ('cumulative', 'tottime'):
+            out.write('Top functions by {}:\n'.format(sort))
+            stats.sort_stats(sort).print_stats(30)
+
+        slow = [r for r in self._handler.records if 'took' in r.getMessage()]
+        out.write('Event loop callbacks slower than {}s: {}\n'.format(
+            self._slow_callback, len(slow)))
+        for record in slow:
+            out.write('  {}\n'.format(record.getMessage()))
+        out.write('\n')
+
+        for (label, before), (next_label, after) in zip(
+                self._snapshots, self._snapshots[1:]):
+            out.write('Allocations from {} to {}:\n'.format(
+                label, next_label))
+            for diff in after.compare_to(before, 'lineno')[:15]:
+                out.write('  {}\n'.format(diff))
+            out.write('\n')
+        return out.getvalue()
+
+    def write(self):
+        """Write profile.pstats and profile.txt into the directory.
+
+        Returns the name of the text report.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._profile.dump_stats(
+            os.path.join(self.directory, 'profile.pstats'))
+        filename = os.path.join(self.directory, 'profile.txt')
+        with open(filename, 'w') as f:
+            f.write(self.report())
+        return filename
+
+
+def profiler_from_config(config):
+    return Profiler(
+        slow_callback=config.get('profile_slow_callback') or 0.1,
+        tracemalloc_frames=config.get('profile_tracemalloc_frames') or 0)
@@ -0,0 +1,201 @@
+"""Publishing encoded files into the music library."""
+import asyncio
+import concurrent.futures
+import errno
+import hashlib
+import os
+import os.path
+import shutil
+from . import placement
+from .error import CdparacordError
+
+
+class PublishError(CdparacordError):
+    pass
+
+
+# Big enough to keep syscall overhead down, small enough not to matter
+CHUNK_SIZE = 1024 * 1024
+
+CHECKSUM_ALGORITHMS = ('md5', 'sha256')
+
+
+def fsync_path(path):
+    """Flush a file or directory to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _hash_file(f, algorithm):
+    """Hash an open file from its current position."""
+    h = hashlib.new(algorithm)
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_file(filename, algorithm):
+    """Return the hex digest of a file."""
+    with open(filename, 'rb') as f:
+        return _hash_file(f, algorithm)
+
+
+def _copy_and_hash(src, dst, algorithm, fsync):
+    """Copy src to dst, hashing it on the way. Returns the hex digest."""
+    h = hashlib.new(algorithm)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while True:
+            chunk = fsrc.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+            fdst.write(chunk)
+        if fsync:
+            fdst.flush()
+            os.fsync(fdst.fileno())
+    shutil.copystat(src, dst)
+    return h.hexdigest()
+
+
+def publish_file(src, dst, *, checksum=None, fsync=True):
+    """Move src to dst atomically and return its checksum.
+
+    If checksum names a hash algorithm, the file's digest is computed
+    in the same pass that moves it (when it can be renamed, the only
+    pass). Otherwise None is returned and the copy, if one is needed,
+    is left to the kernel.
+
+    The directory of dst is not synced; that's left to the caller so it
+    can be done once per directory.
+    """
+    directory = os.path.dirname(dst)
+    os.makedirs(directory, exist_ok=True)
+
+    if checksum is None:
+        if fsync:
+            fsync_path(src)
+        placement.publish(src, dst)
+        if fsync:
+            # The copy fallback in placement.publish doesn't sync
+            fsync_path(dst)
+        return None
+
+    # Same filesystem: read once for the digest, then rename
+    if os.stat(src).st_dev == os.stat(directory).st_dev:
+        with open(src, 'rb') as f:
+            digest = _hash_file(f, checksum)
+            if fsync:
+                os.fsync(f.fileno())
+        try:
+            os.rename(src, dst)
+            return digest
+        except OSError as e:
+            # Bind mounts can share st_dev and still refuse this
+            if e.errno != errno.EXDEV:
+                raise
+
+    temp = placement.staging_filename(dst)
+    try:
+        digest = _copy_and_hash(src, temp, checksum, fsync)
+        os.rename(temp, dst)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    os.remove(src)
+    return digest
+
+
+def parse_manifest(text):
+    """Parse a checksum manifest into a dict of name -> digest."""
+    entries = {}
+    for line in text.split('\n'):
+        if not line:
+            continue
+        # Same format as md5sum and sha256sum: digest, two spaces (or
+        # space and asterisk) and the name
+        space = line.index(' ')
+        entries[line[space + 2:]] = line[:space]
+    return entries
+
+
+def format_manifest(entries):
+    """Format a dict of name -> digest as a checksum manifest."""
+    return ''.join('{}  {}\n'.format(entries[name], name)
+                   for name in sorted(entries))
+
+
+def manifest_filename(directory, algorithm):
+    """Return the manifest name for a directory: <dirname>.<algorithm>."""
+    name = os.path.basename(os.path.normpath(directory)) or 'checksums'
+    return os.path.join(directory, '{}.{}'.format(name, algorithm))
+
+
+class Publisher:
+    """Moves files into the library in parallel.
+
+    Files are handed to the storage backend in a thread pool of the
+    given size as they come in. The directories they were published
+    into are finished (synced, for local storage) and the checksum
+    manifests written when finish is awaited.
+    """
+    def __init__(self, backend, jobs, *, checksum=None):
+        if checksum is not None and checksum not in CHECKSUM_ALGORITHMS:
+            raise PublishError(
+                'Unknown checksum algorithm {} (expected one of {})'.format(
+                    checksum, ', '.join(CHECKSUM_ALGORITHMS)))
+        self._backend = backend
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max(1, jobs))
+        self._checksum = checksum
+        # Target file -> digest (or None without checksums)
+        self._published = {}
+
+    @property
+    def published(self):
+        """Return a dict of published file -> checksum."""
+        return self._published
+
+    async def publish(self, src, dst):
+        """Publish src as dst."""
+        loop = asyncio.get_event_loop()
+        digest = await loop.run_in_executor(
+            self._executor,
+            lambda: self._backend.put(src, dst, checksum=self._checksum))
+        self._published[dst] = digest
+        print('Published {}'.format(dst))
+
+    def _finish(self):
+        directories = {}
+        for filename, digest in self._published.items():
+            directory, name = os.path.split(filename)
+            directories.setdefault(directory, {})[name] = digest
+
+        if self._checksum is not None:
+            for directory, files in directories.items():
+                manifest = manifest_filename(directory, self._checksum)
+                # Keep entries of files published earlier, like other
+                # discs of the same album
+                entries = parse_manifest(
+                    self._backend.read_text(manifest) or '')
+                entries.update(files)
+                self._backend.write_text(manifest, format_manifest(entries))
+
+        self._backend.finish(sorted(directories))
+
+    async def finish(self):
+        """Finish directories and write manifests for everything published.
+
+        Shuts down the thread pool, so nothing can be published after.
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._finish)
+        finally:
+            self._executor.shutdown()
@@ -0,0 +1,308 @@
+"""Re-encoding an archive of lossless files into the current format.
+
+Each file in the archive is decoded back into a wav and then goes
+through the same encoder, post_encode tasks and tagging as a freshly
+ripped track. Several files are worked on at once, as many as there are
+CPUs by default.
+
+What has been done is recorded in a manifest in the output directory,
+so files that are up to date are skipped and an interrupted run can
+simply be started again.
+"""
+import asyncio
+import click
+import functools
+import json
+import mutagen
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+from . import analysis
+from . import command
+from . import encoders
+from . import graph
+from . import placement
+from . import plugin
+from . import publish
+from .config import Config
+from .dependency import Dependency
+from .error import CdparacordError
+from .library import encoder_hash
+from .rip import expand_args, tag_file
+from .util import find_sources, read_tags, run_process
+
+
+class ReencodeError(CdparacordError):
+    pass
+
+
+# Kept in the output directory
+MANIFEST_NAME = '.cdparacord-reencode.jsonl'
+
+
+class Manifest:
+    """Records which files have been re-encoded and with what.
+
+    Entries are JSON lines appended as files are finished, so an
+    interrupted run loses only what it was working on. When a file
+    appears more than once, the last entry counts.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._entries = {}
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Most likely a line cut short by an interruption
+                        continue
+                    self._entries[entry['source']] = entry
+        except FileNotFoundError:
+            pass
+        self._file = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_current(self, source, stat, profile, output_dir):
+        """Return whether source is re-encoded as it is now."""
+        entry = self._entries.get(source)
+        return (entry is not None
+                and entry['mtime'] == stat.st_mtime_ns
+                and entry['size'] == stat.st_size
+                and entry['profile'] == profile
+                and os.path.isfile(os.path.join(output_dir, entry['output'])))
+
+    def compact(self):
+        """Rewrite the manifest with one line per file."""
+        temp = placement.staging_filename(self._filename)
+        with open(temp, 'w', encoding='utf-8') as f:
+            for source in sorted(self._entries):
+                f.write(json.dumps(self._entries[source],
+                                   sort_keys=True) + '\n')
+        os.rename(temp, self._filename)
+
+    def record(self, source, stat, profile, output):
+        entry = {
+            'source': source,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'profile': profile,
+            'output': output
+        }
+        self._entries[source] = entry
+        if self._file is None:
+            self._file = open(self._filename, 'a', encoding='utf-8')
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Reencoder:
+    """Re-encodes the files under archive into output.
+
+    Files ending in source_extension are decoded, encoded and given
+    extension instead. jobs files are worked on at once.
+    """
+    def __init__(self, deps, config, archive, output, *, extension,
+            source_extension='flac', jobs=None, force=False):
+        self._deps = deps
+        self._config = config
+        self._archive = archive
+        self._output = output
+        self._extension = extension.lstrip('.')
+        self._source_extension = source_extension.lstrip('.')
+        self._jobs = max(1, jobs or os.cpu_count() or 1)
+        self._force = force
+        self._profile = encoder_hash(config, self._extension)
+        self._manifest = None
+        self._resources = None
+        self.encoded = []
+        self.skipped = []
+        self.failed = []
+
+    def _target(self, source):
+        stem = os.path.splitext(source)[0]
+        return '{}.{}'.format(stem, self._extension)
+
+    async def _reencode(self, source, wav):
+        source_file = os.path.join(self._archive, source)
+        stat = os.stat(source_file)
+        target = self._target(source)
+        if not self._force and self._manifest.is_current(
+                source, stat, self._profile, self._output):
+            self.skipped.append(source)
+            return
+
+        loop = asyncio.get_event_loop()
+        decoder = self._config.get('decoder')
+        decoder_name = list(decoder.keys())[0]
+        await run_process(
+            self._deps.decoder,
+            expand_args(decoder[decoder_name], source_file, out_file=wav),
+            'Decoding {}'.format(source))
+
+        extra = None
+        if self._config.get('analyse_audio'):
+            result = await loop.run_in_executor(None, functools.partial(
+                analysis.analyse_wav, wav,
+                threshold=self._config.get('silence_threshold')))
+            extra = {'audio_start': str(result['audio_start']),
+                     'audio_end': str(result['audio_end'])}
+
+        target_file = os.path.join(self._output, target)
+        staged = placement.staging_filename(target_file)
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+        try:
+            encoder = encoders.from_config(self._config, self._deps)
+            if encoder.in_process:
+                await encoder.encode(wav, staged, extra=extra)
+            else:
+                # Files are re-encoded one by one, so an encoder that
+                # takes many gets just the one
+                await run_process(
+                    encoder.executable,
+                    expand_args(encoder.args, wav, out_file=staged,
+                                all_files=[wav], extra=extra),
+                    'Encoding {}'.format(source))
+                if command.parse(encoder.args).takes_all_files:
+                    shutil.move(encoders.batch_output(wav, staged), staged)
+            os.remove(wav)
+
+            async def run(task):
+                await self._post_encode(task, source, staged)
+            await graph.run(
+                graph.parse(self._config.get('post_encode'), 'post_encode'),
+                run)
+
+            await loop.run_in_executor(None, functools.partial(
+                self._tag_and_publish, source_file, staged, target_file))
+        except BaseException:
+            if os.path.exists(staged):
+                os.remove(staged)
+            raise
+
+        self._manifest.record(source, stat, self._profile, target)
+        self.encoded.append(source)
+        print('Re-encoded {}'.format(target))
+
+    async def _post_encode(self, task, source, staged):
+        """Run a post_encode task from the task graph on staged."""
+        holder = self._resources.get(task.resource)
+        if holder is not None:
+            await holder.acquire()
+        try:
+            action = task.action
+            if plugin.is_plugin(action):
+                spec = action[plugin.TASK_KEY]
+                await plugin.run(
+                    self._deps.plugin(spec), spec, stage='post_encode',
+                    albumdata=None, track=None, one_file=staged,
+                    all_files=None)
+                return
+            task_name = list(action.keys())[0]
+            await run_process(
+                task_name, expand_args(
+                    action[task_name], staged, all_files=[staged]),
+                'post_encode task {} for {}'.format(task_name, source))
+        finally:
+            if holder is not None:
+                holder.release()
+
+    def _tag_and_publish(self, source_file, staged, target_file):
+        tag_file(staged, read_tags(source_file))
+        publish.publish_file(
+            staged, target_file,
+            fsync=bool(self._config.get('fsync_published')))
+
+    async def _worker(self, sources, wav):
+        # The generator is shared by the workers; each takes the next
+        # file when it's done with the last
+        for source in sources:
+            try:
+                await self._reencode(source, wav)
+            except (CdparacordError, OSError, mutagen.MutagenError) as e:
+                print('Could not re-encode {}: {}'.format(source, e),
+                      file=sys.stderr)
+                self.failed.append(source)
+
+    def run(self):
+        """Re-encode everything that isn't up to date."""
+        os.makedirs(self._output, exist_ok=True)
+        self._manifest = Manifest(
+            os.path.join(self._output, MANIFEST_NAME))
+        # Drop the duplicates (and any half-written line) the last run
+        # left behind
+        self._manifest.compact()
+
+        loop = asyncio.get_event_loop()
+        self._resources = graph.Resources(self._config.get('task_resources'))
+        sources = find_sources(self._archive, self._source_extension)
+        try:
+            with tempfile.TemporaryDirectory(
+                    prefix='cdparacord-reencode-') as wavdir:
+                loop.run_until_complete(asyncio.gather(*[
+                    self._worker(sources, os.path.join(
+                        wavdir, '{}.wav'.format(n)))
+                    for n in range(self._jobs)]))
+        finally:
+            self._manifest.close()
+
+
+@click.command()
+@click.argument('archive', type=click.Path(exists=True, file_okay=False))
+@click.argument('output', type=click.Path(file_okay=False))
+@click.option('--jobs', '-j', type=int, default=None,
+    help="""How many files to re-encode at once (default: reencode_jobs
+    from the configuration).""")
+@click.option('--source-extension', default=None,
+    help="""Extension of the archived files (default: decoder_extension
+    from the configuration).""")
+@click.option('--extension', default=None,
+    help="""Extension of the re-encoded files (default: the extension of
+    target_template).""")
+@click.option('--force', is_flag=True, default=False,
+    help="""Re-encode files even if they are up to date.""")
+def main(archive, output, jobs, source_extension, extension, force):
+    """Re-encode an archive of lossless files with the configured encoder.
+
+    Every file under ARCHIVE is decoded with the configured decoder,
+    then encoded, post_encoded and tagged like a freshly ripped track
+    and put in the same place under OUTPUT. Files already re-encoded
+    with the same settings are skipped, so an interrupted run can just
+    be started again.
+    """
+    config = Config()
+    deps = Dependency(config, ripping=False)
+    if source_extension is None:
+        source_extension = config.get('decoder_extension')
+    if extension is None:
+        extension = os.path.splitext(config.get('target_template'))[1]
+    if not extension.lstrip('.'):
+        raise ReencodeError('Could not tell what extension to use; '
+                            'give one with --extension')
+
+    reencoder = Reencoder(
+        deps, config, archive, output, extension=extension,
+        source_extension=source_extension,
+        jobs=jobs or config.get('reencode_jobs'), force=force)
+    reencoder.run()
+
+    print('Re-encoded {}, {} up to date, {} failed'.format(
+        len(reencoder.encoded), len(reencoder.skipped),
+        len(reencoder.failed)))
+    if reencoder.failed:
+        raise ReencodeError('{} files could not be re-encoded'.format(
+            len(reencoder.failed)))
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
@@ -0,0 +1,330 @@
+"""Moving ripped files to where the configuration now says they go.
+
+Changing target_template or safetyfilter only affects new rips. This
+works out the names of ripped files again from their albumdata, moves
+them there and updates the albumdata, and the library index if there is
+one, to match.
+
+Moves within a filesystem are renames and done right away; the rest
+are copied and removed in a thread pool. Every move is written in a
+journal as it's done, so an interrupted relocation can be resumed or
+rolled back.
+"""
+import click
+import collections
+import concurrent.futures
+import errno
+import json
+import os
+import os.path
+import string
+import sys
+import yaml
+from . import library
+from . import placement
+from .albumdata import Albumdata
+from .config import Config
+from .error import CdparacordError
+from .xdg import XDG_CACHE_HOME, XDG_MUSIC_DIR
+
+
+class RelocateError(CdparacordError):
+    pass
+
+
+DEFAULT_JOURNAL = os.path.join(
+    XDG_CACHE_HOME, 'cdparacord', 'relocate-journal.jsonl')
+
+# A move of one track: the albumdata file it's in, which track and from
+# where to where
+Move = collections.namedtuple('Move', 'albumdata track src dst')
+
+
+def _albumdata_file(filename):
+    if os.path.isdir(filename):
+        return os.path.join(filename, 'albumdata.yaml')
+    return filename
+
+
+def _load_yaml(filename):
+    try:
+        with open(filename, 'r') as f:
+            data = yaml.safe_load(f)
+    except OSError as e:
+        raise RelocateError('Could not read {}: {}'.format(filename, e))
+    if type(data) is not dict or 'tracks' not in data:
+        raise RelocateError('{} is not albumdata'.format(filename))
+    return data
+
+
+def plan(albumdata_files, config):
+    """Return the moves that put the tracks where they now belong.
+
+    Raises RelocateError if a file would be moved on top of another.
+    """
+    moves = []
+    for filename in albumdata_files:
+        filename = os.path.abspath(_albumdata_file(filename))
+        data = _load_yaml(filename)
+        for n, track in enumerate(data['tracks'], 1):
+            dst = Albumdata._generate_filename(data, track, n, config)
+            if dst != track['filename']:
+                moves.append(Move(filename, n - 1, track['filename'], dst))
+
+    # This includes names that are to be moved away, since the order
+    # of the moves would matter then
+    conflicts = []
+    seen = set()
+    for move in moves:
+        if move.dst in seen or os.path.exists(move.dst):
+            conflicts.append(move.dst)
+        seen.add(move.dst)
+    if conflicts:
+        raise RelocateError('Files would be overwritten:\n{}'.format(
+            '\n'.join(conflicts)))
+    return moves
+
+
+def update_albumdata(moves, *, undo=False):
+    """Write the new (or with undo, the old) names into the albumdata."""
+    by_file = collections.defaultdict(list)
+    for move in moves:
+        by_file[move.albumdata].append(move)
+    for filename, file_moves in by_file.items():
+        data = _load_yaml(filename)
+        for move in file_moves:
+            data['tracks'][move.track]['filename'] = (
+                move.src if undo else move.dst)
+        temp = placement.staging_filename(filename)
+        with open(temp, 'w') as f:
+            yaml.safe_dump(data, f)
+        os.rename(temp, filename)
+
+
+def update_index(filename, moves, *, undo=False):
+    """Write the new (or with undo, the old) paths into the index."""
+    index = library.Library(filename)
+    try:
+        index.rename_files(
+            (move.dst, move.src) if undo else (move.src, move.dst)
+            for move in moves)
+    finally:
+        index.close()
+
+
+class Journal:
+    """The moves of a relocation and which of them are done.
+
+    The plan is written first, then a line for each finished move, so
+    after an interruption we know what was planned and what happened.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        """Return the planned moves and the set of the journaled ones."""
+        moves = []
+        done = set()
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Cut short by the interruption
+                    continue
+                if entry['op'] == 'plan':
+                    moves.append(Move(*entry['move']))
+                elif entry['op'] == 'done':
+                    done.add(Move(*entry['move']))
+        return moves, done
+
+    def start(self, moves):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self._file = open(self.filename, 'w', encoding='utf-8')
+        for move in moves:
+            self._write('plan', move)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def reopen(self):
+        self._file = open(self.filename, 'a', encoding='utf-8')
+        # Don't glue our first line to a half-written one
+        self._file.write('\n')
+
+    def _write(self, op, move):
+        self._file.write(json.dumps({'op': op, 'move': list(move)}) + '\n')
+
+    def done(self, move):
+        self._write('done', move)
+        self._file.flush()
+
+    def remove(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.remove(self.filename)
+
+
+def remaining(moves, *, rollback=False):
+    """Return what's left to do of an interrupted relocation.
+
+    This goes by what's on disk rather than the journal, since a move
+    may have happened just before the interruption without making it
+    into the journal. Nothing is ever moved on top of another file, so
+    a source that still exists hasn't been moved and a destination that
+    exists has been moved to. With rollback, the moves that undo the
+    ones done are returned.
+    """
+    if rollback:
+        return [move._replace(src=move.dst, dst=move.src)
+                for move in moves if os.path.exists(move.dst)]
+    return [move for move in moves if os.path.exists(move.src)]
+
+
+def library_root(config):
+    """Return the directory target_template puts everything under.
+
+    That's the part of it before the first directory named from tags.
+    """
+    template = string.Template(config.get('target_template'))
+    path = template.safe_substitute(xdgmusic=XDG_MUSIC_DIR)
+    parts = []
+    for part in os.path.dirname(path).split(os.sep):
+        if '$' in part:
+            break
+        parts.append(part)
+    return os.path.abspath(os.sep.join(parts) or os.curdir)
+
+
+def _remove_empty_dirs(filename, root):
+    """Remove the directories of filename left empty, up to root.
+
+    root itself and anything outside it are left alone.
+    """
+    prefix = root.rstrip(os.sep) + os.sep
+    directory = os.path.dirname(os.path.abspath(filename))
+    while directory.startswith(prefix):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # Not empty, which is where we stop
+            break
+        directory = os.path.dirname(directory)
+
+
+def move_files(moves, jobs, on_done, *, root):
+    """Do moves, calling on_done with each move once it's done.
+
+    Renames are done right away; moves across filesystems are copies,
+    which are done jobs at a time. Directories under root left empty
+    are removed. Returns the moves that failed along with the errors.
+    """
+    failed = []
+
+    def finish(move):
+        _remove_empty_dirs(move.src, root)
+        on_done(move)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        copies = {}
+        for move in moves:
+            try:
+                os.makedirs(os.path.dirname(move.dst), exist_ok=True)
+                os.rename(move.src, move.dst)
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    copies[executor.submit(
+                        placement.publish, move.src, move.dst)] = move
+                else:
+                    failed.append((move, e))
+                continue
+            finish(move)
+
+        for future in concurrent.futures.as_completed(copies):
+            move = copies[future]
+            try:
+                future.result()
+            except OSError as e:
+                failed.append((move, e))
+                continue
+            finish(move)
+    return failed
+
+
+@click.command()
+@click.argument('albumdata', nargs=-1, type=click.Path(exists=True))
+@click.option('--dry-run', '-n', is_flag=True, default=False,
+    help="""Only show what would be moved.""")
+@click.option('--resume', is_flag=True, default=False,
+    help="""Finish an interrupted relocation.""")
+@click.option('--rollback', is_flag=True, default=False,
+    help="""Undo an interrupted relocation.""")
+@click.option('--jobs', '-j', type=int, default=4, show_default=True,
+    help="""How many files to copy at once across filesystems.""")
+@click.option('--journal', type=click.Path(dir_okay=False),
+    default=DEFAULT_JOURNAL, help="""Where to keep the journal.""")
+def main(albumdata, dry_run, resume, rollback, jobs, journal):
+    """Move ripped files to where they'd go if ripped now.
+
+    ALBUMDATA are albumdata.yaml files, or ripdirs with one in them.
+    The names of their tracks are made again from the current
+    target_template and safetyfilter, the files moved and the albumdata
+    and library index updated with the new names.
+    """
+    config = Config()
+    journal = Journal(journal)
+    if resume and rollback:
+        raise RelocateError('Give only one of --resume and --rollback')
+    if (resume or rollback) != journal.exists():
+        if journal.exists():
+            raise RelocateError(
+                'An interrupted relocation was found in {}; finish it '
+                'with --resume or undo it with --rollback'.format(
+                    journal.filename))
+        raise RelocateError('There is no relocation to resume or roll back')
+
+    if resume or rollback:
+        moves, done = journal.load()
+        print('{} of {} moves were done before the interruption'.format(
+            len(done), len(moves)))
+        todo = remaining(moves, rollback=rollback)
+        journal.reopen()
+    else:
+        if not albumdata:
+            raise RelocateError('No albumdata given')
+        moves = plan(albumdata, config)
+        for move in moves:
+            print('{} -> {}'.format(move.src, move.dst))
+        if dry_run or not moves:
+            print('{} files to move'.format(len(moves)))
+            return
+        todo = moves
+        journal.start(moves)
+
+    failed = move_files(todo, jobs, journal.done,
+                        root=library_root(config))
+    for move, error in failed:
+        print('Could not move {}: {}'.format(move.src, error),
+              file=sys.stderr)
+    if failed:
+        raise RelocateError(
+            '{} files could not be moved; fix the problem and run again '
+            'with --resume or --rollback'.format(len(failed)))
+
+    # Both of these can be done again on --resume, so the journal goes
+    # only once they're done
+    update_albumdata(moves, undo=rollback)
+    index = library.index_filename(config)
+    if index is not None and os.path.exists(index):
+        update_index(index, moves, undo=rollback)
+    journal.remove()
+    print('{} {} files'.format(
+        'Moved back' if rollback else 'Moved', len(todo)))
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
@@ -0,0 +1,126 @@
+"""Retagging ripped files from their albumdata.
+
+When albumdata is corrected after the fact, the published files can be
+retagged from it without ripping them again. Only the tags that differ
+are written, and mutagen writes them in place when they fit in the
+padding the tags already have, so the audio isn't rewritten.
+"""
+import click
+import concurrent.futures
+import mutagen
+import os
+import os.path
+import sys
+import yaml
+from .albumdata import Albumdata
+from .config import Config
+from .error import CdparacordError
+from .rip import open_tags, track_tags
+
+
+class RetagError(CdparacordError):
+    pass
+
+
+def load_albumdata(filename):
+    """Load albumdata from an albumdata.yaml or a ripdir with one."""
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, 'albumdata.yaml')
+    try:
+        with open(filename, 'r') as f:
+            data = yaml.safe_load(f)
+    except OSError as e:
+        raise RetagError('Could not read {}: {}'.format(filename, e))
+    if type(data) is not dict or 'tracks' not in data:
+        raise RetagError('{} is not albumdata'.format(filename))
+    return Albumdata(data)
+
+
+def tag_changes(current, wanted):
+    """Return the tags in wanted that differ from current.
+
+    current is a file's tags as mutagen's easy interface has them, a
+    value list for each tag.
+    """
+    return {key: value for key, value in wanted.items()
+            if list(current.get(key, [])) != [value]}
+
+
+def retag_file(filename, tags, *, dry_run=False):
+    """Change the tags of a file that differ from tags.
+
+    Returns the changed tags.
+    """
+    audiofile = open_tags(filename)
+    changes = tag_changes(audiofile, tags)
+    if changes and not dry_run:
+        for key, value in changes.items():
+            audiofile[key] = value
+        audiofile.save()
+    return changes
+
+
+def plan(albumdatas, config):
+    """Return (filename, tags) for every track of albumdatas."""
+    return [(track.filename, track_tags(albumdata, track, config))
+            for albumdata in albumdatas
+            for track in albumdata.tracks]
+
+
+def retag(files, jobs, *, dry_run=False):
+    """Retag files, given as (filename, tags), jobs at a time.
+
+    Yields (filename, changes, error) for each file as it's done; error
+    is None unless the file couldn't be retagged.
+    """
+    def work(item):
+        filename, tags = item
+        try:
+            return filename, retag_file(filename, tags, dry_run=dry_run), None
+        except (OSError, mutagen.MutagenError, CdparacordError) as e:
+            return filename, {}, e
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        yield from executor.map(work, files)
+
+
+@click.command()
+@click.argument('albumdata', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.option('--jobs', '-j', type=int, default=None,
+    help="""How many files to retag at once (default: one per CPU).""")
+@click.option('--dry-run', '-n', is_flag=True, default=False,
+    help="""Only show what would be changed.""")
+def main(albumdata, jobs, dry_run):
+    """Retag ripped files from their albumdata.
+
+    ALBUMDATA are albumdata.yaml files, or ripdirs with one in them. The
+    files they name are given the tags a rip would give them now; only
+    tags that have changed are written.
+    """
+    config = Config()
+    files = plan([load_albumdata(a) for a in albumdata], config)
+
+    changed = 0
+    failed = 0
+    for filename, changes, error in retag(
+            files, jobs or os.cpu_count() or 1, dry_run=dry_run):
+        if error is not None:
+            print('Could not retag {}: {}'.format(filename, error),
+                  file=sys.stderr)
+            failed += 1
+        elif changes:
+            print('{} {}: {}'.format(
+                'Would retag' if dry_run else 'Retagged', filename,
+                ', '.join('{}={}'.format(key, changes[key])
+                          for key in sorted(changes))))
+            changed += 1
+
+    print('{} of {} files {}, {} failed'.format(
+        changed, len(files), 'to retag' if dry_run else 'retagged', failed))
+    if failed:
+        raise RetagError('{} files could not be retagged'.format(failed))
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
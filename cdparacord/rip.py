@@ -1,10 +1,30 @@
 import asyncio
+import errno
+import functools
 import mutagen
 import mutagen.easyid3
 import os
 import os.path
 import shutil
-import string
+import sqlite3
+import sys
+import time
+from . import accounting
+from . import analysis
+from . import batch
+from . import command
+from . import encoders
+from . import fingerprint
+from . import graph
+from . import image
+from . import library
+from . import metrics
+from . import placement
+from . import plugin
+from . import publish
+from . import storage
+from . import trace
+from . import verify
 from .error import CdparacordError
 
 
@@ -12,6 +32,136 @@ class RipError(CdparacordError):
     pass
 
 
+def expand_args(task_args, one_file, *,
+        all_files=None, out_file=None, extra=None):
+    """Expand placeholders in task arguments.
+
+    If all_files is not None, the all_files placeholder will be
+    substituted. Otherwise it won't. Same for out_file. Anything in
+    extra is substituted as is. The arguments are only parsed the first
+    time they're seen; see command.py.
+    """
+    return command.parse(task_args).expand(
+        one_file, all_files=all_files, out_file=out_file, extra=extra)
+
+
+def open_tags(filename):
+    """Open the tags of a file with mutagen's easy interface.
+
+    The file is given empty tags if it has none. Raises RipError if
+    mutagen doesn't know what kind of file it is.
+    """
+    try:
+        audiofile = mutagen.File(filename, easy=True)
+    except mutagen.MutagenError:
+        # An ID3 header with no audio mutagen can make sense of behind
+        # it can still be tagged
+        try:
+            return mutagen.easyid3.EasyID3(filename)
+        except mutagen.MutagenError as e:
+            raise RipError('Can not tag {}: {}'.format(filename, e)) from e
+    if audiofile is None:
+        raise RipError('Can not tag {}: unknown file format'.format(
+            filename))
+    if audiofile.tags is None:
+        audiofile.add_tags()
+    return audiofile
+
+
+def tag_file(filename, tags):
+    """Write tags (a dict of easy tag names to strings) to a file."""
+    audiofile = open_tags(filename)
+    for key, value in tags.items():
+        audiofile[key] = value
+    audiofile.save()
+
+
+def track_tags(albumdata, track, config):
+    """Return the tags a track of albumdata is given, as a dict."""
+    # This is information we always save and presumably always have
+    tags = {
+        'artist': track.artist,
+        'album': albumdata.title,
+        'title': track.title,
+        'tracknumber': str(track.tracknumber),
+        'date': albumdata.date
+    }
+    # We only tag albumartist on multi-artist albums, or if we're set to
+    # always tag albumartist.
+    if albumdata.multiartist or config.get('always_tag_albumartist'):
+        tags['albumartist'] = albumdata.albumartist
+    return tags
+
+
+def reuse_file(src, dst, how):
+    """Put the file src at dst with a hardlink or a copy.
+
+    A hardlink falls back to a copy across filesystems. Returns which
+    of them it was.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    if how == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    placement.fast_copy(src, dst)
+    return 'copy'
+
+
+# What a track with no TOC entry is taken to be for the budget: ten
+# minutes, longer than most tracks
+_FALLBACK_TRACK_SECTORS = 10 * 60 * 75
+
+
+class SpaceBudget:
+    """A byte budget for the files of a rip.
+
+    Reserving waits until enough of the budget is free. A reservation
+    bigger than the whole budget is let through once nothing else is
+    reserved, so one huge track can't stall the rip forever. A limit of
+    0 means no limit.
+    """
+    def __init__(self, limit):
+        self._limit = limit
+        self._used = 0
+        self._changed = asyncio.Condition()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def used(self):
+        return self._used
+
+    def _fits(self, size):
+        return (not self._limit or self._used == 0
+                or self._used + size <= self._limit)
+
+    def add(self, size):
+        """Account for bytes already on disk before anyone waits."""
+        self._used += size
+
+    async def reserve(self, size):
+        """Wait until size bytes fit in the budget and take them."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._fits(size))
+            self._used += size
+
+    async def adjust(self, delta):
+        """Give back (negative delta) or take more of the budget.
+
+        This never waits: the bytes are on disk already.
+        """
+        async with self._changed:
+            self._used += delta
+            self._changed.notify_all()
+
+
 class Rip:
     def __init__(self, albumdata, deps, config, begin_track, end_track,
             continue_rip):
@@ -31,185 +181,645 @@ class Rip:
         # Here's where the temporary -> permanent filenames are recorded
         # so we can move them to the target dir
         self._tagged_files = {}
+        # Frame offset of each ripped wav from the start of its track.
+        # Nonzero only when the rip span was trimmed.
+        self._rip_starts = {}
+        # Budget for the wav files, configured when the pipeline starts
+        self._budget = SpaceBudget(0)
+        # Sizes of the wav files that count towards the budget
+        self._wav_sizes = {}
+        # Batches of the tasks that take many files at once, and how
+        # many tracks there are to batch when the pipeline knows
+        self._batches = {}
+        self._batch_expected = None
+        # The limits of the resource classes of post tasks, set up with
+        # the pipeline
+        self._resources = None
+        # Publishes files into the library, set up with the pipeline
+        self._publisher = None
+        # Sizes of the published files, for the library index
+        self._published_sizes = {}
+        # The library index and the fingerprints of the tracks, when
+        # fingerprinting
+        self._library = None
+        self._fingerprints = None
+        # Times the stages, if configured when the pipeline starts
+        self._tracer = trace.NullTracer()
+        # Resource usage of the processes, if it's to be reported
+        self._accounting = None
+        # Whether to feed the metrics, configured with the pipeline
+        self._metrics = False
+        # Disc image to read instead of the drive, opened with the
+        # pipeline
+        self._image = None
+
+    def _wav_filename(self, tracknumber):
+        """Return where the ripped wav for a track goes."""
+        return os.path.join(
+            self._albumdata.wavdir,
+            '{tracknumber}.wav'.format(tracknumber=tracknumber))
+
+    def _wav_size_estimate(self, track):
+        """Estimate the size of a track's wav from the TOC.
+
+        Without the TOC every track is taken to be a long one, so the
+        budget still holds if some tracks really are. The estimate is
+        corrected once the track has been ripped.
+        """
+        toc = self._albumdata.dict.get('toc')
+        if not toc or track.tracknumber > len(toc):
+            sectors = _FALLBACK_TRACK_SECTORS
+        else:
+            sectors = toc[track.tracknumber - 1][1]
+        # 44 bytes of wav header
+        return sectors * placement.SECTOR_BYTES + 44
+
+    async def _remove_wav(self, track, temp_filename):
+        """Remove the wav of a finished track to free up the budget.
+
+        Without a budget the wavs stay with the rest of the ripdir until
+        the rip is done, so a rip that's continued still has them.
+        """
+        if self._config.get('keep_ripdir') or not self._budget.limit:
+            return
+        try:
+            os.remove(temp_filename)
+        except FileNotFoundError:
+            pass
+        size = self._wav_sizes.pop(track.tracknumber, 0)
+        if size:
+            await self._budget.adjust(-size)
+        self._update_metrics()
+
+    def _encoded_filename(self, track):
+        """Return where the encoded file for a track goes.
+
+        With stage_encoded this is next to its final location, so it
+        can be renamed into place. That only makes sense if the final
+        location is local.
+        """
+        if (self._config.get('stage_encoded')
+                and (self._config.get('storage') or {}).get(
+                    'backend', 'local') == 'local'):
+            return placement.staging_filename(track.filename)
+        return os.path.join(
+            self._albumdata.ripdir,
+            '{tracknumber}{ext}'.format(
+                tracknumber=track.tracknumber,
+                ext=os.path.splitext(track.filename)[1]))
 
-    def _arg_expand(self, task_args, one_file, *,
-            all_files=None, out_file=None):
-        """Expand placeholders in task arguments.
+    async def _run_process(self, stage, track, executable, args, *,
+            name=None):
+        """Run a process as part of a stage and return its exit status.
 
-        If all_files is not None, the all_files placeholder will be
-        substituted. Otherwise it won't. Same for out_file.
+        track is the track number the process works on, or None if it
+        works on the whole disc. name is what the process is called in
+        the trace; by default, the executable.
         """
-        final_args = []
-        placeholder = '<ALLFILES_PLACEHOLDER>'
-        for arg in task_args:
-            template = string.Template(arg)
-            subs = {'one_file': one_file}
-            if all_files is not None:
-                subs['all_files'] = placeholder
-            if out_file is not None:
-                subs['out_file'] = out_file
-
-            # If all_files is used just dump files into args
-            # It's not an "actual" template thing. Because reasons.
-            res = template.substitute(subs)
-            if res == placeholder:
-                final_args.extend(all_files)
+        with self._tracer.span(
+                stage, track=track, command=name or executable) as span:
+            if self._accounting is None:
+                proc = await asyncio.create_subprocess_exec(
+                    executable, *args)
+                status = await proc.wait()
             else:
-                final_args.append(res)
-        return final_args
+                status = await self._accounting.run(
+                    stage, name or os.path.basename(executable),
+                    [executable] + list(args))
+            span.status = status
+        return status
+
+    async def _read_disc(self, track, span, sectors, filename):
+        """Read part of the disc into a wav file.
+
+        span is what cdparanoia is told to read and sectors the same
+        part as (first, count) counted from the start of the disc, which
+        is what's read when ripping from an image. Returns the exit
+        status of the read.
+        """
+        if self._image is None:
+            return await self._run_process(
+                'rip', track, self._deps.cdparanoia,
+                ['--', span, filename], name='cdparanoia')
+
+        # Copying out of the image is just I/O, so it goes in a thread
+        loop = asyncio.get_event_loop()
+        with self._tracer.span('rip', track=track, command='image') as s:
+            await loop.run_in_executor(None, functools.partial(
+                self._image.extract, *sectors, filename))
+            s.status = 0
+        return 0
+
+    def _update_metrics(self):
+        """Update the disc usage metric and the textfile, if any."""
+        if not self._metrics:
+            return
+        metrics.RIPDIR_BYTES.set(metrics.directory_size(
+            self._albumdata.ripdir, self._albumdata.wavdir))
+        textfile = self._config.get('metrics_textfile')
+        if textfile:
+            metrics.write_textfile(os.path.expanduser(textfile))
+
+    def _arg_expand(self, task_args, one_file, *,
+            all_files=None, out_file=None, extra=None):
+        return expand_args(task_args, one_file, all_files=all_files,
+                           out_file=out_file, extra=extra)
+
+    async def _run_task(self, stage, task, track, one_file, *,
+            all_files=None, resource=None):
+        """Run a post task on one_file, or all_files in post_finished.
+
+        track is the Track the file belongs to, if any. resource is the
+        class of resource the task needs, if it's limited. Raises
+        RipError if the task fails.
+        """
+        task_name = list(task.keys())[0]
+        if (not plugin.is_plugin(task) and all_files is None
+                and command.parse(task[task_name]).takes_all_files):
+            # A task that takes many files is run for batches of them
+            async def run(files):
+                await self._run_task(
+                    stage, task, None, None, all_files=files,
+                    resource=resource)
+            await self._batch(
+                (stage, task_name, tuple(task[task_name])), run).submit(
+                    one_file)
+            return
+
+        holder = None
+        if self._resources is not None:
+            holder = self._resources.get(resource)
+        if holder is not None:
+            await holder.acquire()
+        try:
+            await self._run_action(stage, task, track, one_file, all_files)
+        finally:
+            if holder is not None:
+                holder.release()
+
+    async def _run_action(self, stage, task, track, one_file, all_files):
+        """Run the command or Python function of a post task."""
+        task_name = list(task.keys())[0]
+        tracknumber = None if track is None else track.tracknumber
+        if plugin.is_plugin(task):
+            spec = task[plugin.TASK_KEY]
+            with self._tracer.span(
+                    stage, track=tracknumber, command=spec) as span:
+                try:
+                    await plugin.run(
+                        self._deps.plugin(spec), spec, stage=stage,
+                        albumdata=self._albumdata, track=track,
+                        one_file=one_file, all_files=all_files)
+                except plugin.PluginError as e:
+                    raise RipError('{} task {} failed: {}'.format(
+                        stage, spec, e.__cause__)) from e
+                span.status = 0
+            return
+
+        task_args = self._arg_expand(
+            task[task_name], one_file or '/dev/null', all_files=all_files)
+        if await self._run_process(
+                stage, tracknumber, task_name, task_args) != 0:
+            raise RipError('{} task {} failed'.format(stage, task_name))
+
+    def _graph(self, stage):
+        """Return the task graph of a stage."""
+        try:
+            return graph.parse(self._config.get(stage), stage)
+        except graph.TaskGraphError as e:
+            raise RipError(str(e)) from e
+
+    async def _run_stage(self, stage, track, one_file):
+        """Run the post tasks of a stage on the file of a track."""
+        async def run(task):
+            await self._run_task(stage, task.action, track, one_file,
+                                 resource=task.resource)
+        await graph.run(self._graph(stage), run)
+
+    def _batch(self, key, run):
+        """Return the batch for key, made to run with run if it's new."""
+        if key not in self._batches:
+            self._batches[key] = batch.Batch(
+                run, size=self._config.get('batch_size') or 1,
+                timeout=self._config.get('batch_timeout') or 0,
+                expected=self._batch_expected)
+        return self._batches[key]
 
     async def _tag_track(self, track, temp_encoded):
         """Tag track and plop it in the dict."""
-        try:
-            audiofile = mutagen.easyid3.EasyID3(temp_encoded)
-        except mutagen.MutagenError:
-            audiofile = mutagen.File(temp_encoded, easy=True)
-            audiofile.add_tags()
-
-        # We only tag albumartist on multi-artist albums, or if we're
-        # set to always tag albumartist.
-        if (self._albumdata.multiartist
-                or self._config.get('always_tag_albumartist')):
-            audiofile['albumartist'] = self._albumdata.albumartist
-
-        # This is information we always save and presumably always have
-        audiofile['artist'] = track.artist
-        audiofile['album'] = self._albumdata.title
-        audiofile['title'] = track.title
-        audiofile['tracknumber'] = str(track.tracknumber)
-        audiofile['date'] = self._albumdata.date
-
-        audiofile.save()
+        tag_file(temp_encoded,
+                 track_tags(self._albumdata, track, self._config))
 
         print("Tagged {}".format(track.filename))
 
         self._tagged_files[temp_encoded] = track.filename
 
-    async def _encode_track(self, track, temp_filename):
-        """Encode track and kick off tag and post_encode."""
-        temp_encoded = os.path.join(
-            self._albumdata.ripdir,
-            '{tracknumber}{ext}'.format(
-                tracknumber=track.tracknumber,
-                ext=os.path.splitext(track.filename)[1]))
-        encoder = self._config.get('encoder')
-        encoder_name = list(encoder.keys())[0]
-        encoder_args = self._arg_expand(
-            encoder[encoder_name], temp_filename, out_file=temp_encoded)
+    async def _analyse_track(self, track, temp_filename):
+        """Analyse ripped track for silence and record the result.
 
-        proc = await asyncio.create_subprocess_exec(
-            self._deps.encoder,
-            *encoder_args)
+        Offsets are recorded relative to the start of the track even if
+        the rip span was trimmed, so they stay valid between rips.
+        """
+        rip_start = self._rip_starts.get(track.tracknumber)
+        if rip_start is None:
+            # Continued rip: trust whatever the previous one recorded
+            rip_start = (track.analysis or {}).get('rip_start', 0)
 
-        if await proc.wait() != 0:
-            raise RipError('Failed to encode track {}'.format(track.filename))
+        loop = asyncio.get_event_loop()
+        with self._tracer.span('analyse', track=track.tracknumber):
+            result = await loop.run_in_executor(None, functools.partial(
+                analysis.analyse_wav, temp_filename,
+                threshold=self._config.get('silence_threshold')))
+
+        if rip_start:
+            # Trimmed rips only happen when we have a previous analysis
+            # so we know how long the whole track is
+            result['frames'] = track.analysis['frames']
+            if result['audio_end'] > 0:
+                result['audio_start'] += rip_start
+                result['audio_end'] += rip_start
+            result['rip_start'] = rip_start
+
+        track.record_analysis(result)
+        leading = result['audio_start']
+        trailing = result['frames'] - result['audio_end']
+        if result['audio_end'] == 0:
+            print('Track {} is silent'.format(track.tracknumber))
+        elif leading or trailing:
+            print('Track {} has {:.2f}s leading and {:.2f}s trailing '
+                  'silence'.format(
+                      track.tracknumber,
+                      leading / analysis.SAMPLE_RATE,
+                      trailing / analysis.SAMPLE_RATE))
+
+    async def _run_encoder(self, track, temp_filename, temp_encoded, extra):
+        """Encode a ripped track and run post_encode on it."""
+        encoder = encoders.from_config(self._config, self._deps)
+
+        start = time.perf_counter()
+        if encoder.in_process:
+            with self._tracer.span('encode', track=track.tracknumber,
+                                   command=encoder.name) as span:
+                try:
+                    await encoder.encode(
+                        temp_filename, temp_encoded, extra=extra)
+                except encoders.EncoderError as e:
+                    raise RipError('Failed to encode track {}: {}'.format(
+                        track.filename, e)) from e
+                span.status = 0
+        elif command.parse(encoder.args).takes_all_files:
+            async def run(files):
+                if await self._run_process(
+                        'encode', None, encoder.executable,
+                        self._arg_expand(
+                            encoder.args, '/dev/null', all_files=files),
+                        name=encoder.name) != 0:
+                    raise RipError('Failed to encode tracks {}'.format(
+                        ', '.join(files)))
+            await self._batch('encode', run).submit(temp_filename)
+            # The encoder wrote the file next to the wav
+            written = encoders.batch_output(temp_filename, temp_encoded)
+            if written != temp_encoded:
+                shutil.move(written, temp_encoded)
+        else:
+            encoder_args = self._arg_expand(
+                encoder.args, temp_filename, out_file=temp_encoded,
+                extra=extra)
+            if await self._run_process(
+                    'encode', track.tracknumber, encoder.executable,
+                    encoder_args, name=encoder.name) != 0:
+                raise RipError('Failed to encode track {}'.format(
+                    track.filename))
+        if self._metrics:
+            # 16-bit stereo: four bytes per sample, give or take the
+            # header
+            audio = os.path.getsize(temp_filename) / (
+                analysis.FRAME_BYTES * analysis.SAMPLE_RATE)
+            metrics.ENCODED_AUDIO_SECONDS.inc(audio)
+            metrics.ENCODE_SPEED.set(
+                audio / max(time.perf_counter() - start, 1e-6))
+            metrics.TRACKS.inc(stage='encode')
 
         # Run post_encode
-        for task in self._config.get('post_encode'):
-            # Parsing the ansible-y format
-            task_name = list(task.keys())[0]
-            task_args = self._arg_expand(task[task_name], temp_encoded)
-            # Create actual task after preprocessing args
-            proc = await asyncio.create_subprocess_exec(
-                task_name,
-                *task_args)
-
-            if await proc.wait() != 0:
-                raise RipError('post_encode task {} failed'.format(
-                    task_name))
+        await self._run_stage('post_encode', track, temp_encoded)
 
-        # Always run after the previous due to awaits
-        await self._tag_track(track, temp_encoded)
+    async def _fingerprint_track(self, track, temp_filename, temp_encoded):
+        """Fingerprint a ripped track and look for it in earlier rips.
+
+        If the same recording was encoded before with the same settings
+        and fingerprint_reuse is set, that file is reused as
+        temp_encoded. Returns how (copy or hardlink), or None if the
+        track still needs to be encoded.
+        """
+        loop = asyncio.get_event_loop()
+        with self._tracer.span('fingerprint', track=track.tracknumber):
+            duration, result = await loop.run_in_executor(
+                None, fingerprint.fingerprint_wav, temp_filename)
+            self._fingerprints[track.tracknumber] = (duration, result)
+            candidates = [
+                (row, fingerprint.from_bytes(row['fingerprint']))
+                for row in self._library.fingerprints_near(
+                    duration, fingerprint.MAX_SHIFT)
+                # A disc ripped again would find itself
+                if row['path'] != track.filename]
+            match = await loop.run_in_executor(
+                None, fingerprint.best_match, result, candidates,
+                self._config.get('fingerprint_threshold'))
+        if match is None:
+            return None
+
+        row, score = match
+        print('Track {} sounds like {} ({:.0%} alike)'.format(
+            track.tracknumber, row['path'], score))
+        if (not self._config.get('fingerprint_reuse')
+                or row['encoder_hash'] != self._encoder_hash()
+                or not os.path.isfile(row['path'])):
+            return None
+        reused = await loop.run_in_executor(
+            None, reuse_file, row['path'], temp_encoded,
+            self._config.get('fingerprint_reuse'))
+        print('Reused {} for track {}'.format(row['path'], track.tracknumber))
+        return reused
+
+    async def _verify_track(self, track, temp_encoded, ripped_hash):
+        """Check that the encoded track decodes back to the ripped audio.
+
+        ripped_hash is the future hash of the ripped wav. Raises
+        RipError if the audio differs or can't be decoded.
+        """
+        decoder = self._config.get('verify_decoder')
+        decoder_name = list(decoder.keys())[0]
+        decoder_args = self._arg_expand(
+            decoder[decoder_name], temp_encoded)
+        with self._tracer.span('verify', track=track.tracknumber,
+                               command=decoder_name) as span:
+            try:
+                decoded = await verify.hash_decoded(
+                    self._deps.verify_decoder, decoder_args)
+            except verify.VerifyError as e:
+                raise RipError('Could not verify track {}: {}'.format(
+                    track.filename, e)) from e
+            ripped = await ripped_hash
+            span.status = 0 if decoded == ripped else 1
+        if decoded != ripped:
+            raise RipError(
+                'Track {} does not decode back to the ripped audio'.format(
+                    track.filename))
+        print('Verified {}'.format(track.filename))
+        if self._metrics:
+            metrics.TRACKS.inc(stage='verify')
+
+    async def _encode_track(self, track, temp_filename):
+        """Encode track and kick off tag and post_encode."""
+        temp_encoded = self._encoded_filename(track)
+        os.makedirs(os.path.dirname(temp_encoded), exist_ok=True)
+        loop = asyncio.get_event_loop()
+        # The audio span is exposed to the encoder relative to the file
+        # it actually gets, so it can skip silence the rip didn't
+        extra = None
+        if self._config.get('analyse_audio'):
+            await self._analyse_track(track, temp_filename)
+            rip_start = track.analysis.get('rip_start', 0)
+            extra = {
+                'audio_start': str(
+                    max(0, track.analysis['audio_start'] - rip_start)),
+                'audio_end': str(
+                    max(0, track.analysis['audio_end'] - rip_start))
+            }
+
+        reused = None
+        if self._fingerprints is not None:
+            reused = await self._fingerprint_track(
+                track, temp_filename, temp_encoded)
+        if reused is None:
+            ripped_hash = None
+            if self._config.get('verify_lossless'):
+                # Hashing the wav can go on while the encoder runs
+                ripped_hash = asyncio.ensure_future(loop.run_in_executor(
+                    None, verify.hash_wav, temp_filename))
+            await self._run_encoder(track, temp_filename, temp_encoded, extra)
+            if ripped_hash is not None:
+                await self._verify_track(track, temp_encoded, ripped_hash)
+
+        if reused == 'hardlink':
+            # Tagging would change the file it's linked to as well
+            self._tagged_files[temp_encoded] = track.filename
+        else:
+            # Always run after the previous due to awaits
+            with self._tracer.span('tag', track=track.tracknumber):
+                await self._tag_track(track, temp_encoded)
+            if self._metrics:
+                metrics.TRACKS.inc(stage='tag')
+
+        # Everything that needs the wav is done with it now
+        await self._remove_wav(track, temp_filename)
+
+        # Without post_finished tasks nothing touches the file after
+        # this, so it can go to the library right away
+        if not self._config.get('post_finished'):
+            await self._publish_track(temp_encoded)
+
+    async def _publish_track(self, temp_encoded):
+        """Publish a tagged file to its place in the library."""
+        target = self._tagged_files.get(temp_encoded)
+        # Nothing to do if the file didn't get tagged or we're not
+        # running the whole pipeline
+        if target is None or self._publisher is None:
+            return
+        # The file may not be local once it's published
+        try:
+            self._published_sizes[target] = os.path.getsize(temp_encoded)
+        except OSError:
+            pass
+        with self._tracer.span('publish'):
+            await self._publisher.publish(temp_encoded, target)
+        if self._metrics:
+            metrics.TRACKS.inc(stage='publish')
+
+    async def _publish_remaining(self):
+        """Publish whatever hasn't been already."""
+        await asyncio.gather(*[
+            self._publish_track(one_file)
+            for one_file in self._tagged_files
+            if self._tagged_files[one_file] not in self._publisher.published
+        ])
 
     async def _rip_track(self, track):
         """Rip track and kick off encoder and post_rip."""
         # Create temp filename here before acquiring lock to minimise
         # time locked and because I want to
-        temp_filename = os.path.join(
-            self._albumdata.ripdir,
-            '{tracknumber}.wav'.format(tracknumber=track.tracknumber))
+        temp_filename = self._wav_filename(track.tracknumber)
         temp_rip = '{temp_filename}.rip'.format(temp_filename=temp_filename)
 
-        # Acquire lock on, essentially, the CD drive
-        async with self._rip_lock:
-            proc = await asyncio.create_subprocess_exec(
-                self._deps.cdparanoia,
-                '--',
-                str(track.tracknumber),
-                temp_rip)
-
-            if await proc.wait() != 0:
+        # If a previous rip found silence at the ends of this track we
+        # can skip reading it off the disc altogether
+        span = str(track.tracknumber)
+        rip_start = 0
+        if self._image is not None:
+            sectors = tuple(self._image.toc[track.tracknumber - 1])
+        else:
+            sectors = None
+        if (self._config.get('trim_silence')
+                and track.analysis is not None
+                and track.analysis['audio_end'] > 0):
+            first, last = analysis.sector_span(track.analysis)
+            span = '{n}[.{first}]-{n}[.{last}]'.format(
+                n=track.tracknumber, first=first, last=last)
+            rip_start = first * analysis.SECTOR_FRAMES
+            if sectors is not None:
+                sectors = (sectors[0] + first, last - first + 1)
+        self._rip_starts[track.tracknumber] = rip_start
+
+        # Wait for room before touching the drive, so a full budget
+        # doesn't keep the drive locked
+        reserved = 0
+        if self._budget.limit:
+            reserved = self._wav_size_estimate(track)
+            with self._tracer.span('wait_budget', track=track.tracknumber):
+                await self._budget.reserve(reserved)
+
+        # Acquire lock on, essentially, the CD drive. Images are read
+        # one track at a time too, so the reads stay sequential.
+        with self._tracer.span('wait_drive', track=track.tracknumber):
+            await self._rip_lock.acquire()
+        try:
+            start = time.perf_counter()
+            if await self._read_disc(
+                    track.tracknumber, span, sectors, temp_rip) != 0:
                 raise RipError('Ripping track {} failed'.format(
                     track.tracknumber))
+            seconds = time.perf_counter() - start
+        finally:
+            self._rip_lock.release()
+
+        if self._metrics:
+            size = os.path.getsize(temp_rip)
+            metrics.DRIVE_READ_BYTES.inc(size)
+            metrics.DRIVE_READ_SPEED.set(size / max(seconds, 1e-6))
+            metrics.TRACKS.inc(stage='rip')
 
         # Rip lock released
-        # Run post_rip tasks. No gather, we just await them
-        for task in self._config.get('post_rip'):
-            # Parsing the ansible-y format
-            task_name = list(task.keys())[0]
-            task_args = self._arg_expand(task[task_name], temp_rip)
-            # Create actual task after preprocessing args
-            proc = await asyncio.create_subprocess_exec(
-                task_name,
-                *task_args)
-
-            if await proc.wait() != 0:
-                raise RipError('post_rip task {} failed'.format(
-                    task_name))
+        # Run post_rip tasks
+        await self._run_stage('post_rip', track, temp_rip)
 
         # Move the file to the actual temp filename
         # This means the presence of <number>.wav signifies both ripping
         # and post_rip tasks were completed succesfully.
         os.rename(temp_rip, temp_filename)
 
+        # Correct the estimate now that we know the actual size
+        if self._budget.limit:
+            size = os.path.getsize(temp_filename)
+            await self._budget.adjust(size - reserved)
+            self._wav_sizes[track.tracknumber] = size
+
         # Always run after the previous due to awaits
         await self._encode_track(track, temp_filename)
 
+    async def _rip_hidden_track(self):
+        """Rip the pregap before track one and look for audio in it.
+
+        The result is recorded in albumdata as hidden_track. If there
+        was audio, the rip is kept with the other wavs as 0.wav.
+        """
+        pregap = self._albumdata.dict.get('pregap', 0)
+        temp_filename = self._wav_filename(0)
+        temp_rip = '{temp_filename}.rip'.format(temp_filename=temp_filename)
+
+        async with self._rip_lock:
+            # A span without track numbers is absolute on the disc
+            if await self._read_disc(
+                    0, '[.0]-[.{}]'.format(pregap - 1), (0, pregap),
+                    temp_rip) != 0:
+                raise RipError('Ripping track one pregap failed')
+
+        loop = asyncio.get_event_loop()
+        with self._tracer.span('analyse', track=0):
+            result = await loop.run_in_executor(None, functools.partial(
+                analysis.analyse_wav, temp_rip,
+                threshold=self._config.get('silence_threshold')))
+        self._albumdata.dict['hidden_track'] = result
+
+        if result['audio_end'] > 0:
+            os.rename(temp_rip, temp_filename)
+            print('Found {:.2f}s of hidden audio before track one, '
+                  'kept as {}'.format(
+                      (result['audio_end'] - result['audio_start'])
+                          / analysis.SAMPLE_RATE,
+                      temp_filename))
+        else:
+            os.remove(temp_rip)
+
     async def _post_finished(self):
         """Run post_finished tasks.
 
         These are a bit more hefty than the other ones so they get their
         own coro.
         """
-        for task in self._config.get('post_finished'):
-            # Parsing the ansible-y format
-            task_name = list(task.keys())[0]
-            per_file = False
-            # See if we need to run this task per-file
-            # TODO: Need better way to do this
-            for arg in task[task_name]:
-                if ('${one_file}' in arg
-                        or '$one_file' in arg):
-                    per_file = True
-                    break
+        all_files = list(self._tagged_files.keys())
+
+        async def run(task):
+            action = task.action
+            # Tasks that take ${one_file} are run per-file. Python tasks
+            # get all the files at once.
+            per_file = (not plugin.is_plugin(action)
+                        and command.ONE_FILE in command.parse(
+                            list(action.values())[0]).placeholders)
 
             if per_file:
                 for one_file in self._tagged_files:
-                    task_args = self._arg_expand(
-                        task[task_name],
-                        one_file,
-                        all_files=list(self._tagged_files.keys()))
-                    # Create actual task after preprocessing args
-                    proc = await asyncio.create_subprocess_exec(
-                        task_name,
-                        *task_args)
-
-                    if await proc.wait() != 0:
-                        raise RipError('post_finished task {} failed'.format(
-                            task_name))
+                    await self._run_task(
+                        'post_finished', action, None, one_file,
+                        all_files=all_files, resource=task.resource)
             else:
-                task_args = self._arg_expand(
-                    task[task_name],
-                    '/dev/null',
-                    all_files=list(self._tagged_files.keys()))
-                # Create actual task after preprocessing args
-                proc = await asyncio.create_subprocess_exec(
-                    task_name,
-                    *task_args)
+                await self._run_task(
+                    'post_finished', action, None, None,
+                    all_files=all_files, resource=task.resource)
+
+        await graph.run(self._graph('post_finished'), run)
 
-                if await proc.wait() != 0:
-                    raise RipError('post_finished task {} failed'.format(
-                        task_name))
+    def _index_rip(self, started, seconds):
+        """Record the finished rip in the library index.
+
+        The files are in the library by now, so a broken or locked index
+        is only warned about.
+        """
+        filename = library.index_filename(self._config)
+        if filename is None:
+            return
+        files = []
+        for track in self._albumdata.tracks:
+            target = track.filename
+            if target in self._publisher.published:
+                files.append((track.tracknumber, target,
+                              self._published_sizes.get(target),
+                              self._publisher.published[target]))
+        try:
+            index = library.Library(filename)
+            try:
+                index.record(
+                    self._albumdata.dict, files,
+                    encoder_hash=self._encoder_hash(),
+                    ripped_at=started, rip_seconds=seconds)
+                if self._fingerprints:
+                    index.record_fingerprints(
+                        (path, self._fingerprints[tracknumber][0],
+                         fingerprint.to_bytes(
+                             self._fingerprints[tracknumber][1]),
+                         self._encoder_hash())
+                        for tracknumber, path, _, _ in files
+                        if tracknumber in self._fingerprints)
+            finally:
+                index.close()
+        except (library.LibraryError, sqlite3.Error, OSError) as e:
+            print('Warning: Could not record the rip in the library '
+                  'index: {}'.format(e), file=sys.stderr)
+
+    def _encoder_hash(self):
+        return library.encoder_hash(
+            self._config,
+            os.path.splitext(self._config.get('target_template'))[1]
+            .lstrip('.'))
 
     def rip_pipeline(self):
         """Rip cd and run given extra tasks.
@@ -218,6 +828,51 @@ class Rip:
         """
         loop = asyncio.get_event_loop()
         tasks = []
+        started = time.time()
+        started_monotonic = time.monotonic()
+
+        budget = self._config.get('ripdir_budget')
+        if budget and self._config.get('keep_ripdir'):
+            # Nothing would ever be freed
+            print('Note: ripdir_budget has no effect with keep_ripdir',
+                  file=sys.stderr)
+            budget = 0
+        if budget and not self._albumdata.dict.get('toc'):
+            print('Note: No table of contents in albumdata, so '
+                  'ripdir_budget takes every track to be ten minutes '
+                  'long', file=sys.stderr)
+        self._budget = SpaceBudget(budget or 0)
+        self._metrics = metrics.enabled(self._config)
+        self._tracer = trace.tracer_from_config(
+            self._config,
+            [metrics.observe_span] if self._metrics else ())
+        if self._config.get('resource_report'):
+            self._accounting = accounting.Accounting()
+        if self._albumdata.dict.get('image'):
+            self._image = image.DiscImage.open(self._albumdata.dict['image'])
+        if self._config.get('fingerprint'):
+            index = library.index_filename(self._config)
+            if index is None:
+                print('Note: fingerprint has no effect without '
+                      'library_index', file=sys.stderr)
+            else:
+                self._library = library.Library(index)
+                self._fingerprints = {}
+
+        self._resources = graph.Resources(
+            self._config.get('task_resources'), drive=self._rip_lock)
+
+        self._publisher = publish.Publisher(
+            storage.backend_from_config(
+                self._config, state_dir=self._albumdata.ripdir),
+            self._config.get('publish_jobs') or 1,
+            checksum=self._config.get('checksum_manifest') or None)
+
+        # Look for hidden audio first, the drive is at the start of the
+        # disc anyway
+        if (self._config.get('analyse_audio') and self._begin_track == 1
+                and self._albumdata.dict.get('pregap', 0) > 0):
+            tasks.append(asyncio.ensure_future(self._rip_hidden_track()))
         # Schedule each track to be ripped
         # If we continue rip we might only schedule them to be encoded.
         for track in self._albumdata.tracks:
@@ -226,9 +881,7 @@ class Rip:
                 continue
             # File that would exist if rip for this track has
             # succesfully completed
-            ripped_filename = os.path.join(
-                    self._albumdata.ripdir,
-                    '{}.wav'.format(track.tracknumber))
+            ripped_filename = self._wav_filename(track.tracknumber)
             if os.path.isfile(ripped_filename) and self._continue_rip:
                 # We have the .wav - this signals that we have
                 # succesfully ripped this track and only need to
@@ -236,6 +889,10 @@ class Rip:
                 # is of no consequence - it's easier to treat only rip
                 # as the time-consuming part (and it's possible encoder
                 # settings have changed between rips, etc)
+                if self._budget.limit:
+                    size = os.path.getsize(ripped_filename)
+                    self._budget.add(size)
+                    self._wav_sizes[track.tracknumber] = size
                 tasks.append(asyncio.ensure_future(
                         self._encode_track(track, ripped_filename)))
             else:
@@ -243,20 +900,46 @@ class Rip:
                 # schedule it to be ripped
                 tasks.append(asyncio.ensure_future(self._rip_track(track)))
 
+        # Every track goes through the batched tasks, unless it fails
+        self._batch_expected = len([
+            track for track in self._albumdata.tracks
+            if self._begin_track <= track.tracknumber <= self._end_track])
+
         # Wait for all to finish
         # NOTE: gather order is not in fact specified, so tracks may be
         # ripped in a strange order. I've never observed this, just
         # something to keep in mind.
-        loop.run_until_complete(asyncio.gather(*tasks))
-        loop.run_until_complete(asyncio.ensure_future(self._post_finished()))
-
-        # We're done with the tasks
-        for one_file in self._tagged_files:
-            target_file = self._tagged_files[one_file]
-            # Ensure target dir exists
-            os.makedirs(os.path.dirname(target_file), exist_ok=True)
-            # Copy files over
-            shutil.copy2(one_file, target_file)
-
+        try:
+            loop.run_until_complete(asyncio.gather(*tasks))
+            loop.run_until_complete(
+                asyncio.ensure_future(self._post_finished()))
+
+            # We're done with the tasks. Move whatever is left into
+            # place; if there were no post_finished tasks, this was
+            # already done track by track.
+            loop.run_until_complete(self._publish_remaining())
+            if self._metrics:
+                metrics.DISCS_COMPLETED.inc()
+        finally:
+            # Even if something failed, whatever got published should
+            # be synced and in the manifest
+            with self._tracer.span('publish_finish'):
+                loop.run_until_complete(self._publisher.finish())
+            self._update_metrics()
+            # A trace of a failed rip is at least as interesting
+            if self._config.get('trace_dir'):
+                self._tracer.write(
+                    trace.trace_directory(
+                        self._config, self._albumdata.ripdir),
+                    os.path.basename(self._albumdata.ripdir))
+            if self._accounting is not None:
+                print('\nResource usage:\n{}'.format(
+                    self._accounting.report()))
+            if self._image is not None:
+                self._image.close()
+            if self._library is not None:
+                self._library.close()
+
+        self._index_rip(started, time.monotonic() - started_monotonic)
         loop.close()
         # Done!
@@ -0,0 +1,274 @@
+"""Keeping the library index up to date with the music directory.
+
+The scanner walks the directory tree and compares each audio file's
+inode, size and mtime with what the index has. Only files that are new
+or have changed get their tags read, in a thread pool, and the changes
+are written in batches. Nothing more than one directory's worth of
+state is held at a time, so a library of any size can be scanned.
+
+With inotify the directories can also be watched, so that whatever
+changes in them is scanned again as it happens.
+"""
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import mutagen
+import os
+import os.path
+import select
+import struct
+from .error import CdparacordError
+from .util import read_tags
+
+
+class ScanError(CdparacordError):
+    pass
+
+
+# Files with these extensions are scanned
+AUDIO_EXTENSIONS = frozenset((
+    '.aac', '.aiff', '.ape', '.flac', '.m4a', '.mp3', '.mpc', '.ogg',
+    '.opus', '.wav', '.wma', '.wv'))
+
+# How many changes are written in one transaction
+SCAN_BATCH = 1000
+
+
+class Scanner:
+    """Scans directories into a library index.
+
+    The counts of what the last scan found are kept in added, changed,
+    removed, unchanged and failed (files whose tags couldn't be read;
+    they're indexed without tags).
+    """
+    def __init__(self, index, *, jobs=None, batch=SCAN_BATCH,
+            on_directory=None):
+        self._index = index
+        self._jobs = max(1, jobs or os.cpu_count() or 1)
+        self._batch = batch
+        # Called with every directory scanned
+        self._on_directory = on_directory
+        self._files = []
+        self._removed = []
+        self._dirs = []
+        self._removed_dirs = []
+        self.added = 0
+        self.changed = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.failed = 0
+
+    def _walk(self, directories, recursive):
+        """Yield the files of directories that need their tags read.
+
+        Everything else found out along the way goes straight into the
+        batch. Without recursive, only new subdirectories are scanned.
+        """
+        stack = list(reversed(directories))
+        while stack:
+            directory = stack.pop()
+            stored_files, stored_dirs = self._index.scan_state(directory)
+            try:
+                entries = sorted(os.scandir(directory),
+                                 key=lambda entry: entry.name)
+            except (FileNotFoundError, NotADirectoryError):
+                self._removed_dirs.append(directory)
+                continue
+            if self._on_directory is not None:
+                self._on_directory(directory)
+
+            subdirs = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    if (not entry.is_file()
+                            or os.path.splitext(entry.name)[1].lower()
+                            not in AUDIO_EXTENSIONS):
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Gone while we were looking
+                    continue
+                state = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                old = stored_files.pop(entry.name, None)
+                if old == state:
+                    self.unchanged += 1
+                else:
+                    yield entry.path, directory, state, old is None
+
+            for name in stored_files:
+                self._removed.append(os.path.join(directory, name))
+                self.removed += 1
+            self._removed_dirs.extend(stored_dirs.difference(subdirs))
+            for subdir in reversed(subdirs):
+                if subdir not in stored_dirs:
+                    self._dirs.append((subdir, directory))
+                    stack.append(subdir)
+                elif recursive:
+                    stack.append(subdir)
+            self._flush(False)
+
+    def _flush(self, force=True):
+        """Write the batch if it's full, or with force if there's any."""
+        size = (len(self._files) + len(self._removed) + len(self._dirs)
+                + len(self._removed_dirs))
+        if size == 0 or (size < self._batch and not force):
+            return
+        self._index.update_scan(
+            self._files, self._removed, self._dirs, self._removed_dirs)
+        self._files = []
+        self._removed = []
+        self._dirs = []
+        self._removed_dirs = []
+
+    def _read(self, path):
+        try:
+            return read_tags(path)
+        except (OSError, mutagen.MutagenError):
+            return None
+
+    def _finish(self, item, future):
+        path, directory, state, new = item
+        tags = future.result()
+        if tags is None:
+            self.failed += 1
+            tags = {}
+        self._files.append((path, directory, state, tags))
+        if new:
+            self.added += 1
+        else:
+            self.changed += 1
+        self._flush(False)
+
+    def scan(self, directories, *, recursive=True):
+        """Scan directories, and everything under them with recursive.
+
+        Without recursive, only the directories themselves and any new
+        subdirectories are scanned; that's what a watch needs.
+        """
+        directories = [os.path.abspath(d) for d in directories]
+        self.added = self.changed = self.removed = 0
+        self.unchanged = self.failed = 0
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self._jobs) as executor:
+            for item in self._walk(directories, recursive):
+                pending.append((item, executor.submit(self._read, item[0])))
+                # Don't let the walk run too far ahead of the reading
+                while len(pending) > self._jobs * 4:
+                    self._finish(*pending.popleft())
+            while pending:
+                self._finish(*pending.popleft())
+        self._flush()
+
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+              | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+
+
+class Watcher:
+    """Watches directories for changes with inotify."""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._fd = libc.inotify_init1(IN_CLOEXEC)
+        except AttributeError:
+            raise ScanError('Watching needs inotify, which is Linux only')
+        if self._fd < 0:
+            raise ScanError('Could not start watching: {}'.format(
+                os.strerror(ctypes.get_errno())))
+        self._add_watch.argtypes = (
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        # Watch descriptor -> directory
+        self._watches = {}
+
+    def add(self, directory):
+        """Watch directory; watching it again is fine."""
+        wd = self._add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise ScanError(
+                    'Ran out of inotify watches; raise '
+                    'fs.inotify.max_user_watches')
+            # Probably gone already, the scan will notice
+            return
+        self._watches[wd] = directory
+
+    def changed(self, timeout):
+        """Wait up to timeout seconds for changes.
+
+        Returns the set of directories that changed in them, or None if
+        events were lost and everything has to be scanned again.
+        """
+        directories = set()
+        overflow = False
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return directories
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+            # A directory that's gone is noticed in its parent
+            if not mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                directories.add(directory)
+        return None if overflow else directories
+
+    def close(self):
+        os.close(self._fd)
+
+
+def watch(scanner, watcher, directories, *, settle=1.0, report=None):
+    """Scan directories again whenever something in them changes.
+
+    The directories must have been scanned with the watcher already.
+    Changes are collected until there are none for settle seconds and
+    then scanned; report is called after each scan. Runs until
+    interrupted.
+    """
+    while True:
+        changed = watcher.changed(None)
+        while changed:
+            more = watcher.changed(settle)
+            if more is None:
+                changed = None
+            elif not more:
+                break
+            else:
+                changed |= more
+        if changed is None:
+            scanner.scan(directories)
+        else:
+            scanner.scan(sorted(changed), recursive=False)
+        if report is not None:
+            report()
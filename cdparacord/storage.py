@@ -0,0 +1,510 @@
+"""Storage backends files are published to.
+
+A backend takes a local file and a target path (the absolute path the
+target_template produced) and puts the file there, wherever "there"
+actually is. Backends are called from worker threads, so everything
+here is blocking and thread safe.
+
+Remote backends map target paths to names under their own root by
+taking the path relative to the configured local root, which defaults
+to $xdgmusic. Targets outside the root are an error.
+"""
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import os.path
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree
+from . import publish
+from .command import parse as parse_command
+from .error import CdparacordError
+from .xdg import XDG_MUSIC_DIR
+
+
+class StorageError(CdparacordError):
+    pass
+
+
+class _NoSuchUpload(StorageError):
+    """The server doesn't know the multipart upload we're continuing."""
+
+
+BACKENDS = ('local', 'command', 's3')
+
+
+class Backend:
+    """Interface of a storage backend."""
+
+    def put(self, src, target, *, checksum=None):
+        """Move the local file src to target.
+
+        If checksum names a hashlib algorithm, return the hex digest of
+        the file, computed while it's being moved. Otherwise return
+        None.
+        """
+        raise NotImplementedError
+
+    def read_text(self, target):
+        """Return the contents of a small text file, or None."""
+        raise NotImplementedError
+
+    def write_text(self, target, text):
+        """Atomically replace a small text file."""
+        raise NotImplementedError
+
+    def finish(self, directories):
+        """Make everything put in the given directories durable."""
+        pass
+
+
+class LocalBackend(Backend):
+    """The music library is a local directory."""
+
+    def __init__(self, *, fsync=True):
+        self._fsync = fsync
+
+    def put(self, src, target, *, checksum=None):
+        return publish.publish_file(
+            src, target, checksum=checksum, fsync=self._fsync)
+
+    def read_text(self, target):
+        if not os.path.isfile(target):
+            return None
+        with open(target, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def write_text(self, target, text):
+        temp = '{}.cdparacord-part'.format(target)
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.write(text)
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(temp, target)
+
+    def finish(self, directories):
+        if self._fsync:
+            # One sync per directory makes all the renames in it durable
+            for directory in directories:
+                publish.fsync_path(directory)
+
+
+def _relative_name(root, target):
+    """Return target relative to root, with forward slashes."""
+    relative = os.path.relpath(target, root)
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        raise StorageError('{} is not under the storage root {}'.format(
+            target, root))
+    return relative.replace(os.sep, '/')
+
+
+def _retry(action, retries, what):
+    """Run action, retrying with exponential backoff on StorageError."""
+    delay = 0.5
+    for attempt in range(retries + 1):
+        try:
+            return action()
+        except StorageError as e:
+            if attempt == retries:
+                raise StorageError('{} failed after {} attempts: {}'.format(
+                    what, retries + 1, e)) from e
+            time.sleep(delay)
+            delay *= 2
+
+
+class CommandBackend(Backend):
+    """The music library is reached by running commands, like scp.
+
+    The put command gets the local file as ${one_file} and the name
+    under the remote root as ${out_file}. The optional get command gets
+    them the other way around and is only used to merge checksum
+    manifests; without it, manifests are overwritten.
+    """
+
+    def __init__(self, root, put, get=None, *, retries=3):
+        self._root = root
+        self._put = put
+        self._get = get
+        self._retries = retries
+
+    @staticmethod
+    def _expand(command, one_file, out_file):
+        name = list(command.keys())[0]
+        return [name] + parse_command(command[name]).expand(
+            one_file, out_file=out_file)
+
+    def _run(self, command, one_file, out_file):
+        def action():
+            proc = subprocess.run(
+                self._expand(command, one_file, out_file),
+                stdout=subprocess.DEVNULL)
+            if proc.returncode != 0:
+                raise StorageError('{} exited with {}'.format(
+                    list(command.keys())[0], proc.returncode))
+        _retry(action, self._retries, 'Copying {}'.format(out_file))
+
+    def put(self, src, target, *, checksum=None):
+        name = _relative_name(self._root, target)
+        # The command reads the file itself, so the digest costs a read
+        # of our own; it comes from the page cache right after encoding
+        digest = None
+        if checksum is not None:
+            digest = publish.hash_file(src, checksum)
+        self._run(self._put, src, name)
+        os.remove(src)
+        return digest
+
+    def read_text(self, target):
+        if self._get is None:
+            return None
+        name = _relative_name(self._root, target)
+        with tempfile.TemporaryDirectory() as d:
+            local = os.path.join(d, 'file')
+            try:
+                self._run(self._get, local, name)
+            except StorageError:
+                # Most likely it doesn't exist
+                return None
+            with open(local, 'r', encoding='utf-8') as f:
+                return f.read()
+
+    def write_text(self, target, text):
+        name = _relative_name(self._root, target)
+        with tempfile.TemporaryDirectory() as d:
+            local = os.path.join(d, 'file')
+            with open(local, 'w', encoding='utf-8') as f:
+                f.write(text)
+            self._run(self._put, local, name)
+
+
+class _ConnectionPool:
+    """A pool of keep-alive HTTP connections to one host.
+
+    Pools are shared by every backend talking to the same endpoint, so
+    connections are reused across tracks and discs.
+    """
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, scheme, netloc, size):
+        self._scheme = scheme
+        self._netloc = netloc
+        self._idle = queue.LifoQueue(size)
+
+    @classmethod
+    def get(cls, endpoint, size):
+        parts = urllib.parse.urlsplit(endpoint)
+        if parts.scheme not in ('http', 'https'):
+            raise StorageError('Unsupported endpoint {}'.format(endpoint))
+        key = (parts.scheme, parts.netloc)
+        with cls._pools_lock:
+            if key not in cls._pools:
+                cls._pools[key] = cls(parts.scheme, parts.netloc, size)
+            return cls._pools[key]
+
+    def _connect(self):
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(self._netloc, timeout=60)
+        return http.client.HTTPConnection(self._netloc, timeout=60)
+
+    def request(self, method, path, headers, body=b''):
+        """Make a request; return (status, headers, body)."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise StorageError('{} {}: {}'.format(method, path, e)) from e
+
+        if response.will_close:
+            conn.close()
+        else:
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+        return response.status, response.headers, data
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _find_text(document, tag):
+    """Find text of the first tag in an XML document, any namespace."""
+    for element in xml.etree.ElementTree.fromstring(document).iter():
+        if element.tag == tag or element.tag.endswith('}' + tag):
+            return element.text
+    return None
+
+
+class S3Backend(Backend):
+    """The music library is a bucket in an S3-compatible object store.
+
+    Large files are uploaded in parts. The state of each multipart
+    upload is kept in state_dir, so an interrupted upload picks up where
+    it left off on the next try.
+    """
+    # S3 won't take parts smaller than this except the last one
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, root, endpoint, bucket, *, prefix='',
+                 region='us-east-1', access_key=None, secret_key=None,
+                 part_size=8 * 1024 * 1024, retries=3, connections=4,
+                 state_dir=None):
+        self._root = root
+        self._endpoint = endpoint
+        self._bucket = bucket
+        self._prefix = prefix.strip('/')
+        self._region = region
+        self._access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID')
+        self._secret_key = (secret_key
+            or os.environ.get('AWS_SECRET_ACCESS_KEY'))
+        if not self._access_key or not self._secret_key:
+            raise StorageError('S3 storage needs access_key and secret_key')
+        self._part_size = max(part_size, self.MIN_PART_SIZE)
+        self._retries = retries
+        self._state_dir = state_dir
+        self._pool = _ConnectionPool.get(endpoint, connections)
+        self._host = urllib.parse.urlsplit(endpoint).netloc
+
+    def _key(self, target):
+        name = _relative_name(self._root, target)
+        if self._prefix:
+            return '{}/{}'.format(self._prefix, name)
+        return name
+
+    def _sign(self, method, path, query, headers, payload_hash):
+        """Add AWS signature version 4 headers."""
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        date = amz_date[:8]
+        headers['host'] = self._host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+
+        signed = sorted(headers)
+        canonical_query = '&'.join(
+            '{}={}'.format(urllib.parse.quote(k, safe='-_.~'),
+                           urllib.parse.quote(v, safe='-_.~'))
+            for k, v in sorted(query.items()))
+        canonical = '\n'.join([
+            method,
+            path,
+            canonical_query,
+            ''.join('{}:{}\n'.format(h, str(headers[h]).strip())
+                    for h in signed),
+            ';'.join(signed),
+            payload_hash])
+        scope = '{}/{}/s3/aws4_request'.format(date, self._region)
+        to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            _sha256(canonical.encode('utf-8'))])
+
+        key = ('AWS4' + self._secret_key).encode('utf-8')
+        for part in (date, self._region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(
+            key, to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+        headers['authorization'] = (
+            'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, '
+            'Signature={}'.format(
+                self._access_key, scope, ';'.join(signed), signature))
+        return canonical_query
+
+    def _request(self, method, key, *, query=None, body=b'', headers=None,
+                 ok=(200,)):
+        query = query or {}
+        headers = dict(headers or {})
+        path = urllib.parse.quote(
+            '/{}/{}'.format(self._bucket, key), safe='/-_.~')
+
+        def action():
+            h = dict(headers)
+            canonical_query = self._sign(
+                method, path, query, h, _sha256(body))
+            url = path + ('?' + canonical_query if canonical_query else '')
+            status, response_headers, data = self._pool.request(
+                method, url, h, body)
+            # Retry server errors, fail client errors right away
+            if status >= 500:
+                raise StorageError('{} {} returned {}'.format(
+                    method, key, status))
+            return status, response_headers, data
+
+        status, response_headers, data = _retry(
+            action, self._retries, '{} {}'.format(method, key))
+        if status not in ok:
+            raise StorageError('{} {} returned {}: {}'.format(
+                method, key, status, data[:200]))
+        return status, response_headers, data
+
+    def _state_file(self, key):
+        if self._state_dir is None:
+            return None
+        return os.path.join(self._state_dir, 'upload-{}.json'.format(
+            hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def _load_state(self, key, src):
+        """Return the saved multipart state for src if still valid."""
+        state_file = self._state_file(key)
+        if state_file is None or not os.path.isfile(state_file):
+            return None
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        st = os.stat(src)
+        if (state.get('size') != st.st_size
+                or state.get('mtime') != st.st_mtime
+                or state.get('part_size') != self._part_size):
+            return None
+        return state
+
+    def _save_state(self, key, state):
+        state_file = self._state_file(key)
+        if state_file is None:
+            return
+        temp = '{}.part'.format(state_file)
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.rename(temp, state_file)
+
+    def _remove_state(self, key):
+        state_file = self._state_file(key)
+        if state_file is not None and os.path.exists(state_file):
+            os.remove(state_file)
+
+    def _put_multipart(self, src, key, h):
+        """Upload src in parts, continuing an earlier upload if we can.
+
+        Returns h, or a copy of it in its place, having hashed src.
+        """
+        state = self._load_state(key, src)
+        if state is not None:
+            resumed = h.copy() if h is not None else None
+            try:
+                self._upload_parts(src, key, resumed, state)
+                return resumed
+            except _NoSuchUpload:
+                # Aborted or expired on the server since, so the parts
+                # are gone too
+                self._remove_state(key)
+
+        _, _, data = self._request('POST', key, query={'uploads': ''})
+        upload_id = _find_text(data, 'UploadId')
+        if not upload_id:
+            raise StorageError(
+                'No upload id for {} in {}'.format(key, data[:200]))
+        st = os.stat(src)
+        state = {
+            'upload_id': upload_id,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'part_size': self._part_size,
+            'parts': {}
+        }
+        self._save_state(key, state)
+        self._upload_parts(src, key, h, state)
+        return h
+
+    def _upload_request(self, method, key, **kwargs):
+        """Make a request of a multipart upload.
+
+        Raises _NoSuchUpload if the server doesn't know the upload.
+        """
+        status, headers, data = self._request(
+            method, key, ok=(200, 404), **kwargs)
+        if status == 404:
+            if b'NoSuchUpload' in data:
+                raise _NoSuchUpload('{} {}: no such upload'.format(
+                    method, key))
+            raise StorageError('{} {} returned {}: {}'.format(
+                method, key, status, data[:200]))
+        return headers
+
+    def _upload_parts(self, src, key, h, state):
+        upload_id = state['upload_id']
+        number = 0
+        with open(src, 'rb') as f:
+            while True:
+                part = f.read(self._part_size)
+                if not part and number > 0:
+                    break
+                number += 1
+                if h is not None:
+                    h.update(part)
+                # Parts that made it last time only need hashing
+                if str(number) in state['parts']:
+                    continue
+                headers = self._upload_request(
+                    'PUT', key, body=part, query={
+                        'partNumber': str(number),
+                        'uploadId': upload_id})
+                state['parts'][str(number)] = headers.get('ETag')
+                self._save_state(key, state)
+                if len(part) < self._part_size:
+                    break
+
+        body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(
+            ''.join('<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'
+                    .format(n, state['parts'][n])
+                    for n in sorted(state['parts'], key=int)))
+        self._upload_request('POST', key, query={'uploadId': upload_id},
+                             body=body.encode('utf-8'))
+        self._remove_state(key)
+
+    def put(self, src, target, *, checksum=None):
+        key = self._key(target)
+        h = hashlib.new(checksum) if checksum is not None else None
+        if os.path.getsize(src) <= self._part_size:
+            with open(src, 'rb') as f:
+                data = f.read()
+            if h is not None:
+                h.update(data)
+            self._request('PUT', key, body=data)
+        else:
+            h = self._put_multipart(src, key, h)
+        os.remove(src)
+        return h.hexdigest() if h is not None else None
+
+    def read_text(self, target):
+        status, _, data = self._request(
+            'GET', self._key(target), ok=(200, 404))
+        if status == 404:
+            return None
+        return data.decode('utf-8')
+
+    def write_text(self, target, text):
+        self._request('PUT', self._key(target), body=text.encode('utf-8'))
+
+
+def backend_from_config(config, *, state_dir=None):
+    """Create the backend the storage setting asks for."""
+    settings = dict(config.get('storage') or {})
+    kind = settings.pop('backend', 'local')
+    root = os.path.expanduser(settings.pop('root', None) or XDG_MUSIC_DIR)
+
+    try:
+        if kind == 'local':
+            return LocalBackend(fsync=bool(config.get('fsync_published')))
+        elif kind == 'command':
+            return CommandBackend(root, **settings)
+        elif kind == 's3':
+            return S3Backend(root, state_dir=state_dir, **settings)
+    except TypeError as e:
+        # Unknown or missing keys in the settings
+        raise StorageError('Invalid {} storage settings: {}'.format(
+            kind, e)) from e
+    raise StorageError('Unknown storage backend {} (expected one of {})'
+        .format(kind, ', '.join(BACKENDS)))
@@ -0,0 +1,428 @@
+"""Syncing parts of the library to a portable player.
+
+Files are transcoded with the encoder of a sync profile, named with the
+profile's template and copied to the destination. The transcodes are
+kept in a cache shared by every destination, keyed by the contents of
+the source and the profile, so syncing the same music to a second
+player (or again after the player was wiped) costs only the copying.
+The cache is kept under a size limit by evicting the files least
+recently used.
+
+Each destination remembers what was synced to it, so only new and
+changed files are copied the next time.
+"""
+import asyncio
+import click
+import concurrent.futures
+import functools
+import hashlib
+import json
+import mutagen
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+from . import placement
+from . import publish
+from .albumdata import Albumdata
+from .config import Config
+from .error import CdparacordError
+from .rip import expand_args, tag_file
+from .util import find_sources, read_tags, run_process
+from .xdg import XDG_CACHE_HOME
+
+
+class SyncError(CdparacordError):
+    pass
+
+
+# Kept in the destination
+STATE_NAME = '.cdparacord-sync.json'
+# Kept in the cache directory
+SOURCES_NAME = 'sources.json'
+
+
+def _load_json(filename):
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        # Start over rather than refuse to sync
+        print('Ignoring unreadable {}'.format(filename), file=sys.stderr)
+        return {}
+
+
+def _save_json(filename, data):
+    """Write data as JSON, atomically."""
+    temp = placement.staging_filename(filename)
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, sort_keys=True)
+    os.rename(temp, filename)
+
+
+def _copy_file(src, dst):
+    """Copy src to dst so that dst is either old or complete."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    temp = placement.staging_filename(dst)
+    try:
+        placement.fast_copy(src, temp)
+        os.rename(temp, dst)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def profile_hash(profile):
+    """Hash what decides how a profile's transcodes turn out."""
+    return hashlib.sha256(json.dumps(
+        [profile['decoder'], profile['encoder']],
+        sort_keys=True).encode()).hexdigest()
+
+
+def get_profile(config, name):
+    """Return the sync profile name with its defaults filled in."""
+    profiles = config.get('sync_profiles') or {}
+    if name not in profiles:
+        raise SyncError('No sync profile {} (configured: {})'.format(
+            name, ', '.join(sorted(profiles)) or 'none'))
+    profile = dict(profiles[name])
+    for key in ('encoder', 'template'):
+        if key not in profile:
+            raise SyncError('Sync profile {} has no {}'.format(name, key))
+    profile.setdefault('decoder', config.get('decoder'))
+    for key in ('decoder', 'encoder'):
+        if type(profile[key]) is not dict or len(profile[key]) != 1:
+            raise SyncError(
+                'The {} of sync profile {} should be an action like '
+                'the encoder'.format(key, name))
+        executable = list(profile[key].keys())[0]
+        if shutil.which(executable) is None:
+            raise SyncError('Executable {} not found or not executable'
+                            .format(executable))
+    return profile
+
+
+class _TemplateConfig:
+    """Config with target_template replaced, for naming the files."""
+    def __init__(self, config, template):
+        self._config = config
+        self._template = template
+
+    def get(self, key):
+        if key == 'target_template':
+            return self._template
+        return self._config.get(key)
+
+
+def target_name(tags, template, config):
+    """Name a file after its tags with template.
+
+    The name goes through Albumdata._generate_filename, so it gets the
+    same safety filtering as the names of ripped files.
+    """
+    tracknumber = tags.get('tracknumber', '0').split('/')[0]
+    artist = tags.get('artist', '')
+    data = {
+        'title': tags.get('album', ''),
+        'albumartist': tags.get('albumartist', artist)
+    }
+    track = {'artist': artist, 'title': tags.get('title', '')}
+    return Albumdata._generate_filename(
+        data, track, tracknumber if tracknumber.isdigit() else 0,
+        _TemplateConfig(config, template))
+
+
+class Cache:
+    """Transcodes kept in a directory, evicted least recently used.
+
+    Using a file touches it, so a file's mtime is when it was last
+    used.
+    """
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self._limit = limit
+
+    def filename(self, key, extension):
+        return os.path.join(self.directory, key[:2],
+                            '{}.{}'.format(key, extension))
+
+    def get(self, key, extension):
+        """Return the cached file for key, or None."""
+        filename = self.filename(key, extension)
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        return filename
+
+    def evict(self):
+        """Remove the least recently used files until under the limit.
+
+        Returns how many files were removed.
+        """
+        if not self._limit:
+            return 0
+        files = []
+        total = 0
+        for directory, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith('.json') or 'cdparacord-part' in name:
+                    continue
+                filename = os.path.join(directory, name)
+                st = os.stat(filename)
+                files.append((st.st_mtime, st.st_size, filename))
+                total += st.st_size
+        files.sort()
+        removed = 0
+        for _, size, filename in files:
+            if total <= self._limit:
+                break
+            os.remove(filename)
+            total -= size
+            removed += 1
+        return removed
+
+
+class Syncer:
+    """Syncs sources to destination with a profile.
+
+    sources are files and directories; directories are searched for
+    files ending in source_extension.
+    """
+    def __init__(self, config, profile, destination, sources, *,
+            source_extension='flac', cache_dir=None, jobs=None,
+            delete=False):
+        self._config = config
+        self._profile = profile
+        self._destination = destination
+        self._sources = sources
+        self._source_extension = source_extension
+        self._extension = os.path.splitext(profile['template'])[1].lstrip(
+            '.') or 'out'
+        self._profile_hash = profile_hash(profile)
+        self._cache = Cache(
+            cache_dir or os.path.join(XDG_CACHE_HOME, 'cdparacord', 'sync'),
+            config.get('sync_cache_size'))
+        self._jobs = max(1, jobs or os.cpu_count() or 1)
+        self._delete = delete
+        self._copy_executor = concurrent.futures.ThreadPoolExecutor(
+            max(1, config.get('publish_jobs') or 1))
+        self._state = {}
+        self._source_hashes = {}
+        # Cache key -> the transcode of it that's under way
+        self._transcoding = {}
+        self.transcoded = []
+        self.copied = []
+        self.unchanged = []
+        self.removed = []
+        self.failed = []
+
+    def _source_files(self):
+        for source in self._sources:
+            if os.path.isdir(source):
+                for name in find_sources(source, self._source_extension):
+                    yield os.path.join(source, name)
+            else:
+                yield source
+
+    def _content_hash(self, source):
+        """Hash source, unless it's unchanged since it was last hashed."""
+        st = os.stat(source)
+        key = os.path.abspath(source)
+        known = self._source_hashes.get(key)
+        if (known is not None and known['mtime'] == st.st_mtime_ns
+                and known['size'] == st.st_size):
+            return known['sha256']
+        digest = publish.hash_file(source, 'sha256')
+        self._source_hashes[key] = {
+            'mtime': st.st_mtime_ns, 'size': st.st_size, 'sha256': digest}
+        return digest
+
+    def _inspect(self, source):
+        """Return the cache key and the destination name of source."""
+        key = hashlib.sha256('{}:{}'.format(
+            self._content_hash(source),
+            self._profile_hash).encode()).hexdigest()
+        name = target_name(
+            read_tags(source), self._profile['template'], self._config)
+        return key, name
+
+    async def _transcode(self, source, key, wav):
+        cached = self._cache.filename(key, self._extension)
+        staged = placement.staging_filename(cached)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+
+        decoder = self._profile['decoder']
+        decoder_name = list(decoder.keys())[0]
+        await run_process(
+            decoder_name,
+            expand_args(decoder[decoder_name], source, out_file=wav),
+            'Decoding {}'.format(source))
+        try:
+            encoder = self._profile['encoder']
+            encoder_name = list(encoder.keys())[0]
+            await run_process(
+                encoder_name,
+                expand_args(encoder[encoder_name], wav, out_file=staged),
+                'Encoding {}'.format(source))
+            os.remove(wav)
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, functools.partial(
+                tag_file, staged, read_tags(source)))
+            os.rename(staged, cached)
+        except BaseException:
+            if os.path.exists(staged):
+                os.remove(staged)
+            raise
+        return cached
+
+    async def _transcode_once(self, source, key, wav):
+        """Transcode source unless its key is being transcoded already.
+
+        Two workers transcoding the same thing would write the same
+        files, so the later one waits for the first instead. Returns the
+        cached file and whether this call transcoded it.
+        """
+        pending = self._transcoding.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending), False
+        pending = asyncio.ensure_future(self._transcode(source, key, wav))
+        self._transcoding[key] = pending
+        try:
+            return await pending, True
+        finally:
+            del self._transcoding[key]
+
+    async def _sync(self, source, wav, synced):
+        loop = asyncio.get_event_loop()
+        key, name = await loop.run_in_executor(
+            None, self._inspect, source)
+        if name in synced:
+            print('{} and {} would both be synced as {}; skipping the '
+                  'latter'.format(synced[name]['source'], source, name),
+                  file=sys.stderr)
+            return
+        synced[name] = {'source': os.path.abspath(source), 'key': key}
+
+        target = os.path.join(self._destination, name)
+        previous = self._state.get(name)
+        if (previous is not None and previous['key'] == key
+                and os.path.isfile(target)):
+            self.unchanged.append(name)
+            return
+
+        cached = self._cache.get(key, self._extension)
+        if cached is None:
+            cached, transcoded = await self._transcode_once(source, key, wav)
+            if transcoded:
+                self.transcoded.append(name)
+        await loop.run_in_executor(
+            self._copy_executor, _copy_file, cached, target)
+        self.copied.append(name)
+        print('Synced {}'.format(name))
+
+    async def _worker(self, sources, wav, synced):
+        for source in sources:
+            try:
+                await self._sync(source, wav, synced)
+            except (CdparacordError, OSError, mutagen.MutagenError) as e:
+                print('Could not sync {}: {}'.format(source, e),
+                      file=sys.stderr)
+                self.failed.append(source)
+
+    def _remove_stale(self, synced):
+        """Remove what was synced before but isn't any more."""
+        for name in sorted(set(self._state) - set(synced)):
+            filename = os.path.join(self._destination, name)
+            try:
+                os.remove(filename)
+                # Clean up the album directories left empty; this stops
+                # at the destination, which has the state file in it
+                os.removedirs(os.path.dirname(filename))
+            except OSError:
+                pass
+            self.removed.append(name)
+
+    def run(self):
+        os.makedirs(self._destination, exist_ok=True)
+        os.makedirs(self._cache.directory, exist_ok=True)
+        state_file = os.path.join(self._destination, STATE_NAME)
+        sources_file = os.path.join(self._cache.directory, SOURCES_NAME)
+        self._state = _load_json(state_file)
+        self._source_hashes = _load_json(sources_file)
+
+        loop = asyncio.get_event_loop()
+        sources = self._source_files()
+        # Destination name -> what was synced there this time
+        synced = {}
+        try:
+            with tempfile.TemporaryDirectory(
+                    prefix='cdparacord-sync-') as wavdir:
+                loop.run_until_complete(asyncio.gather(*[
+                    self._worker(sources, os.path.join(
+                        wavdir, '{}.wav'.format(n)), synced)
+                    for n in range(self._jobs)]))
+        finally:
+            self._copy_executor.shutdown()
+            # Whatever didn't make it this time is retried the next
+            failed = {os.path.abspath(f) for f in self.failed}
+            state = {name: entry for name, entry in synced.items()
+                     if entry['source'] not in failed}
+            if self._delete and not self.failed:
+                self._remove_stale(synced)
+            else:
+                # Still on the device, still ours
+                for name, entry in self._state.items():
+                    state.setdefault(name, entry)
+            _save_json(state_file, state)
+            _save_json(sources_file, self._source_hashes)
+            self._cache.evict()
+
+
+@click.command()
+@click.argument('profile')
+@click.argument('destination', type=click.Path(file_okay=False))
+@click.argument('sources', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.option('--jobs', '-j', type=int, default=None,
+    help="""How many files to transcode at once (default: sync_jobs
+    from the configuration).""")
+@click.option('--source-extension', default='flac', show_default=True,
+    help="""Extension of the files to sync from directories.""")
+@click.option('--delete', is_flag=True, default=False,
+    help="""Remove files synced to DESTINATION before that aren't
+    among SOURCES any more.""")
+def main(profile, destination, sources, jobs, source_extension, delete):
+    """Sync music to a portable player.
+
+    The files under SOURCES are transcoded with the sync profile PROFILE
+    from the configuration and copied to DESTINATION. Only files that
+    are new or changed since the last sync are copied, and transcodes
+    are cached so the same files don't have to be transcoded again for
+    another player.
+    """
+    config = Config()
+    cache_dir = config.get('sync_cache_dir')
+    syncer = Syncer(
+        config, get_profile(config, profile), destination, list(sources),
+        source_extension=source_extension,
+        cache_dir=cache_dir and os.path.expanduser(cache_dir),
+        jobs=jobs or config.get('sync_jobs'), delete=delete)
+    syncer.run()
+
+    print('Synced {} files ({} transcoded), {} unchanged, {} removed, '
+          '{} failed'.format(
+              len(syncer.copied), len(syncer.transcoded),
+              len(syncer.unchanged), len(syncer.removed),
+              len(syncer.failed)))
+    if syncer.failed:
+        raise SyncError('{} files could not be synced'.format(
+            len(syncer.failed)))
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
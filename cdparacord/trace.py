@@ -0,0 +1,199 @@
+"""Timing what the rip pipeline spends its time on.
+
+A Tracer records a span for each stage of each track (and for each
+process run in it): when it started and ended, which track it was for,
+what command it ran and how that exited. The spans are written out as a
+Chrome trace (chrome://tracing or ui.perfetto.dev opens them) and as a
+short JSON summary per stage.
+
+When tracing is off a NullTracer stands in, whose spans do nothing.
+"""
+import json
+import os
+import os.path
+import time
+
+
+class _Span:
+    """Context manager recording one span into a Tracer."""
+    __slots__ = ('_tracer', '_stage', '_track', '_command', '_start',
+                 'status')
+
+    def __init__(self, tracer, stage, track, command):
+        self._tracer = tracer
+        self._stage = stage
+        self._track = track
+        self._command = command
+        # Exit status of the command, if there was one
+        self.status = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.perf_counter()
+        status = self.status
+        if exc_type is not None:
+            status = exc_type.__name__
+        self._tracer._record(
+            self._stage, self._track, self._command, self._start, end,
+            status)
+        return False
+
+
+class _NullSpan:
+    """A span that records nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    # Setting the status of a null span is fine and ignored
+    @property
+    def status(self):
+        return None
+
+    @status.setter
+    def status(self, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTracer:
+    """A tracer that doesn't trace."""
+    enabled = False
+
+    def span(self, stage, *, track=None, command=None):
+        return _NULL_SPAN
+
+    def write(self, directory, name):
+        pass
+
+
+class Tracer:
+    """Collects spans of the pipeline.
+
+    Use span as a context manager around whatever should be timed, and
+    set the status of the span to the exit status of the process run in
+    it, if any. Spans that end in an exception get the name of the
+    exception as their status.
+
+    Each listener is called with every span as it ends.
+    """
+    enabled = True
+
+    def __init__(self, listeners=()):
+        self._origin = time.perf_counter()
+        self._events = []
+        self._listeners = list(listeners)
+
+    @property
+    def events(self):
+        """Return the recorded spans as dicts, in the order they ended."""
+        return self._events
+
+    def span(self, stage, *, track=None, command=None):
+        return _Span(self, stage, track, command)
+
+    def _record(self, stage, track, command, start, end, status):
+        event = {
+            'stage': stage,
+            'track': track,
+            'command': command,
+            'start': start - self._origin,
+            'end': end - self._origin,
+            'status': status
+        }
+        self._events.append(event)
+        for listener in self._listeners:
+            listener(event)
+
+    def chrome_trace(self):
+        """Return the spans in Chrome's trace event format."""
+        events = []
+        for event in self._events:
+            args = {}
+            if event['command'] is not None:
+                args['command'] = event['command']
+            if event['status'] is not None:
+                args['status'] = event['status']
+            name = event['stage']
+            if event['command'] is not None:
+                name = '{} {}'.format(name, event['command'])
+            events.append({
+                'name': name,
+                'cat': event['stage'],
+                'ph': 'X',
+                # Microseconds
+                'ts': round(event['start'] * 1e6),
+                'dur': round((event['end'] - event['start']) * 1e6),
+                'pid': 1,
+                # Each track gets its own row; the rest share row 0
+                'tid': event['track'] or 0,
+                'args': args
+            })
+        # Name the rows so the viewer doesn't just show numbers
+        for tid in sorted({e['tid'] for e in events}):
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                'args': {'name': 'track {}'.format(tid) if tid else 'disc'}
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self):
+        """Return time spent per stage and in total.
+
+        Stage times are sums over tracks, so with tracks overlapping
+        they can add up to more than the wall time.
+        """
+        stages = {}
+        for event in self._events:
+            duration = event['end'] - event['start']
+            stage = stages.setdefault(event['stage'], {
+                'count': 0, 'total': 0.0, 'max': 0.0, 'failed': 0})
+            stage['count'] += 1
+            stage['total'] += duration
+            stage['max'] = max(stage['max'], duration)
+            if event['status'] not in (None, 0):
+                stage['failed'] += 1
+        for stage in stages.values():
+            stage['mean'] = stage['total'] / stage['count']
+
+        wall = max((e['end'] for e in self._events), default=0.0)
+        return {'wall': wall, 'stages': stages}
+
+    def write(self, directory, name):
+        """Write <name>-trace.json and <name>-summary.json."""
+        os.makedirs(directory, exist_ok=True)
+        for suffix, data in (('trace', self.chrome_trace()),
+                             ('summary', self.summary())):
+            filename = os.path.join(
+                directory, '{}-{}.json'.format(name, suffix))
+            with open(filename, 'w') as f:
+                json.dump(data, f, indent=1)
+        print('Wrote trace to {}'.format(os.path.join(
+            directory, '{}-trace.json'.format(name))))
+
+
+def tracer_from_config(config, listeners=()):
+    """Return a Tracer if tracing is on, otherwise a NullTracer.
+
+    Spans are also traced if there are listeners for them.
+    """
+    if config.get('trace_dir') or listeners:
+        return Tracer(listeners)
+    return NullTracer()
+
+
+def trace_directory(config, ripdir):
+    """Return the directory traces should be written to."""
+    setting = config.get('trace_dir')
+    if setting == 'ripdir':
+        return ripdir
+    return os.path.expanduser(setting)
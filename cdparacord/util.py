@@ -0,0 +1,55 @@
+"""Helpers shared by the command line tools."""
+import asyncio
+import mutagen
+import os
+import os.path
+from .error import CdparacordError
+
+
+class ProcessError(CdparacordError):
+    pass
+
+
+# The tags carried over from a file to what it's transcoded into
+TAGS = ('artist', 'album', 'albumartist', 'title', 'tracknumber', 'date',
+        'discnumber')
+
+
+def read_tags(filename):
+    """Return the tags of a file that are carried over, as strings."""
+    audiofile = mutagen.File(filename, easy=True)
+    if audiofile is None or audiofile.tags is None:
+        return {}
+    return {key: audiofile[key][0] for key in TAGS
+            if key in audiofile and audiofile[key]}
+
+
+def find_sources(archive, extension):
+    """Yield the files under archive with extension, relative to it.
+
+    The directory tree is walked lazily and in order, so a huge archive
+    doesn't have to be listed up front.
+    """
+    suffix = '.' + extension.lower()
+    for directory, dirnames, filenames in os.walk(archive):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(suffix):
+                yield os.path.relpath(
+                    os.path.join(directory, name), archive)
+
+
+async def run_process(executable, args, what):
+    """Run a process, raising ProcessError if it fails.
+
+    Its output is only shown if it fails; with several running at once
+    it would be unreadable otherwise. what says what the process was
+    doing, for the error.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        executable, *args, stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE)
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise ProcessError('{} failed:\n{}'.format(
+            what, stderr.decode(errors='replace').strip()))
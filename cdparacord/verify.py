@@ -0,0 +1,121 @@
+"""Checking that lossless encodes decode back to what was ripped.
+
+The PCM of the ripped wav is hashed, the encoded file decoded into a
+pipe and the PCM coming out of it hashed as it arrives, so nothing is
+decoded onto the disk. Only the PCM is hashed; WAV headers written by
+different tools differ even when the audio doesn't.
+"""
+import asyncio
+import hashlib
+import struct
+from . import analysis
+from .error import CdparacordError
+
+
+class VerifyError(CdparacordError):
+    pass
+
+
+HASH = 'sha256'
+_CHUNK = 1024 * 1024
+
+
+def hash_wav(filename):
+    """Return the hash of the PCM of a WAV file."""
+    offset, length = analysis.find_pcm(filename)
+    digest = hashlib.new(HASH)
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(_CHUNK, length))
+            if not data:
+                break
+            digest.update(data)
+            length -= len(data)
+    return digest.hexdigest()
+
+
+class WavStreamHasher:
+    """Hashes the PCM of a WAV file that's fed in in pieces.
+
+    A WAV written into a pipe can't have its sizes filled in afterwards,
+    so a data chunk claiming to be empty or as big as possible is taken
+    to go on until the end of the stream.
+    """
+    def __init__(self):
+        self._digest = hashlib.new(HASH)
+        self._buffer = b''
+        # Bytes of PCM left, None until the data chunk is found
+        self._remaining = None
+        self._header_done = False
+
+    def _parse_header(self):
+        """Find the data chunk in what has been buffered so far."""
+        if not self._header_done:
+            if len(self._buffer) < 12:
+                return
+            if (self._buffer[0:4] != b'RIFF'
+                    or self._buffer[8:12] != b'WAVE'):
+                raise VerifyError('The decoder did not write a WAV file')
+            self._buffer = self._buffer[12:]
+            self._header_done = True
+        while self._remaining is None and len(self._buffer) >= 8:
+            chunk_id, size = struct.unpack('<4sI', self._buffer[:8])
+            if chunk_id == b'data':
+                self._buffer = self._buffer[8:]
+                if size in (0, 0xffffffff):
+                    self._remaining = float('inf')
+                else:
+                    self._remaining = size
+                return
+            skip = 8 + size + size % 2
+            if len(self._buffer) < skip:
+                return
+            self._buffer = self._buffer[skip:]
+
+    def update(self, data):
+        if self._remaining is None:
+            self._buffer += data
+            self._parse_header()
+            if self._remaining is None:
+                return
+            data = self._buffer
+            self._buffer = b''
+        if self._remaining < len(data):
+            data = data[:int(self._remaining)]
+        self._remaining -= len(data)
+        self._digest.update(data)
+
+    def hexdigest(self):
+        if self._remaining is None:
+            raise VerifyError('The decoder wrote no audio')
+        return self._digest.hexdigest()
+
+
+async def hash_decoded(executable, args):
+    """Run a decoder that writes a WAV file on stdout and hash its PCM.
+
+    Raises VerifyError if the decoder fails.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        executable, *args, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    hasher = WavStreamHasher()
+    # Read stderr alongside so a chatty decoder can't fill the pipe
+    stderr = asyncio.ensure_future(proc.stderr.read())
+    try:
+        while True:
+            data = await proc.stdout.read(_CHUNK)
+            if not data:
+                break
+            hasher.update(data)
+    except VerifyError:
+        proc.kill()
+        raise
+    finally:
+        await proc.wait()
+        errors = await stderr
+    if proc.returncode != 0:
+        raise VerifyError('Decoding failed:\n{}'.format(
+            errors.decode(errors='replace').strip()))
+    return hasher.hexdigest()
@@ -7,5 +7,11 @@ import os
 XDG_CONFIG_HOME = (os.environ.get('XDG_CONFIG_HOME') or
     os.path.join(os.environ['HOME'], '.config'))
 
+XDG_CACHE_HOME = (os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.environ['HOME'], '.cache'))
+
+XDG_DATA_HOME = (os.environ.get('XDG_DATA_HOME') or
+    os.path.join(os.environ['HOME'], '.local', 'share'))
+
 XDG_MUSIC_DIR = (os.environ.get('XDG_MUSIC_DIR') or
     os.path.join(os.environ['HOME'], 'Music'))
@@ -45,13 +45,21 @@ setup(
         'PyYAML>=3.12',
         'click>=6.7'
     ],
+    extras_require={
+        'analysis': ['numpy>=1.13']
+    },
 
     package_data={},
     data_files=[],
 
     entry_points={
         'console_scripts': [
-            'cdparacord=cdparacord.main:main'
+            'cdparacord=cdparacord.main:main',
+            'cdparacord-reencode=cdparacord.reencode:main',
+            'cdparacord-sync=cdparacord.sync:main',
+            'cdparacord-retag=cdparacord.retag:main',
+            'cdparacord-relocate=cdparacord.relocate:main',
+            'cdparacord-library=cdparacord.library:main'
         ]
     }
 )
@@ -0,0 +1,84 @@
+"""Tests for the accounting module."""
+
+import pytest
+import asyncio
+from cdparacord import accounting
+
+
+class FakeRusage:
+    def __init__(self, utime, stime, maxrss):
+        self.ru_utime = utime
+        self.ru_stime = stime
+        self.ru_maxrss = maxrss
+        self.ru_inblock = 2048
+        self.ru_oublock = 4096
+
+
+def test_run():
+    acct = accounting.Accounting()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Burn a bit of CPU so there's something to see
+    status = loop.run_until_complete(acct.run(
+        'encode', 'sh', ['sh', '-c', 'i=0; while [ $i -lt 20000 ]; '
+                         'do i=$((i+1)); done']))
+    assert status == 0
+    assert loop.run_until_complete(
+        acct.run('encode', 'sh', ['sh', '-c', 'exit 3'])) == 3
+    assert loop.run_until_complete(
+        acct.run('rip', 'sh', ['sh', '-c', 'kill -9 $$'])) == -9
+    loop.close()
+
+    encode = acct.stages['encode']
+    assert encode.runs == 2
+    assert encode.cpu > 0
+    assert encode.maxrss > 0
+    assert acct.tools['sh'].runs == 3
+
+
+def test_run_missing():
+    acct = accounting.Accounting()
+    loop = asyncio.new_event_loop()
+    with pytest.raises(FileNotFoundError):
+        loop.run_until_complete(acct.run(
+            'encode', 'x', ['cdparacord-nonexistent-command']))
+    loop.close()
+
+
+def test_run_own_thread():
+    """A busy default executor doesn't hold accounted processes up."""
+    import concurrent.futures
+    import threading
+    acct = accounting.Accounting()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(1))
+    release = threading.Event()
+    blocked = loop.run_in_executor(None, release.wait, 10)
+
+    async def run():
+        status = await acct.run('encode', 'sh', ['sh', '-c', 'exit 0'])
+        # Only now let the executor go
+        release.set()
+        return status
+
+    assert loop.run_until_complete(run()) == 0
+    loop.run_until_complete(blocked)
+    loop.close()
+
+
+def test_report(monkeypatch):
+    clock = iter([0.0, 100.0])
+    monkeypatch.setattr('time.perf_counter', lambda: next(clock))
+    acct = accounting.Accounting()
+    acct.record('rip', 'cdparanoia', 80.0, FakeRusage(1.0, 2.0, 4096))
+    acct.record('encode', 'lame', 30.0, FakeRusage(27.0, 0.0, 10240))
+    acct.record('encode', 'lame', 30.0, FakeRusage(27.0, 1.0, 2048))
+
+    report = acct.report()
+    lines = report.split('\n')
+    assert lines[0].split()[:2] == ['Stage', 'runs']
+    assert lines[1].split() == [
+        'encode', '2', '60.00', '54.00', '1.00', '10.0', '2.0', '4.0']
+    assert 'Drive busy 80% of 100.0s' in report
+    assert 'Encoder CPU efficiency 92%, 0.55 cores busy' in report
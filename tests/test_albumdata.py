@@ -335,6 +335,44 @@ TOTAL   1150 [00:11.50]        (audio only)
     assert albumdata.Albumdata._get_track_count('') == 1
 
 
+def test_get_toc(monkeypatch, albumdata):
+    """Test TOC parsing with a fake cdparanoia output with a pregap."""
+    testdata = """\
+cdparanoia III release 10.2 (September 11, 2008)
+
+
+Table of contents (audio tracks only):
+track        length               begin        copy pre ch
+===========================================================
+  1.    1000 [00:13.25]       3000 [00:40.00]    no   no  2
+  2.    2000 [00:26.50]       4000 [00:53.25]    no   no  2
+TOTAL   3000 [00:40.00]        (audio only)
+"""
+    class FakeProcess:
+        def check_returncode(self):
+            pass
+
+        @property
+        def stdout(self):
+            return testdata
+
+    obj = FakeProcess()
+    monkeypatch.setattr('subprocess.run', lambda *x, **y: obj)
+    assert albumdata.Albumdata._get_toc('') == [(3000, 1000), (4000, 2000)]
+
+
+def test_track_analysis(albumdata):
+    """Test that analysis is recorded in the track data."""
+    trackdata = copy.deepcopy(testdata['tracks'][0])
+    t = albumdata.Track(trackdata)
+    assert t.analysis is None
+
+    analysis = {'frames': 1000, 'audio_start': 0, 'audio_end': 588}
+    t.record_analysis(analysis)
+    assert t.analysis == analysis
+    assert trackdata['analysis'] == analysis
+
+
 def test_get_no_track_count(monkeypatch, albumdata):
     """Test track count getting with empty cdparanoia output."""
     class FakeProcess:
@@ -546,7 +584,7 @@ def test_no_previous_result(monkeypatch, albumdata):
 def test_from_user_input(monkeypatch, albumdata):
     monkeypatch.setattr('discid.read', lambda: 'test')
     monkeypatch.setattr('os.getuid', lambda: 1000)
-    monkeypatch.setattr('cdparacord.albumdata.Albumdata._get_track_count', lambda *x: 1)
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._get_toc', lambda *x: [(0, 1000)])
     monkeypatch.setattr('cdparacord.albumdata.Albumdata._albumdata_from_previous_rip', lambda *x: testdata)
     monkeypatch.setattr('cdparacord.albumdata.Albumdata._albumdata_from_musicbrainz', lambda *x: [])
     monkeypatch.setattr('cdparacord.albumdata.Albumdata._select_albumdata', lambda *x: None)
@@ -563,7 +601,8 @@ def test_from_user_input(monkeypatch, albumdata):
 
     class FakeConfig:
         def __init__(self):
-            self.dict = {'use_musicbrainz': True, 'reuse_albumdata': True }
+            self.dict = {'use_musicbrainz': True, 'reuse_albumdata': True,
+                         'wav_dir': 'ripdir'}
 
         def get(self, a):
             return self.dict[a]
@@ -592,11 +631,87 @@ def test_from_user_input(monkeypatch, albumdata):
     # It's plausible that we would get None here
     config.dict['use_musicbrainz'] = False
     config.dict['reuse_albumdata'] = True
-    monkeypatch.setattr('cdparacord.albumdata.Albumdata._get_track_count', lambda *x: None)
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._get_toc', lambda *x: None)
     with pytest.raises(albumdata.AlbumdataError):
         albumdata.Albumdata.from_user_input(deps, config)
 
 
+def test_from_user_input_image(monkeypatch, albumdata):
+    """Test that an image is used instead of the drive."""
+    selected = []
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._select_albumdata',
+        lambda results: selected.extend(results))
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._edit_albumdata', lambda *x: None)
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._generate_filename', lambda *x: 'file')
+
+    class FakeDeps:
+        editor = None
+
+        @property
+        def cdparanoia(self):
+            raise AssertionError('The drive should not be touched')
+
+    class FakeConfig:
+        def get(self, a):
+            return {'use_musicbrainz': False, 'reuse_albumdata': False,
+                    'wav_dir': 'ripdir'}[a]
+
+    class FakeImage:
+        filename = 'disc.cue'
+        discid = 'imagediscid'
+        toc = [(10, 100), (110, 50)]
+
+    assert albumdata.Albumdata.from_user_input(
+        FakeDeps(), FakeConfig(), disc_image=FakeImage()) is None
+    assert selected[0]['discid'] == 'imagediscid'
+    assert selected[0]['toc'] == [[10, 100], [110, 50]]
+    assert selected[0]['pregap'] == 10
+    assert selected[0]['image'] == os.path.abspath('disc.cue')
+
+
+def test_from_user_input_drop_image(monkeypatch, albumdata):
+    """Test that a drive rip doesn't reuse the image of a previous rip."""
+    selected = []
+    previous = copy.deepcopy(testdata)
+    previous['tracks'] = previous['tracks'][:1]
+    previous['image'] = '/old/disc.cue'
+    monkeypatch.setattr('discid.read', lambda: 'test')
+    monkeypatch.setattr('os.getuid', lambda: 1000)
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._get_toc', lambda *x: [(0, 1000)])
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._albumdata_from_previous_rip', lambda *x: previous)
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._select_albumdata',
+        lambda results: selected.extend(results))
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._edit_albumdata', lambda *x: None)
+    monkeypatch.setattr('cdparacord.albumdata.Albumdata._generate_filename', lambda *x: 'file')
+
+    class FakeDeps:
+        editor = None
+        cdparanoia = None
+
+    class FakeConfig:
+        def get(self, a):
+            return {'use_musicbrainz': False, 'reuse_albumdata': True,
+                    'wav_dir': 'ripdir'}[a]
+
+    assert albumdata.Albumdata.from_user_input(FakeDeps(), FakeConfig()) is None
+    assert selected[0] is previous
+    assert 'image' not in selected[0]
+
+
+def test_from_library(albumdata):
+    """Test that stored albumdata is named for the current config."""
+    class FakeConfig:
+        def get(self, a):
+            return {'wav_dir': 'ripdir', 'safetyfilter': 'remove_restricted',
+                    'target_template': '/music/${album}/${tracknumber}.flac'}[a]
+
+    a = albumdata.Albumdata.from_library(testdata, FakeConfig())
+    assert a.tracks[0].filename == '/music/Test album/01.flac'
+    assert a.ripdir == a.wavdir != testdata['ripdir']
+    # What was given isn't changed
+    assert testdata['tracks'][0]['filename'].endswith('.mp3')
+
+
 def test_edit_albumdata(monkeypatch, albumdata):
     """Test _edit_albumdata."""
     @contextlib.contextmanager
@@ -0,0 +1,107 @@
+"""Tests for the analysis module."""
+
+import pytest
+import struct
+import wave
+from cdparacord import analysis
+
+numpy = pytest.importorskip('numpy')
+
+
+def write_wav(filename, silence_before, audio, silence_after):
+    """Write a CD audio wav with a square wave between two silences.
+
+    All lengths are in frames.
+    """
+    with wave.open(filename, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(b'\0' * 4 * silence_before)
+        w.writeframes(struct.pack('<hh', 10000, -10000) * audio)
+        w.writeframes(b'\0' * 4 * silence_after)
+
+
+def test_analyse_wav(tmpdir):
+    """Find leading and trailing silence."""
+    filename = str(tmpdir.join('1.wav'))
+    write_wav(filename, 588 * 10, 588 * 100, 588 * 20 + 7)
+
+    result = analysis.analyse_wav(filename)
+    assert result['frames'] == 588 * 130 + 7
+    assert result['audio_start'] == 588 * 10
+    assert result['audio_end'] == 588 * 110
+
+
+def test_analyse_wav_no_silence(tmpdir):
+    """Audio that runs all the way to the end of a partial window."""
+    filename = str(tmpdir.join('1.wav'))
+    write_wav(filename, 0, 1000, 0)
+
+    result = analysis.analyse_wav(filename)
+    assert result == {'frames': 1000, 'audio_start': 0, 'audio_end': 1000}
+
+
+def test_analyse_wav_silent(tmpdir):
+    """A silent track has no audio at all."""
+    filename = str(tmpdir.join('1.wav'))
+    write_wav(filename, 588 * 5, 0, 0)
+
+    result = analysis.analyse_wav(filename)
+    assert result == {'frames': 588 * 5, 'audio_start': 0, 'audio_end': 0}
+
+
+def test_analyse_wav_threshold(tmpdir):
+    """Quiet audio counts as silence only under the threshold."""
+    filename = str(tmpdir.join('1.wav'))
+    with wave.open(filename, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        # Roughly -70 dBFS
+        w.writeframes(struct.pack('<hh', 10, -10) * 588 * 3)
+
+    assert analysis.analyse_wav(filename)['audio_end'] == 588 * 3
+    assert analysis.analyse_wav(filename, threshold=-60)['audio_end'] == 0
+
+
+def test_analyse_long_track(tmpdir, monkeypatch):
+    """Silence spanning several chunks is found from both ends."""
+    monkeypatch.setattr('cdparacord.analysis._WINDOWS_PER_CHUNK', 4)
+    filename = str(tmpdir.join('1.wav'))
+    write_wav(filename, 588 * 9, 588 * 3, 588 * 13)
+
+    result = analysis.analyse_wav(filename)
+    assert result['audio_start'] == 588 * 9
+    assert result['audio_end'] == 588 * 12
+
+
+def test_not_a_wav(tmpdir):
+    filename = str(tmpdir.join('1.wav'))
+    with open(filename, 'wb') as f:
+        f.write(b'this is not a wav file')
+
+    with pytest.raises(analysis.AnalysisError):
+        analysis.analyse_wav(filename)
+
+
+def test_wrong_format(tmpdir):
+    filename = str(tmpdir.join('1.wav'))
+    with wave.open(filename, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(b'\0' * 100)
+
+    with pytest.raises(analysis.AnalysisError):
+        analysis.analyse_wav(filename)
+
+
+def test_sector_span():
+    """Sector span is widened to whole sectors."""
+    assert analysis.sector_span(
+        {'frames': 588 * 10, 'audio_start': 600, 'audio_end': 588 * 3 + 1}
+    ) == (1, 3)
+    assert analysis.sector_span(
+        {'frames': 588 * 10, 'audio_start': 0, 'audio_end': 588 * 10}
+    ) == (0, 9)
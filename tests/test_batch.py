@@ -0,0 +1,65 @@
+"""Tests for the batch module."""
+import asyncio
+import pytest
+from cdparacord import batch
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+def run_batches(loop, items, delays=None, **kwargs):
+    """Submit items, each after its delay, and return the batches run."""
+    batches = []
+
+    async def run(batch_items):
+        batches.append(batch_items)
+        if 'fail' in batch_items:
+            raise ValueError('fail')
+
+    b = batch.Batch(run, **kwargs)
+
+    async def submit(item, delay):
+        await asyncio.sleep(delay)
+        await b.submit(item)
+        return item
+
+    results = loop.run_until_complete(asyncio.gather(*[
+        submit(item, delay) for item, delay in zip(
+            items, delays or [0] * len(items))], return_exceptions=True))
+    return batches, results
+
+
+def test_size(loop):
+    # The last one waits for the timeout
+    batches, results = run_batches(
+        loop, list(range(5)), size=2, timeout=0.05)
+    assert batches == [[0, 1], [2, 3], [4]]
+    assert results == list(range(5))
+
+
+def test_expected(loop):
+    # Nothing waits for the timeout once everything is in
+    start = loop.time()
+    batches, results = run_batches(
+        loop, list(range(5)), size=2, timeout=10, expected=5)
+    assert batches == [[0, 1], [2, 3], [4]]
+    assert loop.time() - start < 5
+
+
+def test_timeout(loop):
+    batches, results = run_batches(
+        loop, ['a', 'b', 'c'], [0, 0, 0.2], size=10, timeout=0.05)
+    assert batches == [['a', 'b'], ['c']]
+
+
+def test_failure(loop):
+    batches, results = run_batches(
+        loop, ['a', 'fail', 'b'], size=2, timeout=10, expected=3)
+    assert batches == [['a', 'fail'], ['b']]
+    # Everything in the failed batch fails with it
+    assert [type(r) for r in results] == [ValueError, ValueError, str]
@@ -0,0 +1,55 @@
+"""Tests for the pipeline benchmark, so it doesn't rot."""
+
+import pytest
+import importlib.util
+import os.path
+
+
+@pytest.fixture
+def benchmark():
+    spec = importlib.util.spec_from_file_location(
+        'pipeline_benchmark', os.path.join(
+            os.path.dirname(__file__), os.pardir, 'benchmarks',
+            'pipeline.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+
+
+def test_run_shape(benchmark):
+    result = benchmark.run_shape(
+        2, 3, rip_latency=0.01, encode_latency=0, wav_bytes=2352)
+    assert result['tracks'] == 6
+    # Six rips of at least 10 ms each
+    assert result['drive_busy'] >= 0.06
+    assert 0 <= result['drive_idle'] < result['wall']
+
+
+def test_compare(benchmark):
+    old = {'shapes': {'album': {'wall': 2.0, 'drive_idle': 0.0,
+                                'cpu_self': 1.0}}}
+    new = {'shapes': {'album': {'wall': 1.0, 'drive_idle': 0.5,
+                                'cpu_self': 1.5},
+                      'box-set': {'wall': 1.0, 'drive_idle': 0.5,
+                                  'cpu_self': 1.5}}}
+    lines = benchmark.compare(old, new)
+    assert len(lines) == 2
+    assert lines[1].split() == ['album', '-50.0%', 'n/a', '+50.0%']
+
+
+@pytest.fixture
+def encoder_benchmark():
+    spec = importlib.util.spec_from_file_location(
+        'encoder_benchmark', os.path.join(
+            os.path.dirname(__file__), os.pardir, 'benchmarks',
+            'encoders.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+
+
+def test_encoder_pairs(encoder_benchmark):
+    results = encoder_benchmark.run(['wav'], 1, tracks=2, seconds=0.1,
+                                    jobs=2)
+    assert sorted(results['backends']) == ['wav-command', 'wav-python']
+    assert all(r['wall'] > 0 for r in results['backends'].values())
@@ -0,0 +1,86 @@
+"""Tests for the command module."""
+import pytest
+from cdparacord import command
+
+
+@pytest.mark.parametrize('arg,expected', [
+    # The whole argument
+    ('${one_file}', 'in.wav'),
+    ('$one_file', 'in.wav'),
+    # At the start, in the middle and at the end
+    ('${one_file}.bak', 'in.wav.bak'),
+    ('--in=${one_file},fast', '--in=in.wav,fast'),
+    ('--in=${one_file}', '--in=in.wav'),
+    ('--in=$one_file', '--in=in.wav'),
+    # Next to each other and more than once
+    ('${one_file}${out_file}', 'in.wavout.mp3'),
+    ('${one_file}:${one_file}', 'in.wav:in.wav'),
+    ('$one_file-$out_file', 'in.wav-out.mp3'),
+    # Extras
+    ('--skip=${audio_start}-${audio_end}', '--skip=588-1176'),
+    # Nothing to expand
+    ('-V2', '-V2'),
+    ('', ''),
+    ('$$one_file', '$one_file'),
+    ('100$$', '100$'),
+])
+def test_expand_positions(arg, expected):
+    parsed = command.Command([arg])
+    assert parsed.expand(
+        'in.wav', out_file='out.mp3',
+        extra={'audio_start': '588', 'audio_end': '1176'}) == [expected]
+
+
+@pytest.mark.parametrize('args,expected', [
+    (['${all_files}'], ['a', 'b']),
+    (['$all_files'], ['a', 'b']),
+    (['${all_files}', '-s'], ['a', 'b', '-s']),
+    (['-s', '${all_files}', '-f'], ['-s', 'a', 'b', '-f']),
+    (['-s', '${all_files}'], ['-s', 'a', 'b']),
+    (['${all_files}', '${one_file}'], ['a', 'b', 'x']),
+])
+def test_expand_all_files(args, expected):
+    parsed = command.Command(args)
+    assert parsed.takes_all_files
+    assert parsed.expand('x', all_files=['a', 'b']) == expected
+    assert parsed.expand('x', all_files=[]) == [
+        arg for arg in expected if arg not in ('a', 'b')]
+
+
+def test_placeholders():
+    parsed = command.Command(
+        ['-V2', '${one_file}', '--x=$out_file', '$$audio_end',
+         '${audio_start}'])
+    assert parsed.placeholders == {'one_file', 'out_file', 'audio_start'}
+    assert not parsed.takes_all_files
+    parsed.check(command.ENCODER, 'The encoder')
+    with pytest.raises(command.CommandError, match='out_file'):
+        parsed.check(command.POST_TASK, 'post_encode task x')
+    with pytest.raises(command.CommandError, match=r'\$\{oen_file\}'):
+        command.Command(['${oen_file}']).check(
+            command.PLACEHOLDERS, 'The encoder')
+
+
+def test_invalid():
+    with pytest.raises(command.CommandError):
+        command.Command(['${one_file'])
+    with pytest.raises(command.CommandError):
+        command.Command(['100$'])
+    # It has to be an argument of its own
+    with pytest.raises(command.CommandError):
+        command.Command(['--files=${all_files}'])
+
+
+def test_missing_values():
+    with pytest.raises(command.CommandError):
+        command.Command(['${out_file}']).expand('in.wav')
+    with pytest.raises(command.CommandError):
+        command.Command(['${all_files}']).expand('in.wav')
+    with pytest.raises(command.CommandError):
+        command.Command(['${audio_start}']).expand('in.wav')
+
+
+def test_parse_once():
+    args = ['${one_file}', '${out_file}']
+    assert command.parse(args) is command.parse(list(args))
+    assert command.parse(args).expand('a', out_file='b') == ['a', 'b']
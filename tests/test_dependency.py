@@ -19,15 +19,31 @@ def mock_config_external():
         def __init__(self, param):
             self.param = param
             self.encoder = {self.param: []}
+            self.decoder = {self.param: []}
             self.post = [{self.param: []}]
+            self.storage = {'backend': 'local'}
+            self.fingerprint = False
+            self.fingerprint_reuse = None
+            self.verify_lossless = False
+            self.verify_decoder = {self.param: ['${one_file}']}
+            self.on_duplicate = 'ask'
+            self.on_duplicate_unattended = 'skip'
 
         def get(self, name):
             # Maybe we should write a fake config file but there are
             # Huge issues with mocking the config module...
             if name == 'encoder':
                 return self.encoder
+            if name == 'decoder':
+                return self.decoder
             if name in ('post_rip', 'post_encode', 'post_finished'):
                 return self.post
+            if name == 'storage':
+                return self.storage
+            if name in ('fingerprint', 'fingerprint_reuse',
+                        'verify_lossless', 'verify_decoder',
+                        'on_duplicate', 'on_duplicate_unattended'):
+                return getattr(self, name)
             return self.param
     return MockConfig
 
@@ -94,6 +110,21 @@ def test_get_cdparanoia(mock_external_encoder):
     # It's an absolute path so the value should be the same
     assert deps.cdparanoia == mock_external_encoder.param
 
+def test_decoder(mock_external_encoder):
+    """Without ripping, the decoder is found instead of cdparanoia."""
+
+    deps = Dependency(mock_external_encoder)
+    assert deps.decoder is None
+
+    deps = Dependency(mock_external_encoder, ripping=False)
+    assert deps.decoder == mock_external_encoder.param
+    assert deps.cdparanoia is None
+
+    mock_external_encoder.decoder = {'cdparacord-nonexistent-command': []}
+    with pytest.raises(DependencyError):
+        Dependency(mock_external_encoder, ripping=False)
+
+
 def test_verify_action_params(mock_external_encoder):
     """Ensure encoder and post-action parameter verification works."""
 
@@ -123,3 +154,147 @@ def test_verify_action_params(mock_external_encoder):
     # Test valid
     deps._verify_action_params({'valid': ['totally', 'valid']})
 
+
+def test_storage_commands(mock_external_encoder):
+    """Command storage needs a put command that exists."""
+    conf = mock_external_encoder
+
+    conf.storage = 'local'
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+    conf.storage = {'backend': 'command'}
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+    conf.storage = {'backend': 'command',
+                    'put': {'cdparacord-nonexistent-command': []}}
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+    conf.storage = {'backend': 'command', 'put': {conf.param: []},
+                    'get': {conf.param: 'not a list'}}
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+
+def test_fingerprint(mock_external_encoder):
+    """Fingerprinting needs a valid way of reusing files."""
+    conf = mock_external_encoder
+    conf.fingerprint = True
+    conf.fingerprint_reuse = 'hardlink'
+    Dependency(conf)
+
+    conf.fingerprint_reuse = 'symlink'
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+    # Only ripping fingerprints
+    Dependency(conf, ripping=False)
+
+
+def test_on_duplicate(mock_external_encoder):
+    """There's nobody to ask when unattended."""
+    conf = mock_external_encoder
+    conf.on_duplicate_unattended = 'reencode'
+    Dependency(conf)
+
+    conf.on_duplicate_unattended = 'ask'
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+    conf.on_duplicate_unattended = 'skip'
+    conf.on_duplicate = 'maybe'
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+    Dependency(conf, ripping=False)
+
+
+def test_verify_lossless(mock_external_encoder):
+    """Verifying needs its decoder and an encoder that keeps it all."""
+    conf = mock_external_encoder
+    conf.verify_lossless = True
+    deps = Dependency(conf)
+    assert deps.verify_decoder == conf.param
+
+    conf.verify_decoder = {'cdparacord-no-such-decoder': []}
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+    # Only ripping verifies
+    assert Dependency(conf, ripping=False).verify_decoder is None
+
+    conf.verify_decoder = {conf.param: []}
+    conf.encoder = {conf.param: ['--skip=${audio_start}']}
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+
+def test_python_tasks(mock_external_encoder):
+    """Python tasks are imported instead of looked for in $PATH."""
+    conf = mock_external_encoder
+    conf.post = [{'python': 'os.path:basename'}]
+    import os.path
+    assert Dependency(conf).plugin('os.path:basename') is os.path.basename
+
+    conf.post = [{'python': 'os.path:no_such_function'}]
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+
+def test_python_encoder(mock_external_encoder, monkeypatch):
+    """A Python encoder isn't an executable, but may need modules."""
+    from cdparacord import encoders
+    conf = mock_external_encoder
+    conf.encoder = {'python': 'cdparacord.encoders:wav'}
+    deps = Dependency(conf)
+    assert deps.encoder is None
+    assert deps.plugin('cdparacord.encoders:wav') is encoders.wav
+
+    monkeypatch.setitem(encoders.REQUIREMENTS, encoders.wav,
+                        ('cdparacord_no_such_module',))
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+
+def test_batched_encoder(mock_external_encoder):
+    """An encoder taking ${all_files} can't have per-file arguments."""
+    conf = mock_external_encoder
+    conf.encoder = {conf.param: ['-s', '${all_files}']}
+    Dependency(conf)
+
+    conf.encoder = {conf.param: ['${all_files}', '-o', '${out_file}']}
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+
+def test_unknown_placeholders(mock_external_encoder):
+    """Placeholders a task can't have fail before anything is ripped."""
+    conf = mock_external_encoder
+    conf.encoder = {conf.param: ['${one_file}', '${out_flie}']}
+    with pytest.raises(DependencyError, match='out_flie'):
+        Dependency(conf)
+
+    conf.encoder = {conf.param: ['${one_file}', '${out_file}']}
+    conf.post = [{conf.param: ['${out_file}']}]
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+    conf.post = [{conf.param: ['--files=${all_files}']}]
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+
+def test_task_graph(mock_external_encoder):
+    """Post task graphs are checked before ripping."""
+    conf = mock_external_encoder
+    conf.post = [
+        {'name': 'a', 'run': {conf.param: ['${one_file}']}},
+        {'name': 'b', 'run': {'python': 'os.path:basename'},
+         'after': ['a'], 'resource': 'network'}]
+    Dependency(conf)
+
+    conf.post[0]['after'] = ['b']
+    with pytest.raises(DependencyError):
+        Dependency(conf)
+
+    conf.post = [{'name': 'a', 'run': {conf.param: ['${out_file}']}}]
+    with pytest.raises(DependencyError):
+        Dependency(conf)
@@ -0,0 +1,109 @@
+"""Tests for the encoders module."""
+import asyncio
+import pickle
+import pytest
+from cdparacord import analysis, encoders, image
+
+
+PCM = bytes(range(256)) * 40
+
+
+def write_wav(filename):
+    with open(filename, 'wb') as f:
+        f.write(image.wav_header(len(PCM)) + PCM)
+
+
+seen = []
+
+
+def remember(pcm, out_file, **kwargs):
+    seen.append((bytes(pcm), out_file, kwargs))
+
+
+def keep(pcm, **kwargs):
+    # Holding on to the PCM past the call mustn't break anything
+    seen.append(pcm)
+
+
+def export(pcm, **kwargs):
+    # A buffer made from the PCM itself, so the PCM can't be released
+    seen.append(pickle.PickleBuffer(pcm))
+
+
+def broken(**kwargs):
+    raise ValueError('broken')
+
+
+def test_from_config():
+    class FakeDeps:
+        encoder = '/usr/bin/lame'
+
+        def plugin(self, spec):
+            return remember
+
+    class FakeConfig:
+        def __init__(self, encoder):
+            self.encoder = encoder
+
+        def get(self, key):
+            return self.encoder
+
+    backend = encoders.from_config(
+        FakeConfig({'lame': ['${one_file}']}), FakeDeps())
+    assert not backend.in_process
+    assert (backend.executable, backend.name, backend.args) == (
+        '/usr/bin/lame', 'lame', ['${one_file}'])
+
+    backend = encoders.from_config(
+        FakeConfig({'python': 'test_encoders:remember'}), FakeDeps())
+    assert backend.in_process
+    assert backend.name == 'test_encoders:remember'
+
+
+def test_python_encoder(tmpdir):
+    wav = str(tmpdir.join('in.wav'))
+    write_wav(wav)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    del seen[:]
+
+    backend = encoders.PythonEncoder('remember', remember)
+    loop.run_until_complete(backend.encode(wav, 'out', extra={'a': '1'}))
+    assert seen == [(PCM, 'out', {'in_file': wav, 'extra': {'a': '1'}})]
+
+    loop.run_until_complete(
+        encoders.PythonEncoder('keep', keep).encode(wav, 'out'))
+    # PickleBuffer is new in Python 3.8
+    if hasattr(pickle, 'PickleBuffer'):
+        loop.run_until_complete(
+            encoders.PythonEncoder('export', export).encode(wav, 'out'))
+    with pytest.raises(encoders.EncoderError, match='broken'):
+        loop.run_until_complete(
+            encoders.PythonEncoder('broken', broken).encode(wav, 'out'))
+
+
+def test_wav(tmpdir):
+    out = str(tmpdir.join('out.wav'))
+    encoders.wav(memoryview(PCM), out)
+    offset, length = analysis.find_pcm(out)
+    with open(out, 'rb') as f:
+        f.seek(offset)
+        assert f.read(length) == PCM
+
+
+def test_flac(tmpdir):
+    numpy = pytest.importorskip('numpy')
+    soundfile = pytest.importorskip('soundfile')
+    out = str(tmpdir.join('out.flac'))
+    encoders.flac(memoryview(PCM), out)
+    data, rate = soundfile.read(out, dtype='int16')
+    assert rate == 44100
+    assert data.tobytes() == PCM
+
+
+def test_missing_modules(monkeypatch):
+    monkeypatch.setitem(
+        encoders.REQUIREMENTS, remember, ('os', 'cdparacord_no_such_module'))
+    assert encoders.missing_modules(remember) == [
+        'cdparacord_no_such_module']
+    assert encoders.missing_modules(broken) == []
@@ -0,0 +1,66 @@
+"""Tests for the fingerprint module."""
+
+import pytest
+from cdparacord import fingerprint, image
+
+numpy = pytest.importorskip('numpy')
+
+
+def make_song(seed, seconds=20):
+    """Make pcm of notes that change four times a second."""
+    rng = numpy.random.RandomState(seed)
+    t = numpy.arange(seconds * 44100) / 44100
+    signal = numpy.zeros(len(t))
+    note = 44100 // 4
+    for n in range(seconds * 4):
+        part = slice(n * note, (n + 1) * note)
+        for f in rng.uniform(200, 1800, 2):
+            signal[part] += numpy.sin(2 * numpy.pi * f * t[part])
+    signal += 0.05 * rng.standard_normal(len(t))
+    pcm = (signal / numpy.abs(signal).max() * 20000).astype('<i2')
+    return numpy.stack([pcm, pcm], axis=1)
+
+
+def write_wav(filename, pcm):
+    data = pcm.astype('<i2').tobytes()
+    with open(filename, 'wb') as f:
+        f.write(image.wav_header(len(data)) + data)
+
+
+def test_similarity():
+    song = make_song(1)
+    original = fingerprint.fingerprint_pcm(song)
+    assert len(original) == int(20 * fingerprint.frames_per_second()) - 8
+    assert original.dtype == numpy.uint32
+
+    # Started elsewhere, cut shorter and quieter
+    remastered = numpy.concatenate(
+        [numpy.zeros((12345, 2), dtype='<i2'), song[:-5000] // 2])
+    assert fingerprint.similarity(
+        original, fingerprint.fingerprint_pcm(remastered)) > 0.9
+    other = fingerprint.fingerprint_pcm(make_song(2))
+    assert fingerprint.similarity(original, other) < 0.6
+
+    assert fingerprint.best_match(
+        original, [('other', other), ('same', original)], 0.85) == (
+            'same', 1.0)
+    assert fingerprint.best_match(original, [('other', other)], 0.85) is None
+
+
+def test_fingerprint_wav(tmpdir):
+    song = make_song(3, seconds=10)
+    filename = str(tmpdir.join('track.wav'))
+    # The silence around it isn't part of the fingerprint
+    write_wav(filename, numpy.concatenate(
+        [numpy.zeros((44100, 2)), song, numpy.zeros((20000, 2))]))
+    duration, result = fingerprint.fingerprint_wav(filename)
+    assert duration == pytest.approx(10, abs=0.02)
+    assert fingerprint.similarity(
+        result, fingerprint.fingerprint_pcm(song)) > 0.95
+    assert (fingerprint.from_bytes(fingerprint.to_bytes(result))
+            == result).all()
+
+    write_wav(filename, numpy.zeros((44100, 2)))
+    duration, result = fingerprint.fingerprint_wav(filename)
+    assert duration == 0
+    assert fingerprint.similarity(result, result) == 0
@@ -0,0 +1,113 @@
+"""Tests for the graph module."""
+import asyncio
+import pytest
+from cdparacord import graph
+
+
+def names(tasks):
+    return [task.name for task in tasks]
+
+
+def test_old_style_is_a_chain():
+    tasks = graph.parse([{'a': []}, {'b': ['${one_file}']}], 'post_encode')
+    assert names(tasks) == ['post_encode task 1', 'post_encode task 2']
+    assert tasks[0].depends == frozenset()
+    assert tasks[1].depends == {'post_encode task 1'}
+    assert tasks[1].action == {'b': ['${one_file}']}
+    # Not limited, like before
+    assert tasks[0].resource is None
+    # An executable called run
+    assert not graph.is_declared({'run': ['${one_file}']})
+
+
+def test_declared():
+    tasks = graph.parse([
+        {'name': 'upload', 'run': {'scp': []}, 'inputs': ['sum'],
+         'after': ['gain'], 'resource': 'network'},
+        {'name': 'gain', 'run': {'mp3gain': []}},
+        {'name': 'sum', 'run': {'python': 'x:y'}, 'outputs': ['sum'],
+         'resource': 'io'},
+        {'name': 'other', 'run': {'true': []}}
+    ], 'post_encode')
+    by_name = {task.name: task for task in tasks}
+    assert by_name['upload'].depends == {'gain', 'sum'}
+    assert by_name['gain'].depends == frozenset()
+    assert by_name['gain'].resource == 'cpu'
+    assert by_name['sum'].resource == 'io'
+    # Everything comes after what it depends on
+    assert names(tasks).index('upload') > names(tasks).index('gain')
+    assert names(tasks).index('upload') > names(tasks).index('sum')
+
+
+@pytest.mark.parametrize('entries', [
+    [{'name': 'a', 'run': {'x': []}, 'after': ['b']}],
+    [{'name': 'a', 'run': {'x': []}, 'after': ['b']},
+     {'name': 'b', 'run': {'x': []}, 'after': ['a']}],
+    [{'name': 'a', 'run': {'x': []}, 'inputs': ['i'], 'outputs': ['o']},
+     {'name': 'b', 'run': {'x': []}, 'inputs': ['o'], 'outputs': ['i']}],
+    [{'name': 'a', 'run': {'x': []}}, {'name': 'a', 'run': {'x': []}}],
+    [{'name': 'a', 'run': {'x': []}, 'resource': 'gpu'}],
+    [{'name': 'a', 'run': {'x': []}, 'depends': ['b']}],
+    [{'name': 'a', 'run': {'x': []}, 'after': 'b'}],
+])
+def test_bad_graphs(entries):
+    with pytest.raises(graph.TaskGraphError):
+        graph.parse(entries, 'post_encode')
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+def test_run(loop):
+    tasks = graph.parse([
+        {'name': 'slow', 'run': {'x': []}},
+        {'name': 'fast', 'run': {'x': []}},
+        {'name': 'last', 'run': {'x': []}, 'after': ['slow', 'fast']}
+    ], 'post_encode')
+    log = []
+
+    async def run_task(task):
+        log.append(('start', task.name))
+        await asyncio.sleep(0.05 if task.name == 'slow' else 0)
+        log.append(('end', task.name))
+
+    loop.run_until_complete(graph.run(tasks, run_task))
+    # slow and fast overlap, last waits for both
+    assert log[:2] in ([('start', 'slow'), ('start', 'fast')],
+                       [('start', 'fast'), ('start', 'slow')])
+    assert log[-2:] == [('start', 'last'), ('end', 'last')]
+
+
+def test_run_failure(loop):
+    tasks = graph.parse([
+        {'name': 'broken', 'run': {'x': []}},
+        {'name': 'after', 'run': {'x': []}, 'after': ['broken']},
+        {'name': 'other', 'run': {'x': []}}
+    ], 'post_encode')
+    ran = []
+
+    async def run_task(task):
+        ran.append(task.name)
+        if task.name == 'broken':
+            raise ValueError('broken')
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(graph.run(tasks, run_task))
+    assert sorted(ran) == ['broken', 'other']
+
+
+def test_resources(loop):
+    lock = asyncio.Lock()
+    resources = graph.Resources({'io': 1, 'network': 3}, drive=lock)
+    assert resources.get(None) is None
+    assert resources.get('drive') is lock
+    network = resources.get('network')
+    for _ in range(3):
+        assert not network.locked()
+        loop.run_until_complete(network.acquire())
+    assert network.locked()
@@ -0,0 +1,148 @@
+"""Tests for the image module."""
+
+import pytest
+from cdparacord import analysis, image
+from cdparacord.placement import SECTOR_BYTES
+
+
+def sectors(value, count):
+    """Return count sectors filled with the byte value."""
+    return bytes([value]) * (SECTOR_BYTES * count)
+
+
+def read_wav(filename):
+    offset, length = analysis.find_pcm(filename)
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def test_parse_timestamp():
+    assert image._parse_timestamp('00:00:00') == 0
+    assert image._parse_timestamp('01:02:03') == (62 * 75) + 3
+    with pytest.raises(image.ImageError):
+        image._parse_timestamp('1:2')
+
+
+def test_musicbrainz_discid():
+    # The example from the MusicBrainz disc id documentation
+    assert image.musicbrainz_discid(
+        1, 6, [150, 15363, 32314, 46592, 63414, 80489], 95462) \
+        == '49HHV7Eb8UKF3aQiNmu1GR8vKTY-'
+
+
+def test_wav_header(tmpdir):
+    wav = tmpdir.join('a.wav')
+    wav.write_binary(image.wav_header(SECTOR_BYTES) + sectors(1, 1))
+    assert analysis.find_pcm(str(wav)) == (44, SECTOR_BYTES)
+
+
+def test_single_bin(tmpdir):
+    tmpdir.join('disc.bin').write_binary(
+        sectors(1, 10) + sectors(2, 20) + sectors(3, 5))
+    cue = tmpdir.join('disc.cue')
+    cue.write("""\
+TITLE "Don't Panic"
+FILE "disc.bin" BINARY
+  TRACK 01 AUDIO
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    INDEX 00 00:00:05
+    INDEX 01 00:00:10
+  TRACK 03 AUDIO
+    INDEX 01 00:00:30
+""")
+    disc = image.DiscImage.open(str(cue))
+    assert disc.toc == [(0, 10), (10, 20), (30, 5)]
+    assert disc.discid == image.musicbrainz_discid(
+        1, 3, [150, 160, 180], 185)
+
+    out = str(tmpdir.join('2.wav'))
+    disc.extract_track(2, out)
+    assert read_wav(out) == sectors(2, 20)
+    disc.extract_track(2, out, first=5, last=6)
+    assert read_wav(out) == sectors(2, 2)
+    disc.close()
+
+
+def test_files(tmpdir):
+    # A WAV per track, with a big-endian raw file in the middle
+    tmpdir.join('01 one.wav').write_binary(
+        image.wav_header(SECTOR_BYTES * 2) + sectors(1, 2))
+    tmpdir.join('02.raw').write_binary(b'\x01\x02' * (SECTOR_BYTES // 2))
+    tmpdir.join('03.wav').write_binary(
+        image.wav_header(SECTOR_BYTES) + sectors(3, 1))
+    cue = tmpdir.join('disc.cue')
+    cue.write("""\
+FILE "01 one.wav" WAVE
+  TRACK 01 AUDIO
+    INDEX 01 00:00:00
+FILE "02.raw" MOTOROLA
+  TRACK 02 AUDIO
+    INDEX 01 00:00:00
+FILE "03.wav" WAVE
+  TRACK 03 AUDIO
+    INDEX 01 00:00:00
+""")
+    disc = image.DiscImage.open(str(cue))
+    assert disc.toc == [(0, 2), (2, 1), (3, 1)]
+
+    # Spans can cross files
+    out = str(tmpdir.join('out.wav'))
+    disc.extract(1, 3, out)
+    assert read_wav(out) == (sectors(1, 1) + b'\x02\x01' * (SECTOR_BYTES // 2)
+                             + sectors(3, 1))
+    with pytest.raises(image.ImageError):
+        disc.extract(3, 2, out)
+    disc.close()
+
+
+def test_enhanced_cd(tmpdir):
+    tmpdir.join('disc.bin').write_binary(sectors(1, 10) + sectors(9, 10))
+    cue = tmpdir.join('disc.cue')
+    cue.write("""\
+FILE "disc.bin" BINARY
+  TRACK 01 AUDIO
+    INDEX 01 00:00:00
+  TRACK 02 MODE1/2352
+    INDEX 01 00:00:10
+""")
+    disc = image.DiscImage.open(str(cue))
+    # The data track isn't part of the audio
+    assert disc.toc == [(0, 10)]
+    assert disc.discid == image.musicbrainz_discid(1, 1, [150], 160)
+
+
+def test_wav_image(tmpdir):
+    wav = tmpdir.join('album.wav')
+    wav.write_binary(image.wav_header(SECTOR_BYTES * 3) + sectors(1, 3))
+    disc = image.DiscImage.open(str(wav))
+    assert disc.toc == [(0, 3)]
+
+
+def test_errors(tmpdir):
+    iso = tmpdir.join('disc.iso')
+    iso.write_binary(b'')
+    with pytest.raises(image.ImageError):
+        image.DiscImage.open(str(iso))
+
+    with pytest.raises(image.ImageError):
+        image.DiscImage.open(str(tmpdir.join('missing.cue')))
+
+    cue = tmpdir.join('disc.cue')
+    cue.write('FILE "missing.bin" BINARY\n')
+    with pytest.raises(image.ImageError):
+        image.DiscImage.open(str(cue))
+
+    tmpdir.join('disc.bin').write_binary(sectors(1, 10))
+    for text in (
+            'REM nothing here\n',
+            'TRACK 01 AUDIO\n  INDEX 01 00:00:00\n',
+            'FILE "disc.bin" BINARY\n  TRACK 01 MODE1/2352\n'
+            '    INDEX 01 00:00:00\n',
+            'FILE "disc.bin" BINARY\n  TRACK 01 AUDIO\n'
+            '    INDEX 01 00:00:20\n',
+            'FILE "disc.bin" MP3\n'):
+        cue.write(text)
+        with pytest.raises(image.ImageError):
+            image.DiscImage.open(str(cue))
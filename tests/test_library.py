@@ -0,0 +1,110 @@
+"""Tests for the library module."""
+
+import pytest
+import click.testing
+import yaml
+from cdparacord import library
+
+
+def albumdata(n, artist='Artist', discid=None):
+    return {
+        'discid': discid or 'disc-{}'.format(n),
+        'title': 'Album {}'.format(n),
+        'albumartist': artist,
+        'date': '2018',
+        'tracks': [{'artist': artist, 'title': 'Track'},
+                   {'artist': 'Guest', 'title': 'Feat'}]
+    }
+
+
+@pytest.fixture
+def index(tmpdir):
+    index = library.Library(str(tmpdir.join('db', 'library.sqlite3')))
+    yield index
+    index.close()
+
+
+def test_index_filename(monkeypatch):
+    class FakeConfig:
+        def __init__(self, value):
+            self.value = value
+
+        def get(self, key):
+            return {'library_index': self.value}[key]
+
+    assert library.index_filename(FakeConfig(None)) == library.DEFAULT_INDEX
+    assert library.index_filename(FakeConfig(False)) is None
+    monkeypatch.setenv('HOME', '/home/user')
+    assert library.index_filename(
+        FakeConfig('~/lib.db')) == '/home/user/lib.db'
+
+
+def test_record_and_find(index):
+    index.record(albumdata(1), [(1, '/music/A/1.mp3', 10, 'abc'),
+                                (2, '/music/A/2.mp3', 20, 'def')],
+                 encoder_hash='hash', rip_seconds=5.0)
+    index.record(albumdata(2, artist='Other'),
+                 [(1, '/music/B/1.mp3', None, None)])
+
+    disc, = index.find(discid='disc-1')
+    assert disc['albumdata'] == albumdata(1)
+    assert disc['encoder_hash'] == 'hash'
+    assert [(f['path'], f['size'], f['checksum']) for f in disc['files']] == [
+        ('/music/A/1.mp3', 10, 'abc'), ('/music/A/2.mp3', 20, 'def')]
+
+    assert [d['discid'] for d in index.find(artist='artist')] == ['disc-1']
+    # The artists of the tracks count too
+    assert [d['discid'] for d in index.find(artist='guest')] == ['disc-1']
+    assert [d['discid'] for d in index.find(album='ALBUM 2')] == ['disc-2']
+    assert [d['discid'] for d in index.find(path='/music/B')] == ['disc-2']
+    assert [d['discid'] for d in index.find(
+        path='/music/A/2.mp3')] == ['disc-1']
+    assert index.find(path='/music/A/2') == []
+    assert index.find(artist='Artist', album='Album 2') == []
+
+    # Ripping again updates the disc and the tracks that were ripped
+    data = albumdata(1)
+    data['title'] = 'Fixed'
+    index.record(data, [(2, '/music/A/02.mp3', 30, None)])
+    disc, = index.find(discid='disc-1')
+    assert disc['album'] == 'Fixed'
+    assert [f['path'] for f in disc['files']] == [
+        '/music/A/1.mp3', '/music/A/02.mp3']
+    assert len(index.find()) == 2
+
+
+def test_import(tmpdir, index):
+    ripdirs = tmpdir.mkdir('ripdirs')
+    music = tmpdir.mkdir('music')
+    for n in range(5):
+        data = albumdata(n)
+        for t, track in enumerate(data['tracks'], 1):
+            track['filename'] = str(music.join('{}-{}.mp3'.format(n, t)))
+        ripdirs.mkdir(str(n)).join('albumdata.yaml').write(
+            yaml.safe_dump(data))
+    music.join('0-1.mp3').write('xyz')
+    ripdirs.join('broken.yaml').write('- not albumdata')
+
+    imported, failed = index.import_albumdata(
+        list(library.find_albumdata([str(ripdirs)])) +
+        [str(ripdirs.join('broken.yaml'))], batch=2)
+    assert imported == 5
+    assert len(failed) == 1
+    disc, = index.find(discid='disc-0')
+    assert [f['size'] for f in disc['files']] == [3, None]
+
+
+def test_main(tmpdir):
+    ripdir = tmpdir.mkdir('ripdir')
+    data = albumdata(1)
+    data['tracks'][0]['filename'] = '/music/1.mp3'
+    ripdir.join('albumdata.yaml').write(yaml.safe_dump(data))
+    db = str(tmpdir.join('library.sqlite3'))
+
+    runner = click.testing.CliRunner()
+    res = runner.invoke(library.main, ['--index', db, 'import', str(tmpdir)],
+                        catch_exceptions=False)
+    assert 'Imported 1 albumdata files, 0 failed' in res.output
+    res = runner.invoke(library.main, ['--index', db, 'find', '--artist',
+                                       'Artist'], catch_exceptions=False)
+    assert res.output == 'Artist - Album 1 (2018) [disc-1]\n   1 /music/1.mp3\n'
@@ -3,6 +3,7 @@
 import pytest
 import click.testing
 import io
+import os
 import cdparacord
 
 @pytest.fixture
@@ -10,6 +11,10 @@ def mock_dependencies(monkeypatch):
     class Config:
         def update(self, d):
             pass
+
+        def get(self, key):
+            # Keep away from the real library index
+            return {'library_index': False}.get(key)
     monkeypatch.setattr('cdparacord.main.Config', Config)
 
     class Dependency:
@@ -21,9 +26,19 @@ def mock_dependencies(monkeypatch):
         def __init__(self):
             self.track_count = 1
             self.ripdir = '/tmp/oispa-kaljaa'
+            self.wavdir = '/dev/shm/oispa-kaljaa'
+
+        @classmethod
+        def read_disc(cls, disc_image=None):
+            return 'disc-id'
+
+        @classmethod
+        def from_user_input(cls, deps, config, *, disc=None,
+                disc_image=None):
+            return cls()
 
         @classmethod
-        def from_user_input(cls, deps, config):
+        def from_library(cls, data, config):
             return cls()
 
         @property
@@ -33,7 +48,7 @@ def mock_dependencies(monkeypatch):
 
     class Rip:
         def __init__(self, albumdata, deps, config, begin_track, end_track, continue_rip):
-            pass
+            Rip.continue_rip = continue_rip
 
         def rip_pipeline(self):
             pass
@@ -89,8 +104,116 @@ def test_main_albumdata_none(mock_dependencies, monkeypatch):
     """Test that main completes succesfully when albumdata is None."""
     from cdparacord import main
 
-    monkeypatch.setattr('cdparacord.main.Albumdata.from_user_input', lambda y, z: None)
+    monkeypatch.setattr('cdparacord.main.Albumdata.from_user_input', lambda y, z, **k: None)
 
     res = click.testing.CliRunner().invoke(main.main, catch_exceptions=False)
 
     assert res.output == 'User aborted albumdata selection.\n'
+
+
+def test_main_profile(mock_dependencies, monkeypatch):
+    """Test that --profile writes the profile into the ripdir."""
+    from cdparacord import main
+
+    written = []
+    def fake_write(self):
+        written.append(self.directory)
+        return '/tmp/oispa-kaljaa/profile.txt'
+    monkeypatch.setattr('cdparacord.profiling.Profiler.write', fake_write)
+    removed = []
+    monkeypatch.setattr('shutil.rmtree', removed.append)
+
+    res = click.testing.CliRunner().invoke(
+        main.main, args=['--profile'], catch_exceptions=False)
+
+    assert written == ['/tmp/oispa-kaljaa']
+    # The ripdir has the profile in it so it's kept
+    assert removed == []
+    assert 'Wrote profile to' in res.output
+
+
+def test_main_image(mock_dependencies, monkeypatch, tmpdir):
+    """Test that --image hands the opened image to albumdata."""
+    from cdparacord import main
+
+    # open is mocked, so make the file the hard way
+    cue = tmpdir.join('disc.cue')
+    os.close(os.open(str(cue), os.O_CREAT | os.O_WRONLY))
+    opened = []
+    class FakeImage:
+        @classmethod
+        def open(cls, filename):
+            opened.append(filename)
+            return cls()
+
+        def close(self):
+            pass
+    monkeypatch.setattr('cdparacord.image.DiscImage', FakeImage)
+    given = []
+    def fake_from_user_input(deps, config, *, disc=None, disc_image=None):
+        given.append(disc_image)
+        return None
+    monkeypatch.setattr('cdparacord.main.Albumdata.from_user_input',
+        fake_from_user_input)
+
+    click.testing.CliRunner().invoke(
+        main.main, args=['--image', str(cue)], catch_exceptions=False)
+
+    assert opened == [str(cue)]
+    assert isinstance(given[0], FakeImage)
+
+
+def test_main_duplicate(mock_dependencies, monkeypatch, tmpdir):
+    """Test that a disc in the library index is looked up first."""
+    from cdparacord import main, library
+
+    monkeypatch.setattr('os.makedirs', lambda *x, **k: None)
+    index = library.Library(str(tmpdir.join('library.sqlite3')))
+    index.record({'discid': 'disc-id', 'title': 'Album',
+                  'albumartist': 'Artist', 'tracks': []},
+                 [(1, '/music/1.flac', 10, None)])
+    index.close()
+
+    settings = {'library_index': str(tmpdir.join('library.sqlite3')),
+                'on_duplicate': 'ask', 'on_duplicate_unattended': 'skip',
+                'decoder_extension': 'flac'}
+    monkeypatch.setattr('cdparacord.main.Config.get',
+        lambda self, key: settings.get(key))
+    monkeypatch.setattr('cdparacord.main.Config.update',
+        lambda self, d: settings.update(
+            (k, v) for k, v in d.items() if k in settings and v is not None))
+    asked = []
+    monkeypatch.setattr('cdparacord.main.Albumdata.from_user_input',
+        lambda deps, config, **k: asked.append(k['disc']))
+    decoded = []
+    monkeypatch.setattr('cdparacord.main._decode_ripped',
+        lambda config, albumdata, files: decoded.extend(files))
+
+    # Nobody to ask, so the disc is skipped
+    res = click.testing.CliRunner().invoke(
+        main.main, catch_exceptions=False)
+    assert 'Artist - Album was already ripped' in res.output
+    assert 'Skipping' in res.output
+    assert asked == []
+
+    res = click.testing.CliRunner().invoke(
+        main.main, args=['--on-duplicate', 'rip'], catch_exceptions=False)
+    assert asked == ['disc-id']
+
+    settings['on_duplicate'] = 'reencode'
+    res = click.testing.CliRunner().invoke(
+        main.main, catch_exceptions=False)
+    assert [f['path'] for f in decoded] == ['/music/1.flac']
+    assert main.Rip.continue_rip
+
+    # The decoder can't read what was ripped
+    settings['decoder_extension'] = 'wv'
+    res = click.testing.CliRunner().invoke(main.main)
+    assert 'the decoder reads .wv files' in str(res.exception)
+    assert len(decoded) == 1
+
+    # Never seen before, so nothing to ask
+    settings['library_index'] = str(tmpdir.join('other.sqlite3'))
+    settings['on_duplicate'] = 'skip'
+    click.testing.CliRunner().invoke(main.main, catch_exceptions=False)
+    assert asked == ['disc-id', 'disc-id']
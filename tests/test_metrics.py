@@ -0,0 +1,99 @@
+"""Tests for the metrics module."""
+
+import pytest
+import urllib.request
+from cdparacord import metrics
+
+
+def test_exposition():
+    registry = metrics.Registry()
+    counter = metrics.Counter(registry, 'c_total', 'A counter.', ['stage'])
+    gauge = metrics.Gauge(registry, 'g', 'A gauge.')
+    histogram = metrics.Histogram(
+        registry, 'h_seconds', 'A histogram.', buckets=(1, 10))
+
+    counter.inc(stage='rip')
+    counter.inc(2, stage='say "hi"\n')
+    gauge.set(1.5)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.expose() == '\n'.join([
+        '# HELP c_total A counter.',
+        '# TYPE c_total counter',
+        'c_total{stage="rip"} 1',
+        'c_total{stage="say \\"hi\\"\\n"} 2',
+        '# HELP g A gauge.',
+        '# TYPE g gauge',
+        'g 1.5',
+        '# HELP h_seconds A histogram.',
+        '# TYPE h_seconds histogram',
+        'h_seconds_bucket{le="1"} 1',
+        'h_seconds_bucket{le="10"} 2',
+        'h_seconds_bucket{le="+Inf"} 2',
+        'h_seconds_sum 5.5',
+        'h_seconds_count 2',
+        ''])
+
+    with pytest.raises(metrics.MetricsError):
+        counter.inc()
+
+
+def test_load():
+    """Counters and histograms carry over, gauges don't."""
+    def make():
+        registry = metrics.Registry()
+        return (registry,
+                metrics.Counter(registry, 'c_total', 'C.', ['stage']),
+                metrics.Gauge(registry, 'g', 'G.'),
+                metrics.Histogram(registry, 'h', 'H.', buckets=(1,)))
+
+    registry, counter, gauge, histogram = make()
+    counter.inc(3, stage='a "b"')
+    gauge.set(7)
+    histogram.observe(0.5)
+    text = registry.expose()
+
+    registry, counter, gauge, histogram = make()
+    registry.load(text + 'garbage\nc_total{other="x"} 5\n')
+    counter.inc(stage='a "b"')
+    histogram.observe(2)
+    assert counter.get(stage='a "b"') == 4
+    assert gauge.get() is None
+    assert histogram.get() == {'buckets': [1, 2], 'sum': 2.5, 'count': 2}
+
+
+def test_textfile(tmpdir):
+    registry = metrics.Registry()
+    counter = metrics.Counter(registry, 'c_total', 'C.')
+    counter.inc()
+    filename = str(tmpdir.join('cdparacord.prom'))
+
+    # Nothing there yet is fine
+    metrics.load_textfile(filename, registry)
+    metrics.write_textfile(filename, registry)
+    metrics.load_textfile(filename, registry)
+    assert counter.get() == 2
+    assert tmpdir.listdir() == [tmpdir.join('cdparacord.prom')]
+
+
+def test_serve():
+    registry = metrics.Registry()
+    metrics.Gauge(registry, 'g', 'G.').set(1)
+    server = metrics.serve('127.0.0.1:0', registry)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            assert response.read().decode() == registry.expose()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with pytest.raises(metrics.MetricsError):
+        metrics.serve('localhost:http')
+
+
+def test_directory_size(tmpdir):
+    tmpdir.join('a').write('x' * 10)
+    tmpdir.join('b', 'c').write('x' * 5, ensure=True)
+    assert metrics.directory_size(str(tmpdir), str(tmpdir)) == 15
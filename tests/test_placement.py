@@ -0,0 +1,130 @@
+"""Tests for the placement module."""
+
+import pytest
+import errno
+import os
+from cdparacord import placement
+
+
+class FakeConfig:
+    def __init__(self, wav_dir):
+        self.wav_dir = wav_dir
+
+    def get(self, key):
+        assert key == 'wav_dir'
+        return self.wav_dir
+
+
+def test_choose_wavdir_ripdir():
+    assert placement.choose_wavdir(
+        FakeConfig('ripdir'), '/tmp/rip', 'test', 0) == '/tmp/rip'
+
+
+def test_choose_wavdir_custom(tmpdir):
+    wavdir = placement.choose_wavdir(
+        FakeConfig(str(tmpdir)), '/tmp/rip', 'test', 0)
+    assert wavdir == placement.rip_subdir(str(tmpdir), 'test')
+
+
+def test_choose_wavdir_auto(tmpdir, monkeypatch):
+    """RAM is used only if it's there and has room."""
+    monkeypatch.setattr('cdparacord.placement._RAM_DIRS',
+        (None, '/nonexistent', str(tmpdir)))
+    monkeypatch.setattr('cdparacord.placement.is_ram_backed',
+        lambda x: True)
+    monkeypatch.setattr('cdparacord.placement.free_space', lambda x: 1000)
+
+    config = FakeConfig('auto')
+    assert placement.choose_wavdir(config, '/tmp/rip', 'test', 900) == \
+        placement.rip_subdir(str(tmpdir), 'test')
+    # Headroom is needed too
+    assert placement.choose_wavdir(config, '/tmp/rip', 'test', 950) == \
+        '/tmp/rip'
+
+    monkeypatch.setattr('cdparacord.placement.is_ram_backed',
+        lambda x: False)
+    assert placement.choose_wavdir(config, '/tmp/rip', 'test', 900) == \
+        '/tmp/rip'
+
+
+def test_is_ram_backed(monkeypatch):
+    monkeypatch.setattr('cdparacord.placement._mounts', lambda: {
+        '/': 'ext4',
+        '/dev/shm': 'tmpfs',
+        '/dev/shm/disk': 'ext4'
+    })
+    assert placement.is_ram_backed('/dev/shm')
+    assert placement.is_ram_backed('/dev/shm/x')
+    assert not placement.is_ram_backed('/dev/shm/disk/x')
+    assert not placement.is_ram_backed('/dev/shmx')
+    assert not placement.is_ram_backed('/tmp')
+
+
+def test_mounts(tmpdir):
+    mounts = tmpdir.join('mounts')
+    mounts.write_binary(
+        b'/dev/sda1 / ext4 rw 0 0\n'
+        b'/dev/sdb1 /media/m\xc3\xa4k vfat rw 0 0\n'
+        b'tmpfs /run/user/1000/with\\040space tmpfs rw 0 0\n')
+    assert placement._mounts(str(mounts)) == {
+        '/': 'ext4',
+        '/media/m\xe4k': 'vfat',
+        '/run/user/1000/with space': 'tmpfs'
+    }
+    assert placement._mounts(str(tmpdir.join('nonexistent'))) == {}
+
+
+def test_staging_filename():
+    assert placement.staging_filename('/music/a/01 - b.mp3') == \
+        '/music/a/.01 - b.cdparacord-part.mp3'
+
+
+@pytest.mark.parametrize('broken', [
+    (),
+    ('copy_file_range',),
+    ('copy_file_range', 'sendfile')
+])
+def test_fast_copy(tmpdir, monkeypatch, broken):
+    """Copy works with every fallback."""
+    def fail(*args):
+        raise OSError(errno.ENOSYS, 'Not implemented')
+    for name in broken:
+        monkeypatch.setattr(os, name, fail, raising=False)
+
+    src = tmpdir.join('src')
+    src.write_binary(b'x' * 100000)
+    os.utime(str(src), (1000000000, 1000000000))
+    dst = tmpdir.join('dst')
+
+    placement.fast_copy(str(src), str(dst))
+    assert dst.read_binary() == b'x' * 100000
+    assert os.stat(str(dst)).st_mtime == 1000000000
+
+
+def test_publish(tmpdir):
+    src = tmpdir.join('src.mp3')
+    src.write('test')
+    dst = tmpdir.join('a', 'b', 'dst.mp3')
+
+    placement.publish(str(src), str(dst))
+    assert dst.read() == 'test'
+    assert not src.exists()
+
+
+def test_publish_across_filesystems(tmpdir, monkeypatch):
+    """Copy when rename can't be done, but rename the copy in place."""
+    src = tmpdir.join('src.mp3')
+    src.write('test')
+    dst = tmpdir.join('a', 'dst.mp3')
+
+    real_rename = os.rename
+    def fake_rename(a, b):
+        if a == str(src):
+            raise OSError(errno.EXDEV, 'Cross-device link')
+        real_rename(a, b)
+    monkeypatch.setattr('os.rename', fake_rename)
+
+    placement.publish(str(src), str(dst))
+    assert dst.read() == 'test'
+    assert not src.exists()
+    assert tmpdir.join('a').listdir() == [dst]
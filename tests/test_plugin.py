@@ -0,0 +1,63 @@
+"""Tests for the plugin module."""
+import asyncio
+import os.path
+import pytest
+from cdparacord import plugin
+
+
+calls = []
+
+
+def record(**kwargs):
+    calls.append(kwargs)
+
+
+async def record_async(**kwargs):
+    calls.append(('async', kwargs))
+
+
+def broken(**kwargs):
+    raise ValueError('broken')
+
+
+class Tasks:
+    @staticmethod
+    def nested(**kwargs):
+        pass
+
+
+not_a_function = 42
+
+
+def test_is_plugin():
+    assert plugin.is_plugin({'python': 'module:function'})
+    # An executable called python
+    assert not plugin.is_plugin({'python': ['script.py', '${one_file}']})
+    assert not plugin.is_plugin({'echo': ['${one_file}']})
+
+
+def test_load():
+    assert plugin.load('test_plugin:record') is record
+    assert plugin.load('test_plugin:Tasks.nested') is Tasks.nested
+    assert plugin.load('os.path:basename') is os.path.basename
+    with pytest.raises(plugin.PluginError):
+        plugin.load('cdparacord_no_such_module:record')
+    with pytest.raises(plugin.PluginError):
+        plugin.load('test_plugin:no_such_function')
+    with pytest.raises(plugin.PluginError):
+        plugin.load('test_plugin:not_a_function')
+    with pytest.raises(plugin.PluginError, match='No task called'):
+        plugin.load('cdparacord-no-such-entry-point')
+
+
+def test_run():
+    del calls[:]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(plugin.run(record, 'record', one_file='a'))
+    loop.run_until_complete(
+        plugin.run(record_async, 'record_async', one_file='b'))
+    assert calls == [{'one_file': 'a'}, ('async', {'one_file': 'b'})]
+
+    with pytest.raises(plugin.PluginError, match='broken'):
+        loop.run_until_complete(plugin.run(broken, 'broken'))
@@ -0,0 +1,46 @@
+"""Tests for the profiling module."""
+
+import asyncio
+import pstats
+import time
+from cdparacord import profiling
+
+
+def test_profiler(tmpdir):
+    profiler = profiling.Profiler(slow_callback=0.01, tracemalloc_frames=1)
+    profiler.start()
+
+    loop = asyncio.new_event_loop()
+    profiler.configure_loop(loop)
+    async def hog():
+        # Block the event loop for a while
+        time.sleep(0.05)
+        return [b'x' * 1000 for _ in range(1000)]
+    profiler.snapshot('before')
+    data = loop.run_until_complete(hog())
+    loop.close()
+
+    profiler.stop()
+    profiler.directory = str(tmpdir.join('ripdir'))
+    filename = profiler.write()
+
+    with open(filename) as f:
+        report = f.read()
+    assert 'Top functions by cumulative' in report
+    assert 'Event loop callbacks slower than 0.01s: 1' in report
+    assert 'hog' in report
+    assert 'Allocations from before to end' in report
+    # Loadable by the usual tools
+    stats = pstats.Stats(str(tmpdir.join('ripdir', 'profile.pstats')))
+    assert stats.total_calls > 0
+
+
+def test_profiler_defaults():
+    class FakeConfig:
+        def get(self, key):
+            return None
+
+    profiler = profiling.profiler_from_config(FakeConfig())
+    profiler.start()
+    profiler.stop()
+    assert 'callbacks slower than 0.1s: 0' in profiler.report()
@@ -0,0 +1,100 @@
+"""Tests for the publish module."""
+
+import pytest
+import asyncio
+import errno
+import hashlib
+import os
+from cdparacord import publish, storage
+
+
+def test_publish_file_rename(tmpdir):
+    """Same filesystem: digest computed and file renamed."""
+    src = tmpdir.join('src.mp3')
+    src.write_binary(b'test data')
+    dst = tmpdir.join('a', 'dst.mp3')
+
+    digest = publish.publish_file(str(src), str(dst), checksum='sha256')
+    assert digest == hashlib.sha256(b'test data').hexdigest()
+    assert dst.read_binary() == b'test data'
+    assert not src.exists()
+
+
+def test_publish_file_copy(tmpdir, monkeypatch):
+    """Different filesystem: copied through a temp name."""
+    src = tmpdir.join('src.mp3')
+    src.write_binary(b'x' * (3 * 1024 * 1024 + 5))
+    dst = tmpdir.join('a', 'dst.mp3')
+
+    renames = []
+    real_rename = os.rename
+    def fake_rename(a, b):
+        if a == str(src):
+            raise OSError(errno.EXDEV, 'Cross-device link')
+        renames.append((a, b))
+        real_rename(a, b)
+    monkeypatch.setattr('os.rename', fake_rename)
+
+    digest = publish.publish_file(str(src), str(dst), checksum='md5')
+    assert digest == hashlib.md5(b'x' * (3 * 1024 * 1024 + 5)).hexdigest()
+    assert dst.read_binary() == b'x' * (3 * 1024 * 1024 + 5)
+    assert not src.exists()
+    # Never written to the final name directly
+    assert renames == [(
+        str(tmpdir.join('a', '.dst.cdparacord-part.mp3')), str(dst))]
+
+
+def test_publish_file_no_checksum(tmpdir):
+    src = tmpdir.join('src.mp3')
+    src.write('test')
+    dst = tmpdir.join('a', 'dst.mp3')
+
+    assert publish.publish_file(str(src), str(dst)) is None
+    assert dst.read() == 'test'
+
+
+def test_manifest_roundtrip():
+    entries = {'01 - a.mp3': 'abc', '02 - b *c.mp3': 'def'}
+    text = publish.format_manifest(entries)
+    assert text == 'abc  01 - a.mp3\ndef  02 - b *c.mp3\n'
+    assert publish.parse_manifest(text) == entries
+
+
+def test_manifest_filename():
+    assert publish.manifest_filename('/music/A/Album/', 'md5') == \
+        '/music/A/Album/Album.md5'
+
+
+def test_unknown_checksum():
+    with pytest.raises(publish.PublishError):
+        publish.Publisher(storage.LocalBackend(), 1, checksum='crc32')
+
+
+def test_publisher(tmpdir):
+    """Publish in parallel, merging into an existing manifest."""
+    album = tmpdir.join('Album')
+    album.mkdir()
+    album.join('Album.sha256').write('abc  00 - old.mp3\n')
+
+    sources = []
+    for n in range(1, 5):
+        src = tmpdir.join('{}.mp3'.format(n))
+        src.write('track {}'.format(n))
+        sources.append(str(src))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    publisher = publish.Publisher(
+        storage.LocalBackend(), 2, checksum='sha256')
+    loop.run_until_complete(asyncio.gather(*[
+        publisher.publish(src, str(album.join('0{}.mp3'.format(n))))
+        for n, src in enumerate(sources, 1)]))
+    loop.run_until_complete(publisher.finish())
+    loop.close()
+
+    manifest = publish.parse_manifest(album.join('Album.sha256').read())
+    assert manifest['00 - old.mp3'] == 'abc'
+    for n in range(1, 5):
+        assert manifest['0{}.mp3'.format(n)] == hashlib.sha256(
+            'track {}'.format(n).encode()).hexdigest()
+    assert len(manifest) == 5
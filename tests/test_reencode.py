@@ -0,0 +1,169 @@
+"""Tests for the reencode module."""
+
+import pytest
+import asyncio
+import os
+import stat
+import struct
+import mutagen
+import mutagen.easyid3
+from cdparacord import reencode
+
+
+def make_flac(filename, **tags):
+    """Write a FLAC file with no audio, just tags."""
+    streaminfo = bytearray(34)
+    streaminfo[0:4] = struct.pack('>HH', 4096, 4096)
+    # 44.1 kHz, two channels, 16 bits
+    streaminfo[10:18] = struct.pack('>Q', (44100 << 44) | (1 << 41)
+                                    | (15 << 36))
+    with open(filename, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80, 0, 0, 34]) + streaminfo)
+    audiofile = mutagen.File(filename, easy=True)
+    audiofile.add_tags()
+    for key, value in tags.items():
+        audiofile[key] = value
+    audiofile.save()
+
+
+def make_script(filename, body):
+    with open(filename, 'w') as f:
+        f.write('#!/bin/sh\n{}\n'.format(body))
+    os.chmod(filename, stat.S_IRWXU)
+    return filename
+
+
+class FakeConfig:
+    def __init__(self, **values):
+        self.values = {
+            'decoder': {'decode': ['${one_file}', '${out_file}']},
+            'encoder': {'encode': ['${one_file}', '${out_file}']},
+            'post_encode': [],
+            'analyse_audio': False,
+            'fsync_published': False,
+            'task_resources': {}
+        }
+        self.values.update(values)
+
+    def get(self, key):
+        return self.values[key]
+
+
+@pytest.fixture
+def archive(tmpdir):
+    """An archive of three FLACs and tools that count their runs."""
+    make_flac(str(tmpdir.mkdir('archive').join('01.flac')),
+              artist='A', album='Album', title='One', tracknumber='1')
+    make_flac(str(tmpdir.join('archive', '02.flac')),
+              artist='A', album='Album', title='Two', tracknumber='2')
+    make_flac(str(tmpdir.mkdir('archive', 'Other').join('01.FLAC')),
+              artist='B', album='Other', title='Three', tracknumber='1')
+    tmpdir.join('archive', 'cover.jpg').write('')
+
+    runs = tmpdir.join('runs')
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    class FakeDeps:
+        decoder = make_script(
+            str(tmpdir.join('decode')),
+            'echo "$1" >> {}\nhead -c 2396 /dev/zero > "$2"'.format(runs))
+        # Just enough of an mp3 for mutagen to tag: an empty ID3 header
+        encoder = make_script(
+            str(tmpdir.join('encode')),
+            "test -f \"$1\" && printf 'ID3\\003{}' > \"$2\"".format(
+                '\\000' * 6))
+
+    yield str(tmpdir.join('archive')), FakeDeps(), runs
+
+
+def test_find_sources(archive):
+    directory, _, _ = archive
+    assert list(reencode.find_sources(directory, 'flac')) == [
+        '01.flac', '02.flac', os.path.join('Other', '01.FLAC')]
+
+
+def test_reencode(tmpdir, archive):
+    directory, deps, runs = archive
+    output = str(tmpdir.join('output'))
+    r = reencode.Reencoder(deps, FakeConfig(), directory, output,
+                           extension='mp3', jobs=2)
+    r.run()
+
+    assert sorted(r.encoded) == [
+        '01.flac', '02.flac', os.path.join('Other', '01.FLAC')]
+    assert len(runs.readlines()) == 3
+    tags = mutagen.easyid3.EasyID3(os.path.join(output, 'Other', '01.mp3'))
+    assert tags['title'] == ['Three']
+    assert tags['artist'] == ['B']
+    # Nothing left behind
+    assert sorted(os.listdir(output)) == [
+        reencode.MANIFEST_NAME, '01.mp3', '02.mp3', 'Other']
+
+    # Up to date files are skipped
+    r = reencode.Reencoder(deps, FakeConfig(), directory, output,
+                           extension='mp3')
+    r.run()
+    assert r.encoded == []
+    assert len(r.skipped) == 3
+    assert len(runs.readlines()) == 3
+
+    # A changed file, a removed output and changed settings are noticed
+    make_flac(os.path.join(directory, '02.flac'), title='New')
+    os.remove(os.path.join(output, '01.mp3'))
+    r = reencode.Reencoder(deps, FakeConfig(), directory, output,
+                           extension='mp3')
+    r.run()
+    assert sorted(r.encoded) == ['01.flac', '02.flac']
+    config = FakeConfig(encoder={'encode': ['${one_file}', '${out_file}',
+                                            '--new']})
+    r = reencode.Reencoder(deps, config, directory, output, extension='mp3')
+    r.run()
+    assert len(r.encoded) == 3
+
+
+def test_reencode_failure(tmpdir, archive):
+    directory, deps, runs = archive
+    output = str(tmpdir.join('output'))
+    # The encoder fails on one of the files
+    deps.encoder = make_script(
+        str(tmpdir.join('encode-fail')),
+        "case \"$2\" in *02*) echo broken >&2; exit 1;; esac\n"
+        "printf 'ID3\\003{}' > \"$2\"".format('\\000' * 6))
+    r = reencode.Reencoder(deps, FakeConfig(), directory, output,
+                           extension='mp3')
+    r.run()
+    assert r.failed == ['02.flac']
+    assert len(r.encoded) == 2
+    assert not os.path.exists(os.path.join(output, '02.mp3'))
+    assert [f for f in os.listdir(output) if 'cdparacord-part' in f] == []
+
+    # Only the failed one is redone next time
+    r = reencode.Reencoder(deps, FakeConfig(), directory, output,
+                           extension='mp3')
+    r.run()
+    assert r.failed == ['02.flac']
+    assert len(r.skipped) == 2
+
+
+def test_manifest(tmpdir):
+    filename = str(tmpdir.join('manifest'))
+    source = tmpdir.join('source')
+    source.write('x')
+    tmpdir.join('out').write('y')
+    st = os.stat(str(source))
+
+    manifest = reencode.Manifest(filename)
+    manifest.record('source', st, 'a', 'out')
+    manifest.record('source', st, 'b', 'out')
+    manifest.close()
+    # Interrupted in the middle of a line
+    with open(filename, 'a') as f:
+        f.write('{"source": ')
+
+    manifest = reencode.Manifest(filename)
+    assert len(manifest) == 1
+    assert manifest.is_current('source', st, 'b', str(tmpdir))
+    assert not manifest.is_current('source', st, 'a', str(tmpdir))
+    manifest.compact()
+    with open(filename) as f:
+        assert len(f.readlines()) == 1
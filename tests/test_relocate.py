@@ -0,0 +1,201 @@
+"""Tests for the relocate module."""
+
+import pytest
+import click.testing
+import errno
+import os
+import yaml
+from cdparacord import relocate
+from cdparacord.library import Library
+
+
+class FakeConfig:
+    template = '${albumartist}/${album}/${tracknumber} - ${track}.mp3'
+    index = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, key):
+        if key == 'target_template':
+            return os.path.join(self.root, self.template)
+        return {'safetyfilter': 'remove_restricted',
+                'library_index': self.index}[key]
+
+
+@pytest.fixture
+def library(tmpdir, monkeypatch):
+    """Two ripped albums, named with an older template."""
+    root = str(tmpdir.mkdir('library'))
+    albumdata = []
+    for album in ('One', 'Two'):
+        data = {'title': album, 'albumartist': 'Artist', 'date': '2018',
+                'ripdir': str(tmpdir.join(album)), 'tracks': []}
+        for n in (1, 2):
+            filename = os.path.join(
+                root, 'old', album, '{} Track.mp3'.format(n))
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'w') as f:
+                f.write('{} {}'.format(album, n))
+            data['tracks'].append({'title': 'Track', 'artist': 'Artist',
+                                   'filename': filename})
+        tmpdir.mkdir(album).join('albumdata.yaml').write(
+            yaml.safe_dump(data))
+        albumdata.append(str(tmpdir.join(album)))
+
+    monkeypatch.setattr('cdparacord.relocate.Config',
+                        lambda: FakeConfig(root))
+    yield root, albumdata, str(tmpdir.join('journal.jsonl'))
+
+
+def invoke(*args):
+    return click.testing.CliRunner().invoke(
+        relocate.main, args=list(args), catch_exceptions=False)
+
+
+def new_name(root, album, n):
+    return os.path.join(root, 'Artist', album, '0{} - Track.mp3'.format(n))
+
+
+def test_plan(library):
+    root, albumdata, _ = library
+    moves = relocate.plan(albumdata, FakeConfig(root))
+    assert [(m.track, m.dst) for m in moves] == [
+        (0, new_name(root, 'One', 1)), (1, new_name(root, 'One', 2)),
+        (0, new_name(root, 'Two', 1)), (1, new_name(root, 'Two', 2))]
+
+    # Nothing gets overwritten
+    os.makedirs(os.path.dirname(new_name(root, 'Two', 2)))
+    with open(new_name(root, 'Two', 2), 'w'):
+        pass
+    with pytest.raises(relocate.RelocateError):
+        relocate.plan(albumdata, FakeConfig(root))
+
+
+def test_relocate(library):
+    root, albumdata, journal = library
+    res = invoke('--dry-run', '--journal', journal, *albumdata)
+    assert '4 files to move' in res.output
+    assert not os.path.exists(new_name(root, 'One', 1))
+
+    invoke('--journal', journal, *albumdata)
+    with open(new_name(root, 'Two', 2)) as f:
+        assert f.read() == 'Two 2'
+    # The old directories are cleaned up
+    assert os.listdir(root) == ['Artist']
+    assert not os.path.exists(journal)
+    with open(os.path.join(albumdata[0], 'albumdata.yaml')) as f:
+        assert yaml.safe_load(f)['tracks'][1]['filename'] == new_name(
+            root, 'One', 2)
+
+    # Everything is where it should be now
+    assert relocate.plan(albumdata, FakeConfig(root)) == []
+
+
+def test_relocate_across_filesystems(library, monkeypatch):
+    root, albumdata, journal = library
+    rename = os.rename
+    copied = []
+    def fake_rename(src, dst):
+        # The copy is renamed into place from its temporary name
+        if src.endswith('Track.mp3') and 'Two' in src:
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        if 'cdparacord-part' in src and dst.endswith('.mp3'):
+            copied.append(dst)
+        rename(src, dst)
+    monkeypatch.setattr('os.rename', fake_rename)
+
+    invoke('--journal', journal, *albumdata)
+    for album in ('One', 'Two'):
+        with open(new_name(root, album, 1)) as f:
+            assert f.read() == '{} 1'.format(album)
+    assert sorted(copied) == [new_name(root, 'Two', 1),
+                              new_name(root, 'Two', 2)]
+    assert os.listdir(root) == ['Artist']
+
+
+def test_resume_and_rollback(library, monkeypatch):
+    root, albumdata, journal = library
+    rename = os.rename
+    def failing_rename(src, dst):
+        if src.endswith('2 Track.mp3'):
+            raise OSError(errno.EACCES, 'Permission denied')
+        rename(src, dst)
+    monkeypatch.setattr('os.rename', failing_rename)
+
+    with pytest.raises(relocate.RelocateError):
+        invoke('--journal', journal, *albumdata)
+    assert os.path.exists(journal)
+    assert os.path.exists(new_name(root, 'One', 1))
+    # Can't start another one on top
+    with pytest.raises(relocate.RelocateError):
+        invoke('--journal', journal, *albumdata)
+
+    monkeypatch.setattr('os.rename', rename)
+    invoke('--rollback', '--journal', journal)
+    assert not os.path.exists(journal)
+    assert sorted(os.listdir(root)) == ['old']
+    with open(os.path.join(root, 'old', 'One', '1 Track.mp3')) as f:
+        assert f.read() == 'One 1'
+
+    monkeypatch.setattr('os.rename', failing_rename)
+    with pytest.raises(relocate.RelocateError):
+        invoke('--journal', journal, *albumdata)
+    monkeypatch.setattr('os.rename', rename)
+    res = invoke('--resume', '--journal', journal)
+    assert '2 of 4 moves were done' in res.output
+    assert relocate.plan(albumdata, FakeConfig(root)) == []
+    assert os.listdir(root) == ['Artist']
+
+    with pytest.raises(relocate.RelocateError):
+        invoke('--resume', '--journal', journal)
+
+
+def test_relocate_index(library, monkeypatch, tmpdir):
+    """The paths in the library index follow the files."""
+    root, albumdata, journal = library
+    filename = str(tmpdir.join('library.sqlite3'))
+    monkeypatch.setattr(FakeConfig, 'index', filename)
+    index = Library(filename)
+    index.record({'discid': 'one', 'title': 'One', 'tracks': []},
+                 [(1, os.path.join(root, 'old', 'One', '1 Track.mp3'),
+                   None, None)])
+    index.record_fingerprints([(
+        os.path.join(root, 'old', 'One', '1 Track.mp3'), 1.0, b'x', None)])
+    index.close()
+
+    def paths():
+        index = Library(filename)
+        try:
+            disc, = index.find(discid='one')
+            return ([f['path'] for f in disc['files']],
+                    [f['path'] for f in index.fingerprints_near(1.0, 0)])
+        finally:
+            index.close()
+
+    invoke('--journal', journal, *albumdata)
+    assert paths() == ([new_name(root, 'One', 1)],
+                       [new_name(root, 'One', 1)])
+
+
+def test_remove_empty_dirs(tmpdir):
+    """Nothing above the library is removed."""
+    root = tmpdir.mkdir('Music')
+    album = root.mkdir('Artist').mkdir('Album')
+    relocate._remove_empty_dirs(str(album.join('01.mp3')), str(root))
+    assert root.check()
+    assert root.listdir() == []
+
+    outside = tmpdir.mkdir('elsewhere').mkdir('Album')
+    relocate._remove_empty_dirs(str(outside.join('01.mp3')), str(root))
+    assert outside.check()
+
+    assert relocate.library_root(FakeConfig(str(root))) == str(root)
+
+    class XdgConfig:
+        def get(self, key):
+            assert key == 'target_template'
+            return '${xdgmusic}/${albumartist}/${track}.mp3'
+
+    assert relocate.library_root(XdgConfig()) == os.path.abspath(
+        relocate.XDG_MUSIC_DIR)
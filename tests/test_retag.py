@@ -0,0 +1,118 @@
+"""Tests for the retag module."""
+
+import pytest
+import os
+import struct
+import yaml
+import mutagen.easyid3
+from cdparacord import retag, rip
+from cdparacord.albumdata import Albumdata
+
+
+class FakeConfig:
+    def get(self, key):
+        return {'always_tag_albumartist': False}[key]
+
+
+@pytest.fixture
+def ripped(tmpdir):
+    """An albumdata.yaml and the two tagged files it names."""
+    data = {
+        'title': 'Album',
+        'date': '2018',
+        'albumartist': 'Artist',
+        'ripdir': str(tmpdir),
+        'tracks': []
+    }
+    for n in (1, 2):
+        filename = str(tmpdir.join('{}.mp3'.format(n)))
+        with open(filename, 'wb') as f:
+            f.write(b'ID3\x03' + b'\x00' * 6 + b'audio')
+        data['tracks'].append({'title': 'Track {}'.format(n),
+                               'artist': 'Artist', 'filename': filename})
+    tmpdir.join('albumdata.yaml').write(yaml.safe_dump(data))
+    albumdata = retag.load_albumdata(str(tmpdir))
+    for filename, tags in retag.plan([albumdata], FakeConfig()):
+        rip.tag_file(filename, tags)
+    yield data
+
+
+def test_tag_changes():
+    current = {'artist': ['A'], 'title': ['T'], 'date': ['2018', '2019']}
+    assert retag.tag_changes(
+        current, {'artist': 'A', 'title': 'U', 'date': '2018',
+                  'album': 'X'}) == {'title': 'U', 'date': '2018',
+                                     'album': 'X'}
+
+
+def test_load_albumdata(tmpdir, ripped):
+    assert retag.load_albumdata(str(tmpdir)).title == 'Album'
+    assert retag.load_albumdata(
+        str(tmpdir.join('albumdata.yaml'))).track_count == 2
+
+    tmpdir.join('broken.yaml').write('- just a list')
+    with pytest.raises(retag.RetagError):
+        retag.load_albumdata(str(tmpdir.join('broken.yaml')))
+    with pytest.raises(retag.RetagError):
+        retag.load_albumdata(str(tmpdir.join('missing.yaml')))
+
+
+def test_retag(tmpdir, ripped):
+    sizes = [os.path.getsize(t['filename']) for t in ripped['tracks']]
+
+    ripped['tracks'][1]['title'] = 'Fixed title'
+    ripped['date'] = '2017'
+    files = retag.plan([Albumdata(ripped)], FakeConfig())
+
+    # A dry run changes nothing
+    results = list(retag.retag(files, 2, dry_run=True))
+    assert [changes for _, changes, _ in results] == [
+        {'date': '2017'}, {'date': '2017', 'title': 'Fixed title'}]
+    assert mutagen.easyid3.EasyID3(
+        ripped['tracks'][1]['filename'])['date'] == ['2018']
+
+    results = list(retag.retag(files, 2))
+    assert all(error is None for _, _, error in results)
+    tags = mutagen.easyid3.EasyID3(ripped['tracks'][1]['filename'])
+    assert tags['title'] == ['Fixed title']
+    assert tags['date'] == ['2017']
+    assert tags['artist'] == ['Artist']
+    # The new tags fit in the padding, so the files didn't grow and the
+    # audio is where it was
+    assert [os.path.getsize(t['filename'])
+            for t in ripped['tracks']] == sizes
+    with open(ripped['tracks'][0]['filename'], 'rb') as f:
+        assert f.read().endswith(b'audio')
+
+    # Nothing left to change
+    assert [changes for _, changes, _ in retag.retag(files, 2)] == [{}, {}]
+
+
+def test_retag_missing_file(tmpdir, ripped):
+    os.remove(ripped['tracks'][0]['filename'])
+    files = retag.plan([Albumdata(ripped)], FakeConfig())
+    results = list(retag.retag(files, 1))
+    assert results[0][2] is not None
+    assert results[1][2] is None
+
+
+def test_retag_flac(tmpdir):
+    """A FLAC file keeps its Vorbis comments when it's retagged."""
+    filename = str(tmpdir.join('1.flac'))
+    streaminfo = bytearray(34)
+    streaminfo[0:4] = struct.pack('>HH', 4096, 4096)
+    streaminfo[10:18] = struct.pack('>Q', (44100 << 44) | (1 << 41)
+                                    | (15 << 36))
+    with open(filename, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80, 0, 0, 34]) + streaminfo)
+    rip.tag_file(filename, {'title': 'Old title', 'genre': 'Rock'})
+
+    assert retag.retag_file(filename, {'title': 'New title'}) == {
+        'title': 'New title'}
+    tags = mutagen.File(filename, easy=True)
+    assert tags['title'] == ['New title']
+    assert tags['genre'] == ['Rock']
+
+    tmpdir.join('notes.txt').write('not audio')
+    with pytest.raises(rip.RipError):
+        retag.retag_file(str(tmpdir.join('notes.txt')), {'title': 'T'})
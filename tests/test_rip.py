@@ -1,5 +1,6 @@
 import pytest
 import asyncio
+import os
 from cdparacord import rip
 
 @pytest.fixture
@@ -57,6 +58,14 @@ def test_rip_pipeline(monkeypatch, get_fake_config):
         def ripdir(self):
             return '/tmp/oispa-kaljaa'
 
+        @property
+        def wavdir(self):
+            return '/tmp/oispa-kaljaa'
+
+        @property
+        def dict(self):
+            return {}
+
     class FakeDeps:
         ...
 
@@ -71,8 +80,8 @@ def test_rip_pipeline(monkeypatch, get_fake_config):
 
     monkeypatch.setattr('cdparacord.rip.Rip._rip_track', fake_rip)
     monkeypatch.setattr('cdparacord.rip.Rip._encode_track', fake_encode)
-    monkeypatch.setattr('os.makedirs', lambda x, exist_ok: None)
-    monkeypatch.setattr('shutil.copy2', lambda x, y: True)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
 
     fake_config = get_fake_config()
     # Rip from 2 to 3, therefore hitting both tracks
@@ -134,6 +143,10 @@ def test_rip_track(monkeypatch, get_fake_config):
         def ripdir(self):
             return '/tmp/oispa-kaljaa'
 
+        @property
+        def wavdir(self):
+            return '/tmp/oispa-kaljaa'
+
     class FakeDeps:
         def __init__(self):
             self.cdparanoia = 'echo'
@@ -193,6 +206,10 @@ def test_encode_track(monkeypatch, get_fake_config):
         def ripdir(self):
             return '/tmp/oispa-kaljaa'
 
+        @property
+        def wavdir(self):
+            return '/tmp/oispa-kaljaa'
+
     class FakeDeps:
         def __init__(self):
             self.encoder = 'echo'
@@ -205,6 +222,7 @@ def test_encode_track(monkeypatch, get_fake_config):
         ...
 
     monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('os.makedirs', lambda x, exist_ok: None)
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -254,6 +272,10 @@ def test_tag_track(monkeypatch, get_fake_config):
         def ripdir(self):
             return '/tmp/oispa-kaljaa'
 
+        @property
+        def wavdir(self):
+            return '/tmp/oispa-kaljaa'
+
         @property
         def albumartist(self):
             return 'test'
@@ -279,6 +301,8 @@ def test_tag_track(monkeypatch, get_fake_config):
     r = rip.Rip(FakeAlbumdata(), fake_deps, fake_config, 1, 1, True)
 
     class FakeFile:
+        tags = None
+
         def __init__(*a, **b):
             ...
 
@@ -312,3 +336,806 @@ def test_tag_track(monkeypatch, get_fake_config):
 
         # Assert we got the filename put in the dict
         assert r._tagged_files[fake_track.filename] == fake_track.filename
+
+
+def test_analyse_track(monkeypatch, get_fake_config, tmpdir):
+    """Test that analysis is recorded and exposed to the encoder."""
+    pytest.importorskip('numpy')
+    import struct
+    import wave
+
+    filename = str(tmpdir.join('1.wav'))
+    with wave.open(filename, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(b'\0' * 4 * 588 * 2)
+        w.writeframes(struct.pack('<hh', 10000, -10000) * 588 * 4)
+        w.writeframes(b'\0' * 4 * 588)
+
+    class FakeTrack:
+        def __init__(self):
+            self.tracknumber = 1
+            self.analysis = None
+
+        def record_analysis(self, analysis):
+            self.analysis = analysis
+
+        @property
+        def filename(self):
+            return str(tmpdir.join('final', 'test.mp3'))
+
+    fake_track = FakeTrack()
+
+    class FakeAlbumdata:
+        @property
+        def tracks(self):
+            return [fake_track]
+
+        @property
+        def ripdir(self):
+            return str(tmpdir)
+
+        @property
+        def wavdir(self):
+            return str(tmpdir)
+
+    class FakeDeps:
+        def __init__(self):
+            self.encoder = 'echo'
+
+    class AnalysingConfig(get_fake_config):
+        def get(self, key):
+            if key == 'analyse_audio':
+                return True
+            elif key == 'silence_threshold':
+                return -90.0
+            elif key == 'keep_ripdir':
+                return True
+            elif key == 'encoder':
+                return {'echo': ['${audio_start}', '${audio_end}']}
+            return super().get(key)
+
+    expanded = []
+    def fake_arg_expand(self, task_args, one_file, **kwargs):
+        # Only the encoder gets an out_file
+        if 'out_file' in kwargs:
+            expanded.append(kwargs.get('extra'))
+        return []
+
+    async def fake_tag(self, track, filename):
+        ...
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.rip.Rip._arg_expand', fake_arg_expand)
+
+    r = rip.Rip(FakeAlbumdata(), FakeDeps(), AnalysingConfig(), 1, 1, True)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(r._encode_track(fake_track, filename))
+    loop.close()
+
+    assert fake_track.analysis == {
+        'frames': 588 * 7, 'audio_start': 588 * 2, 'audio_end': 588 * 6}
+    assert expanded[0] == {
+        'audio_start': str(588 * 2), 'audio_end': str(588 * 6)}
+
+    # Pretend the rip was trimmed to start at the second sector. The
+    # offsets stay relative to the track but the encoder gets them
+    # relative to the file.
+    r._rip_starts[1] = 588
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(r._encode_track(fake_track, filename))
+    loop.close()
+
+    assert fake_track.analysis == {
+        'frames': 588 * 7, 'audio_start': 588 * 3, 'audio_end': 588 * 7,
+        'rip_start': 588}
+    assert expanded[-1] == {
+        'audio_start': str(588 * 2), 'audio_end': str(588 * 6)}
+
+
+def test_space_budget():
+    """Test that reservations wait for the budget to free up."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    budget = rip.SpaceBudget(100)
+    order = []
+
+    async def take(name, size):
+        await budget.reserve(size)
+        order.append(name)
+
+    async def run():
+        await budget.reserve(60)
+        waiting = asyncio.ensure_future(take('second', 60))
+        await asyncio.sleep(0)
+        # Doesn't fit yet
+        assert order == []
+        await budget.adjust(-60)
+        await waiting
+        assert order == ['second']
+        assert budget.used == 60
+
+        # Bigger than the whole budget only fits when nothing else does
+        waiting = asyncio.ensure_future(take('huge', 1000))
+        await asyncio.sleep(0)
+        assert order == ['second']
+        await budget.adjust(-60)
+        await waiting
+        assert order == ['second', 'huge']
+
+    loop.run_until_complete(run())
+    loop.close()
+
+
+@pytest.fixture
+def fake_disc(tmpdir):
+    """A four track disc with a fake cdparanoia and a no-op encoder.
+
+    Yields the albumdata and dependencies to give Rip.
+    """
+    import stat
+
+    # Fake cdparanoia writes a one sector wav wherever it's told to
+    cdparanoia = tmpdir.join('cdparanoia')
+    cdparanoia.write('#!/bin/sh\nhead -c 2396 /dev/zero > "$3"\n')
+    os.chmod(str(cdparanoia), stat.S_IRWXU)
+
+    class FakeTrack:
+        def __init__(self, number):
+            self.tracknumber = number
+            self.analysis = None
+
+        @property
+        def filename(self):
+            return str(tmpdir.join('final', '{}.mp3'.format(
+                self.tracknumber)))
+
+    class FakeAlbumdata:
+        tracks = [FakeTrack(n) for n in range(1, 5)]
+        ripdir = str(tmpdir)
+        wavdir = str(tmpdir)
+
+        @property
+        def dict(self):
+            return {'toc': [[0, 1]] * 4}
+
+    class FakeDeps:
+        def __init__(self):
+            self.cdparanoia = str(cdparanoia)
+            self.encoder = 'true'
+
+    yield FakeAlbumdata(), FakeDeps()
+
+
+def test_rip_pipeline_budget(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that wavs are removed eagerly and the budget holds."""
+    albumdata, deps = fake_disc
+
+    class BudgetConfig(get_fake_config):
+        def get(self, key):
+            if key == 'ripdir_budget':
+                return 5000
+            elif key in ('post_rip', 'post_encode', 'post_finished'):
+                return []
+            return super().get(key)
+
+    peak = []
+    async def fake_tag(self, track, filename):
+        peak.append(self._budget.used)
+        wavs = [f for f in os.listdir(str(tmpdir)) if f.endswith('.wav')]
+        # Never more than the budget allows on disk at once
+        assert len(wavs) <= 2
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+
+    r = rip.Rip(albumdata, deps, BudgetConfig(), 1, 4, False)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    r.rip_pipeline()
+
+    assert max(peak) <= 5000
+    assert r._budget.used == 0
+    # All the wavs are gone
+    assert [f for f in os.listdir(str(tmpdir)) if f.endswith('.wav')] == []
+
+
+def test_rip_pipeline_no_budget(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that wavs are kept for a continued rip without a budget."""
+    albumdata, deps = fake_disc
+
+    class NoBudgetConfig(get_fake_config):
+        def get(self, key):
+            if key == 'ripdir_budget':
+                return 0
+            elif key in ('post_rip', 'post_encode', 'post_finished'):
+                return []
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        pass
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+
+    r = rip.Rip(albumdata, deps, NoBudgetConfig(), 1, 4, False)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    r.rip_pipeline()
+
+    assert sorted(f for f in os.listdir(str(tmpdir))
+                  if f.endswith('.wav')) == ['1.wav', '2.wav', '3.wav',
+                                             '4.wav']
+
+
+def test_wav_size_estimate(get_fake_config):
+    """Test that a track with no TOC entry is taken to be long."""
+    class FakeTrack:
+        tracknumber = 2
+
+    class FakeAlbumdata:
+        def __init__(self, toc):
+            self.dict = {'toc': toc}
+
+    r = rip.Rip(FakeAlbumdata([[0, 10], [10, 20]]), None,
+                get_fake_config(), 1, 2, False)
+    assert r._wav_size_estimate(FakeTrack()) == 20 * 2352 + 44
+    r = rip.Rip(FakeAlbumdata(None), None, get_fake_config(), 1, 2, False)
+    assert r._wav_size_estimate(FakeTrack()) > 100 * 1024 * 1024
+
+
+def test_rip_pipeline_trace(monkeypatch, tmpdir, get_fake_config, fake_disc):
+    """Test that every stage of every track ends up in the trace."""
+    import json
+    albumdata, deps = fake_disc
+
+    class TraceConfig(get_fake_config):
+        def get(self, key):
+            if key == 'trace_dir':
+                return str(tmpdir.join('traces'))
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+
+    r = rip.Rip(albumdata, deps, TraceConfig(), 1, 4, False)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    r.rip_pipeline()
+
+    name = os.path.basename(str(tmpdir))
+    with open(str(tmpdir.join('traces', name + '-trace.json'))) as f:
+        events = json.load(f)['traceEvents']
+    spans = [(e['cat'], e['tid']) for e in events if e['ph'] == 'X']
+    for n in range(1, 5):
+        for stage in ('wait_drive', 'rip', 'encode', 'post_encode', 'tag'):
+            assert (stage, n) in spans
+    assert spans.count(('publish', 0)) == 4
+    rips = [e for e in events if e.get('cat') == 'rip']
+    assert all(e['args'] == {'command': 'cdparanoia', 'status': 0}
+               for e in rips)
+
+    with open(str(tmpdir.join('traces', name + '-summary.json'))) as f:
+        summary = json.load(f)
+    assert summary['stages']['encode']['count'] == 4
+    assert summary['stages']['encode']['failed'] == 0
+
+
+def test_rip_pipeline_index(monkeypatch, tmpdir, get_fake_config, fake_disc):
+    """Test that a finished rip is recorded in the library index."""
+    from cdparacord import library
+    albumdata, deps = fake_disc
+    monkeypatch.setattr(type(albumdata), 'dict', {
+        'discid': 'disc-id', 'title': 'Album', 'albumartist': 'Artist',
+        'tracks': [{'artist': 'Artist', 'title': 'Track'}] * 4})
+
+    class IndexConfig(get_fake_config):
+        def get(self, key):
+            if key == 'library_index':
+                return str(tmpdir.join('library.sqlite3'))
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        with open(filename, 'wb') as f:
+            f.write(b'x' * track.tracknumber)
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+
+    r = rip.Rip(albumdata, deps, IndexConfig(), 2, 3, False)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    r.rip_pipeline()
+
+    index = library.Library(str(tmpdir.join('library.sqlite3')))
+    disc, = index.find(discid='disc-id')
+    index.close()
+    assert disc['album'] == 'Album'
+    assert disc['rip_seconds'] >= 0
+    assert [(f['tracknumber'], f['path'], f['size'])
+            for f in disc['files']] == [
+        (n, str(tmpdir.join('final', '{}.mp3'.format(n))), n)
+        for n in (2, 3)]
+
+
+def test_rip_pipeline_index_broken(monkeypatch, tmpdir, get_fake_config,
+        fake_disc, capsys):
+    """Test that a broken library index doesn't fail a finished rip."""
+    albumdata, deps = fake_disc
+    tmpdir.join('library.sqlite3').write('not a database' * 100)
+
+    class IndexConfig(get_fake_config):
+        def get(self, key):
+            if key == 'library_index':
+                return str(tmpdir.join('library.sqlite3'))
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+
+    r = rip.Rip(albumdata, deps, IndexConfig(), 1, 1, False)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    r.rip_pipeline()
+    assert 'Could not record the rip' in capsys.readouterr().err
+
+
+def test_rip_pipeline_resources(monkeypatch, get_fake_config, fake_disc,
+        capsys):
+    """Test that the processes are accounted for."""
+    albumdata, deps = fake_disc
+
+    class ReportConfig(get_fake_config):
+        def get(self, key):
+            if key == 'resource_report':
+                return True
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+
+    r = rip.Rip(albumdata, deps, ReportConfig(), 1, 4, False)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    r.rip_pipeline()
+
+    assert r._accounting.stages['rip'].runs == 4
+    assert r._accounting.stages['post_encode'].runs == 4
+    # Named after the configured encoder, not its path
+    assert r._accounting.tools['echo'].runs == 8
+    assert r._accounting.tools['cdparanoia'].runs == 4
+    assert 'Drive busy' in capsys.readouterr().out
+
+
+def test_rip_pipeline_metrics(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that the metrics are fed and written out."""
+    from cdparacord import metrics
+    albumdata, deps = fake_disc
+    textfile = str(tmpdir.join('cdparacord.prom'))
+
+    class MetricsConfig(get_fake_config):
+        def get(self, key):
+            if key == 'metrics_textfile':
+                return textfile
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+
+    # The metrics are global, so look at how much they change
+    def snapshot():
+        return (metrics.DISCS_COMPLETED.get() or 0,
+                [metrics.TRACKS.get(stage=stage) or 0
+                 for stage in ('rip', 'encode', 'tag', 'publish')],
+                metrics.DRIVE_READ_BYTES.get() or 0,
+                (metrics.STAGE_SECONDS.get(stage='encode')
+                 or {'count': 0})['count'])
+    before = snapshot()
+
+    r = rip.Rip(albumdata, deps, MetricsConfig(), 1, 4, False)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    r.rip_pipeline()
+
+    after = snapshot()
+    assert after[0] - before[0] == 1
+    assert [x - y for x, y in zip(after[1], before[1])] == [4] * 4
+    assert after[2] - before[2] == 4 * 2396
+    assert after[3] - before[3] == 4
+    with open(textfile) as f:
+        assert 'cdparacord_discs_completed_total {}'.format(
+            after[0]) in f.read()
+
+
+def test_rip_pipeline_image(monkeypatch, tmpdir, get_fake_config, fake_disc):
+    """Test that tracks are read out of an image instead of the drive."""
+    from cdparacord import image
+    from cdparacord.placement import SECTOR_BYTES
+    albumdata, deps = fake_disc
+    # Nothing should run cdparanoia
+    deps.cdparanoia = 'false'
+
+    tmpdir.join('disc.bin').write_binary(b''.join(
+        bytes([n]) * SECTOR_BYTES * n for n in range(1, 5)))
+    cue = tmpdir.join('disc.cue')
+    cue.write('FILE "disc.bin" BINARY\n' + ''.join(
+        '  TRACK 0{} AUDIO\n    INDEX 01 00:00:{:02}\n'.format(n, begin)
+        for n, begin in zip(range(1, 5), (0, 1, 3, 6))))
+    monkeypatch.setattr(type(albumdata), 'dict', {'image': str(cue)})
+
+    class ImageConfig(get_fake_config):
+        def get(self, key):
+            if key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    ripped = {}
+    async def fake_encode(self, track, filename):
+        with open(filename, 'rb') as f:
+            ripped[track.tracknumber] = f.read()
+
+    monkeypatch.setattr('cdparacord.rip.Rip._encode_track', fake_encode)
+
+    r = rip.Rip(albumdata, deps, ImageConfig(), 1, 4, False)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    r.rip_pipeline()
+
+    for n in range(1, 5):
+        data = bytes([n]) * SECTOR_BYTES * n
+        assert ripped[n] == image.wav_header(len(data)) + data
+
+
+def test_rip_pipeline_fingerprint(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that a recording ripped before is found and reused."""
+    numpy = pytest.importorskip('numpy')
+    import stat
+    from test_fingerprint import make_song, write_wav
+    albumdata, deps = fake_disc
+    for n in range(1, 5):
+        write_wav(str(tmpdir.join('song{}.wav'.format(n))),
+                  make_song(n, seconds=10))
+    # Every track is a different song
+    cdparanoia = tmpdir.join('cdparanoia')
+    cdparanoia.write('#!/bin/sh\nn=${{2%%[!0-9]*}}\n'
+                     'cp {}/song$n.wav "$3"\n'.format(tmpdir))
+    os.chmod(str(cdparanoia), stat.S_IRWXU)
+
+    class FingerprintConfig(get_fake_config):
+        def get(self, key):
+            if key == 'library_index':
+                return str(tmpdir.join('library.sqlite3'))
+            elif key == 'fingerprint':
+                return True
+            elif key == 'fingerprint_threshold':
+                return 0.85
+            elif key == 'fingerprint_reuse':
+                return 'hardlink'
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    encoded = []
+    async def fake_encoder(self, track, temp_filename, temp_encoded, extra):
+        encoded.append(track.tracknumber)
+        with open(temp_encoded, 'w') as f:
+            f.write('track {}'.format(track.tracknumber))
+
+    async def fake_tag(self, track, filename):
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._run_encoder', fake_encoder)
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    rip.Rip(albumdata, deps, FingerprintConfig(), 1, 2, False).rip_pipeline()
+    assert sorted(encoded) == [1, 2]
+
+    # Track 3 is new, but track 4 is the same song as track 1, just
+    # starting a bit later
+    write_wav(str(tmpdir.join('song4.wav')), numpy.concatenate(
+        [numpy.zeros((22050, 2), dtype='<i2'), make_song(1, seconds=10)]))
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    rip.Rip(albumdata, deps, FingerprintConfig(), 3, 4, False).rip_pipeline()
+    assert sorted(encoded) == [1, 2, 3]
+    first = tmpdir.join('final', '1.mp3')
+    reused = tmpdir.join('final', '4.mp3')
+    assert reused.read() == 'track 1'
+    assert os.path.samefile(str(first), str(reused))
+
+
+def test_rip_pipeline_verify(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that encoded tracks are decoded and checked."""
+    import stat
+    from cdparacord import image
+    albumdata, deps = fake_disc
+    data = bytes(range(256)) * 20
+    tmpdir.join('song.wav').write_binary(image.wav_header(len(data)) + data)
+    cdparanoia = tmpdir.join('cdparanoia')
+    cdparanoia.write('#!/bin/sh\ncp {} "$3"\n'.format(tmpdir.join('song.wav')))
+    os.chmod(str(cdparanoia), stat.S_IRWXU)
+    deps.cdparanoia = str(cdparanoia)
+    deps.encoder = 'cp'
+    # A decoder that loses the last byte
+    lossy = tmpdir.join('lossy')
+    lossy.write('#!/bin/sh\nhead -c -1 "$1"\n')
+    os.chmod(str(lossy), stat.S_IRWXU)
+
+    class VerifyConfig(get_fake_config):
+        def get(self, key):
+            if key == 'verify_lossless':
+                return True
+            elif key == 'verify_decoder':
+                return {'cat': ['${one_file}']}
+            elif key == 'encoder':
+                return {'cp': ['${one_file}', '${out_file}']}
+            elif key in ('post_rip', 'post_encode', 'post_finished'):
+                return []
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+
+    verified = []
+    hash_decoded = rip.verify.hash_decoded
+    async def counting_hash(executable, args):
+        verified.append(args[0])
+        return await hash_decoded(executable, args)
+
+    monkeypatch.setattr('cdparacord.verify.hash_decoded', counting_hash)
+    deps.verify_decoder = 'cat'
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    rip.Rip(albumdata, deps, VerifyConfig(), 1, 4, False).rip_pipeline()
+    assert len(verified) == 4
+
+    deps.verify_decoder = str(lossy)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    with pytest.raises(rip.RipError, match='does not decode back'):
+        rip.Rip(albumdata, deps, VerifyConfig(), 1, 1, False).rip_pipeline()
+
+
+def test_rip_pipeline_plugins(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that python tasks are called instead of processes."""
+    import test_plugin
+    from cdparacord import plugin
+    albumdata, deps = fake_disc
+    deps.plugin = plugin.load
+
+    class PluginConfig(get_fake_config):
+        def get(self, key):
+            if key == 'post_rip':
+                return [{'python': 'test_plugin:record'}]
+            elif key == 'post_encode':
+                return [{'python': 'test_plugin:record_async'}]
+            elif key == 'post_finished':
+                return [{'python': 'test_plugin:record'}]
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+    del test_plugin.calls[:]
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    rip.Rip(albumdata, deps, PluginConfig(), 1, 2, False).rip_pipeline()
+
+    post_rip = sorted(
+        (c['track'].tracknumber, c['one_file']) for c in test_plugin.calls
+        if type(c) is dict and c['stage'] == 'post_rip')
+    assert post_rip == [(n, str(tmpdir.join('{}.wav.rip'.format(n))))
+                        for n in (1, 2)]
+    post_encode = [c for c in test_plugin.calls if type(c) is tuple]
+    assert sorted(c['track'].tracknumber for _, c in post_encode) == [1, 2]
+    assert all(c['albumdata'] is albumdata for _, c in post_encode)
+    finished, = [c for c in test_plugin.calls
+                 if type(c) is dict and c['stage'] == 'post_finished']
+    assert finished['one_file'] is None
+    assert len(finished['all_files']) == 2
+
+    # A task that raises fails the rip
+    class BrokenConfig(PluginConfig):
+        def get(self, key):
+            if key == 'post_encode':
+                return [{'python': 'test_plugin:broken'}]
+            return super().get(key)
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    with pytest.raises(rip.RipError, match='broken'):
+        rip.Rip(albumdata, deps, BrokenConfig(), 1, 1, False).rip_pipeline()
+
+
+def test_rip_pipeline_python_encoder(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that an in-process encoder goes through the same stages."""
+    from cdparacord import image, plugin
+    albumdata, deps = fake_disc
+    deps.plugin = plugin.load
+    # Fail if a process is started for encoding
+    deps.encoder = 'false'
+
+    class EncoderConfig(get_fake_config):
+        def get(self, key):
+            if key == 'encoder':
+                return {'python': 'cdparacord.encoders:wav'}
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    tagged = []
+    async def fake_tag(self, track, filename):
+        with open(filename, 'rb') as f:
+            tagged.append((track.tracknumber, f.read()))
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+    # A real wav for the encoder to read
+    cdparanoia = tmpdir.join('cdparanoia')
+    cdparanoia.write('#!/bin/sh\nprintf x > "$3.pcm"\n'
+                     'cat {} "$3.pcm" "$3.pcm" "$3.pcm" "$3.pcm" > "$3"\n'
+                     .format(tmpdir.join('header')))
+    tmpdir.join('header').write_binary(image.wav_header(4))
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    rip.Rip(albumdata, deps, EncoderConfig(), 1, 2, False).rip_pipeline()
+    assert sorted(tagged) == [(n, image.wav_header(4) + b'xxxx')
+                              for n in (1, 2)]
+
+
+def test_rip_pipeline_batches(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that tasks taking ${all_files} are run for batches."""
+    import stat
+    albumdata, deps = fake_disc
+    encoder = tmpdir.join('encoder')
+    encoder.write('#!/bin/sh\necho "$@" >> {}\n'
+                  'for f; do touch "${{f%.wav}}.mp3"; done\n'.format(
+                      tmpdir.join('encoded')))
+    os.chmod(str(encoder), stat.S_IRWXU)
+    deps.encoder = str(encoder)
+    post = tmpdir.join('post')
+    post.write('#!/bin/sh\necho "$@" >> {}\n'.format(tmpdir.join('posted')))
+    os.chmod(str(post), stat.S_IRWXU)
+
+    class BatchConfig(get_fake_config):
+        def get(self, key):
+            if key == 'encoder':
+                return {'flac': ['-s', '${all_files}']}
+            elif key == 'post_encode':
+                return [{str(post): ['${all_files}']}]
+            elif key == 'batch_size':
+                return 2
+            elif key == 'batch_timeout':
+                # Long enough to fail the test if it's waited for
+                return 60
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    tagged = []
+    async def fake_tag(self, track, filename):
+        tagged.append(filename)
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    rip.Rip(albumdata, deps, BatchConfig(), 1, 3, False).rip_pipeline()
+
+    encoded = tmpdir.join('encoded').read().splitlines()
+    # Tracks come in any order, and the batches may finish in any
+    # order. The last batch goes as soon as every track is in.
+    assert [line.split()[0] for line in encoded] == ['-s', '-s']
+    assert sorted(len(line.split()) - 1 for line in encoded) == [1, 2]
+    assert sorted(sum([line.split()[1:] for line in encoded], [])) == [
+        str(tmpdir.join('{}.wav'.format(n))) for n in (1, 2, 3)]
+    assert sorted(tagged) == [str(tmpdir.join('{}.mp3'.format(n)))
+                              for n in (1, 2, 3)]
+    posted = tmpdir.join('posted').read().split()
+    assert sorted(posted) == sorted(tagged)
+
+
+def test_rip_pipeline_task_graph(monkeypatch, tmpdir, get_fake_config,
+        fake_disc):
+    """Test that independent post tasks overlap within their limits."""
+    import test_plugin
+    from cdparacord import plugin
+    albumdata, deps = fake_disc
+    deps.plugin = plugin.load
+    running = {'cpu': 0, 'network': 0}
+    peak = {'cpu': 0, 'network': 0}
+    overlapped = []
+    log = []
+
+    async def task(resource, name, **kwargs):
+        running[resource] += 1
+        peak[resource] = max(peak[resource], running[resource])
+        if running['cpu'] and running['network']:
+            overlapped.append(name)
+        log.append((kwargs['track'].tracknumber, name))
+        await asyncio.sleep(0.02)
+        running[resource] -= 1
+
+    async def analyse(**kwargs):
+        await task('cpu', 'analyse', **kwargs)
+
+    async def upload(**kwargs):
+        await task('network', 'upload', **kwargs)
+
+    async def done(**kwargs):
+        log.append((kwargs['track'].tracknumber, 'done'))
+
+    monkeypatch.setattr(test_plugin, 'analyse', analyse, raising=False)
+    monkeypatch.setattr(test_plugin, 'upload', upload, raising=False)
+    monkeypatch.setattr(test_plugin, 'done', done, raising=False)
+
+    class GraphConfig(get_fake_config):
+        def get(self, key):
+            if key == 'post_encode':
+                return [
+                    {'name': 'analyse',
+                     'run': {'python': 'test_plugin:analyse'}},
+                    {'name': 'upload',
+                     'run': {'python': 'test_plugin:upload'},
+                     'resource': 'network'},
+                    {'name': 'done', 'run': {'python': 'test_plugin:done'},
+                     'after': ['analyse', 'upload']}]
+            elif key == 'task_resources':
+                return {'cpu': 4, 'network': 1}
+            elif key in ('post_rip', 'post_finished'):
+                return []
+            return super().get(key)
+
+    async def fake_tag(self, track, filename):
+        self._tagged_files[filename] = track.filename
+
+    monkeypatch.setattr('cdparacord.rip.Rip._tag_track', fake_tag)
+    monkeypatch.setattr('cdparacord.publish.publish_file',
+        lambda x, y, **z: None)
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    rip.Rip(albumdata, deps, GraphConfig(), 1, 4, False).rip_pipeline()
+
+    # Uploads never overlap, analysing and uploading do
+    assert peak['network'] == 1
+    assert overlapped
+    for n in range(1, 5):
+        steps = [name for number, name in log if number == n]
+        assert sorted(steps[:2]) == ['analyse', 'upload']
+        assert steps[2] == 'done'
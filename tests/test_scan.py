@@ -0,0 +1,105 @@
+"""Tests for the scan module."""
+
+import pytest
+from cdparacord import library, scan
+from test_reencode import make_flac
+
+
+@pytest.fixture
+def index(tmpdir):
+    index = library.Library(str(tmpdir.join('library.sqlite3')))
+    yield index
+    index.close()
+
+
+@pytest.fixture
+def music(tmpdir):
+    music = tmpdir.mkdir('music')
+    for album in ('One', 'Two'):
+        directory = music.mkdir(album)
+        for n in (1, 2):
+            make_flac(str(directory.join('{}.flac'.format(n))),
+                      artist='Artist', album=album,
+                      title='Track {}'.format(n))
+    music.join('cover.jpg').write('not audio')
+    yield music
+
+
+def counts(scanner):
+    return (scanner.added, scanner.changed, scanner.removed,
+            scanner.unchanged, scanner.failed)
+
+
+def test_scan(music, index, monkeypatch):
+    read = []
+    read_tags = scan.read_tags
+    def counting_read_tags(path):
+        read.append(path)
+        return read_tags(path)
+    monkeypatch.setattr('cdparacord.scan.read_tags', counting_read_tags)
+
+    scanner = scan.Scanner(index, jobs=2, batch=2)
+    scanner.scan([str(music)])
+    assert counts(scanner) == (4, 0, 0, 0, 0)
+    assert [f['title'] for f in index.find_scanned(album='one')] == [
+        'Track 1', 'Track 2']
+
+    # Nothing changed, nothing read
+    scanner.scan([str(music)])
+    assert counts(scanner) == (0, 0, 0, 4, 0)
+    assert len(read) == 4
+
+    make_flac(str(music.join('One', '2.flac')), artist='Artist',
+              album='One', title='Fixed')
+    music.join('Two', '2.flac').remove()
+    music.mkdir('Three').join('1.mp3').write('broken')
+    scanner.scan([str(music)])
+    assert counts(scanner) == (1, 1, 1, 2, 1)
+    assert [f['title'] for f in index.find_scanned(artist='ARTIST')] == [
+        'Track 1', 'Fixed', 'Track 1']
+    assert len(index.find_scanned()) == 4
+
+    # A directory that's gone takes everything in it along
+    music.join('One').remove()
+    scanner.scan([str(music)])
+    assert counts(scanner) == (0, 0, 0, 2, 0)
+    assert [f['path'] for f in index.find_scanned()] == [
+        str(music.join('Three', '1.mp3')), str(music.join('Two', '1.flac'))]
+
+
+def test_scan_not_recursive(music, index):
+    scanner = scan.Scanner(index)
+    scanner.scan([str(music)])
+    make_flac(str(music.join('One', '3.flac')), title='New')
+    make_flac(str(music.mkdir('Four').join('1.flac')), title='Also new')
+
+    # Only new subdirectories are gone into
+    scanner.scan([str(music)], recursive=False)
+    assert counts(scanner) == (1, 0, 0, 0, 0)
+    scanner.scan([str(music.join('One'))], recursive=False)
+    assert counts(scanner) == (1, 0, 0, 2, 0)
+
+
+def test_watcher(tmpdir):
+    watcher = scan.Watcher()
+    try:
+        watcher.add(str(tmpdir))
+        sub = tmpdir.mkdir('sub')
+        watcher.add(str(sub))
+        assert watcher.changed(0) == {str(tmpdir)}
+        sub.join('1.flac').write('x')
+        assert watcher.changed(1) == {str(sub)}
+        assert watcher.changed(0) == set()
+        sub.remove()
+        assert watcher.changed(1) == {str(tmpdir), str(sub)}
+    finally:
+        watcher.close()
+
+
+def test_main(tmpdir, music):
+    import click.testing
+    res = click.testing.CliRunner().invoke(
+        library.main, ['--index', str(tmpdir.join('library.sqlite3')),
+                       'scan', str(music)], catch_exceptions=False)
+    assert res.output == '4 new, 0 changed, 0 removed, 0 unchanged, ' \
+        '0 unreadable\n'
@@ -0,0 +1,292 @@
+"""Tests for the storage module."""
+
+import pytest
+import hashlib
+import http.server
+import os
+import socketserver
+import threading
+import urllib.parse
+from cdparacord import storage
+
+
+class FakeConfig:
+    def __init__(self, settings):
+        self._settings = settings
+
+    def get(self, key):
+        if key == 'storage':
+            return self._settings
+        return True
+
+
+@pytest.fixture
+def s3_server():
+    """A tiny in-process S3 lookalike."""
+    objects = {}
+    uploads = {}
+    requests = []
+    # Number of requests to fail with 500 before behaving
+    failures = [0]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, body=b'', headers=None):
+            self.send_response(status)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _parse(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            key = urllib.parse.unquote(url.path).split('/', 2)[2]
+            requests.append((self.command, key, sorted(query)))
+            assert self.headers['authorization'].startswith(
+                'AWS4-HMAC-SHA256 Credential=key/')
+            return key, query, body
+
+        def do_PUT(self):
+            key, query, body = self._parse()
+            if failures[0]:
+                failures[0] -= 1
+                return self._reply(500)
+            if 'partNumber' in query:
+                if query['uploadId'][0] not in uploads:
+                    return self._reply(404, b'<Code>NoSuchUpload</Code>')
+                upload = uploads[query['uploadId'][0]]
+                upload[int(query['partNumber'][0])] = body
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                return self._reply(200, headers={'ETag': etag})
+            objects[key] = body
+            self._reply(200)
+
+        def do_POST(self):
+            key, query, body = self._parse()
+            if 'uploads' in query:
+                upload_id = 'upload{}'.format(len(uploads))
+                uploads[upload_id] = {}
+                return self._reply(200, (
+                    '<InitiateMultipartUploadResult><UploadId>{}</UploadId>'
+                    '</InitiateMultipartUploadResult>'
+                    .format(upload_id)).encode())
+            if query['uploadId'][0] not in uploads:
+                return self._reply(404, b'<Code>NoSuchUpload</Code>')
+            parts = uploads.pop(query['uploadId'][0])
+            objects[key] = b''.join(parts[n] for n in sorted(parts))
+            self._reply(200, b'<CompleteMultipartUploadResult/>')
+
+        def do_GET(self):
+            key, query, body = self._parse()
+            if key not in objects:
+                return self._reply(404)
+            self._reply(200, objects[key])
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    server.objects = objects
+    server.uploads = uploads
+    server.requests = requests
+    server.failures = failures
+    server.endpoint = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda x: None)
+
+
+def make_s3(server, tmpdir, **kwargs):
+    return storage.S3Backend(
+        '/music', server.endpoint, 'bucket', prefix='lib/',
+        access_key='key', secret_key='secret', part_size=0,
+        state_dir=str(tmpdir), **kwargs)
+
+
+def test_local_backend(tmpdir):
+    src = tmpdir.join('src.mp3')
+    src.write('data')
+    album = tmpdir.join('Album')
+    backend = storage.LocalBackend()
+
+    digest = backend.put(str(src), str(album.join('01.mp3')), checksum='md5')
+    assert digest == hashlib.md5(b'data').hexdigest()
+    assert album.join('01.mp3').read() == 'data'
+
+    manifest = str(album.join('Album.md5'))
+    assert backend.read_text(manifest) is None
+    backend.write_text(manifest, 'text\n')
+    assert backend.read_text(manifest) == 'text\n'
+    backend.finish([str(album)])
+
+
+def test_relative_name():
+    assert storage._relative_name('/music', '/music/A/B.mp3') == 'A/B.mp3'
+    with pytest.raises(storage.StorageError):
+        storage._relative_name('/music', '/other/A/B.mp3')
+    with pytest.raises(storage.StorageError):
+        storage._relative_name('/music', '/music/../B.mp3')
+
+
+def test_command_backend(tmpdir, no_sleep):
+    remote = tmpdir.join('remote')
+    remote.mkdir()
+    src = tmpdir.join('src.mp3')
+    src.write('data')
+    backend = storage.CommandBackend(
+        '/music',
+        {'cp': ['${one_file}', str(remote) + '/${out_file}']},
+        {'cp': [str(remote) + '/${out_file}', '${one_file}']})
+
+    digest = backend.put(str(src), '/music/01.mp3', checksum='sha256')
+    assert digest == hashlib.sha256(b'data').hexdigest()
+    assert remote.join('01.mp3').read() == 'data'
+    assert not src.exists()
+
+    assert backend.read_text('/music/missing.sha256') is None
+    backend.write_text('/music/list.sha256', 'text\n')
+    assert backend.read_text('/music/list.sha256') == 'text\n'
+
+
+def test_command_backend_fail(tmpdir, no_sleep):
+    src = tmpdir.join('src.mp3')
+    src.write('data')
+    backend = storage.CommandBackend('/music', {'false': []}, retries=2)
+    with pytest.raises(storage.StorageError):
+        backend.put(str(src), '/music/01.mp3')
+    # Not lost on failure
+    assert src.exists()
+
+
+def test_s3_put(s3_server, tmpdir):
+    src = tmpdir.join('src.mp3')
+    src.write_binary(b'data')
+    backend = storage.S3Backend(
+        '/music', s3_server.endpoint, 'bucket', access_key='key',
+        secret_key='secret', state_dir=str(tmpdir))
+
+    digest = backend.put(str(src), '/music/A B/01.mp3', checksum='md5')
+    assert digest == hashlib.md5(b'data').hexdigest()
+    assert s3_server.objects['A B/01.mp3'] == b'data'
+    assert not src.exists()
+
+    assert backend.read_text('/music/A B/A B.md5') is None
+    backend.write_text('/music/A B/A B.md5', 'text\n')
+    assert backend.read_text('/music/A B/A B.md5') == 'text\n'
+
+
+def test_s3_multipart(s3_server, tmpdir, no_sleep):
+    data = os.urandom(storage.S3Backend.MIN_PART_SIZE * 2 + 100)
+    src = tmpdir.join('src.flac')
+    src.write_binary(data)
+    backend = make_s3(s3_server, tmpdir)
+
+    # A server error gets retried
+    s3_server.failures[0] = 1
+    digest = backend.put(str(src), '/music/01.flac', checksum='sha256')
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert s3_server.objects['lib/01.flac'] == data
+    assert [r for r in s3_server.requests if r[0] == 'PUT'] == \
+        [('PUT', 'lib/01.flac', ['partNumber', 'uploadId'])] * 4
+    # State is gone once complete
+    assert tmpdir.listdir(lambda p: p.basename.startswith('upload-')) == []
+
+
+def test_s3_multipart_resume(s3_server, tmpdir, no_sleep, monkeypatch):
+    data = os.urandom(storage.S3Backend.MIN_PART_SIZE * 2 + 100)
+    src = tmpdir.join('src.flac')
+    src.write_binary(data)
+    backend = make_s3(s3_server, tmpdir, retries=0)
+
+    # Fail on the second part, for good
+    real_request = backend._request
+    def failing_request(method, key, **kwargs):
+        if kwargs.get('query', {}).get('partNumber') == '2':
+            raise storage.StorageError('Connection reset')
+        return real_request(method, key, **kwargs)
+    monkeypatch.setattr(backend, '_request', failing_request)
+    with pytest.raises(storage.StorageError):
+        backend.put(str(src), '/music/01.flac')
+    assert src.exists()
+    monkeypatch.undo()
+
+    del s3_server.requests[:]
+    backend.put(str(src), '/music/01.flac')
+    assert s3_server.objects['lib/01.flac'] == data
+    # The upload was continued, so part 1 wasn't sent again
+    assert [r[1:] for r in s3_server.requests] == \
+        [('lib/01.flac', ['partNumber', 'uploadId'])] * 2 + \
+        [('lib/01.flac', ['uploadId'])]
+
+
+def test_s3_multipart_expired(s3_server, tmpdir, no_sleep, monkeypatch):
+    """An upload the server has forgotten is started over."""
+    data = os.urandom(storage.S3Backend.MIN_PART_SIZE * 2 + 100)
+    src = tmpdir.join('src.flac')
+    src.write_binary(data)
+    backend = make_s3(s3_server, tmpdir, retries=0)
+
+    real_request = backend._request
+    def failing_request(method, key, **kwargs):
+        if kwargs.get('query', {}).get('partNumber') == '2':
+            raise storage.StorageError('Connection reset')
+        return real_request(method, key, **kwargs)
+    monkeypatch.setattr(backend, '_request', failing_request)
+    with pytest.raises(storage.StorageError):
+        backend.put(str(src), '/music/01.flac')
+    monkeypatch.undo()
+    # Aborted by a lifecycle rule, say
+    s3_server.uploads.clear()
+
+    digest = backend.put(str(src), '/music/01.flac', checksum='sha256')
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert s3_server.objects['lib/01.flac'] == data
+    assert tmpdir.listdir(lambda p: p.basename.startswith('upload-')) == []
+
+
+def test_s3_client_error(s3_server, tmpdir):
+    backend = make_s3(s3_server, tmpdir)
+    # 4xx isn't retried, and only 404 is fine for read_text
+    with pytest.raises(storage.StorageError):
+        backend._request('GET', 'nothing')
+
+
+def test_backend_from_config(s3_server, tmpdir):
+    assert isinstance(
+        storage.backend_from_config(FakeConfig({'backend': 'local'})),
+        storage.LocalBackend)
+    assert isinstance(
+        storage.backend_from_config(FakeConfig(
+            {'backend': 'command', 'put': {'cp': []}})),
+        storage.CommandBackend)
+    assert isinstance(
+        storage.backend_from_config(FakeConfig({
+            'backend': 's3', 'endpoint': s3_server.endpoint,
+            'bucket': 'b', 'access_key': 'a', 'secret_key': 's'})),
+        storage.S3Backend)
+
+    with pytest.raises(storage.StorageError):
+        storage.backend_from_config(FakeConfig({'backend': 'ftp'}))
+    with pytest.raises(storage.StorageError):
+        storage.backend_from_config(FakeConfig(
+            {'backend': 'command', 'put': {'cp': []}, 'colour': 'red'}))
+    with pytest.raises(storage.StorageError):
+        storage.backend_from_config(FakeConfig(
+            {'backend': 's3', 'endpoint': 'ftp://x', 'bucket': 'b',
+             'access_key': 'a', 'secret_key': 's'}))
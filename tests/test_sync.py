@@ -0,0 +1,170 @@
+"""Tests for the sync module."""
+
+import pytest
+import asyncio
+import os
+import mutagen.easyid3
+from cdparacord import sync
+from test_reencode import make_flac, make_script
+
+
+class FakeConfig:
+    def __init__(self, **values):
+        self.values = {
+            'decoder': {'decode': ['${one_file}', '${out_file}']},
+            'safetyfilter': 'remove_restricted',
+            'sync_cache_size': 0,
+            'publish_jobs': 2
+        }
+        self.values.update(values)
+
+    def get(self, key):
+        return self.values[key]
+
+
+@pytest.fixture
+def library(tmpdir, monkeypatch):
+    """A library of two albums and a profile whose tools count runs."""
+    album = tmpdir.mkdir('library').mkdir('Album')
+    make_flac(str(album.join('01.flac')), artist='A', album='Album: One',
+              title='First', tracknumber='1/2')
+    make_flac(str(album.join('02.flac')), artist='A', album='Album: One',
+              title='Second?', tracknumber='2/2')
+    make_flac(str(tmpdir.mkdir('library', 'Other').join('01.flac')),
+              artist='B', album='Other', title='Third', tracknumber='1')
+
+    runs = tmpdir.join('runs')
+    tools = tmpdir.mkdir('bin')
+    make_script(str(tools.join('decode')),
+                'head -c 2396 /dev/zero > "$2"')
+    make_script(str(tools.join('encode')),
+                "echo \"$2\" >> {}\nprintf 'ID3\\003{}' > \"$2\"".format(
+                    runs, '\\000' * 6))
+    monkeypatch.setenv('PATH', str(tools), prepend=os.pathsep)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    config = FakeConfig(sync_profiles={'portable': {
+        'encoder': {'encode': ['${one_file}', '${out_file}']},
+        'template': '${albumartist}/${album}/${tracknumber} ${track}.mp3'
+    }})
+    yield config, str(tmpdir.join('library')), runs
+
+
+def syncer(tmpdir, config, destination, sources, **kwargs):
+    return sync.Syncer(
+        config, sync.get_profile(config, 'portable'),
+        str(tmpdir.join(destination)), sources,
+        cache_dir=str(tmpdir.join('cache')), **kwargs)
+
+
+def test_get_profile(library):
+    config, _, _ = library
+    profile = sync.get_profile(config, 'portable')
+    assert profile['decoder'] == config.get('decoder')
+
+    with pytest.raises(sync.SyncError):
+        sync.get_profile(config, 'nonexistent')
+    config.values['sync_profiles']['broken'] = {'template': 'x.mp3'}
+    with pytest.raises(sync.SyncError):
+        sync.get_profile(config, 'broken')
+    config.values['sync_profiles']['missing'] = {
+        'template': 'x.mp3',
+        'encoder': {'cdparacord-nonexistent-command': []}}
+    with pytest.raises(sync.SyncError):
+        sync.get_profile(config, 'missing')
+
+
+def test_target_name(library):
+    config, _, _ = library
+    assert sync.target_name(
+        {'artist': 'A/B', 'album': 'X: Y', 'title': 'Z', 'tracknumber': '3/9'},
+        '${albumartist}/${album}/${tracknumber} ${track}.ogg',
+        config) == 'A-B/X - Y/03 Z.ogg'
+
+
+def test_sync(tmpdir, library):
+    config, source, runs = library
+    s = syncer(tmpdir, config, 'player', [source])
+    s.run()
+
+    assert sorted(s.copied) == [
+        'A/Album - One/01 First.mp3', 'A/Album - One/02 Second.mp3',
+        'B/Other/01 Third.mp3']
+    assert len(s.transcoded) == 3
+    tags = mutagen.easyid3.EasyID3(
+        str(tmpdir.join('player', 'B', 'Other', '01 Third.mp3')))
+    assert tags['title'] == ['Third']
+
+    # Nothing changed, nothing to do
+    s = syncer(tmpdir, config, 'player', [source])
+    s.run()
+    assert s.copied == []
+    assert len(s.unchanged) == 3
+
+    # A changed file is transcoded again
+    make_flac(os.path.join(source, 'Other', '01.flac'), artist='B',
+              album='Other', title='Third', tracknumber='1', date='2018')
+    s = syncer(tmpdir, config, 'player', [source])
+    s.run()
+    assert s.copied == s.transcoded == ['B/Other/01 Third.mp3']
+    assert len(runs.readlines()) == 4
+
+    # Another player gets the cached transcodes
+    s = syncer(tmpdir, config, 'other-player',
+               [os.path.join(source, 'Album')])
+    s.run()
+    assert len(s.copied) == 2
+    assert s.transcoded == []
+    assert len(runs.readlines()) == 4
+
+
+def test_sync_delete(tmpdir, library):
+    config, source, _ = library
+    syncer(tmpdir, config, 'player', [source]).run()
+
+    # Without --delete files are left alone
+    s = syncer(tmpdir, config, 'player', [os.path.join(source, 'Album')])
+    s.run()
+    assert s.removed == []
+    assert tmpdir.join('player', 'B', 'Other', '01 Third.mp3').check()
+
+    s = syncer(tmpdir, config, 'player', [os.path.join(source, 'Album')],
+               delete=True)
+    s.run()
+    assert s.removed == ['B/Other/01 Third.mp3']
+    assert not tmpdir.join('player', 'B').check()
+
+
+def test_cache_evict(tmpdir):
+    cache = sync.Cache(str(tmpdir), 250)
+    for n, key in enumerate(('aa', 'bb', 'cc')):
+        filename = cache.filename(key, 'mp3')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(filename, (n, n))
+    # Using the oldest makes it the newest
+    assert cache.get('aa', 'mp3') is not None
+    assert cache.get('dd', 'mp3') is None
+
+    assert cache.evict() == 1
+    assert cache.get('bb', 'mp3') is None
+    assert cache.get('aa', 'mp3') is not None
+
+
+def test_transcode_once(tmpdir, library):
+    """The same thing is only transcoded once at a time."""
+    config, source, runs = library
+    s = syncer(tmpdir, config, 'player', [source])
+    os.makedirs(str(tmpdir.join('cache')))
+    flac = os.path.join(source, 'Other', '01.flac')
+    key, _ = s._inspect(flac)
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(asyncio.gather(
+        s._transcode_once(flac, key, str(tmpdir.join('1.wav'))),
+        s._transcode_once(flac, key, str(tmpdir.join('2.wav')))))
+    assert results[0][0] == results[1][0]
+    assert [transcoded for _, transcoded in results] == [True, False]
+    assert len(runs.readlines()) == 1
+    assert s._transcoding == {}
@@ -0,0 +1,68 @@
+"""Tests for the trace module."""
+
+import pytest
+import json
+from cdparacord import trace
+
+
+def test_null_tracer(tmpdir):
+    tracer = trace.NullTracer()
+    with tracer.span('rip', track=1, command='cdparanoia') as span:
+        span.status = 0
+    assert span.status is None
+    tracer.write(str(tmpdir), 'disc')
+    assert tmpdir.listdir() == []
+
+
+def test_tracer(tmpdir):
+    tracer = trace.Tracer()
+    with tracer.span('rip', track=1, command='cdparanoia') as span:
+        span.status = 0
+    with tracer.span('encode', track=1, command='lame') as span:
+        span.status = 1
+    with pytest.raises(ValueError):
+        with tracer.span('tag', track=2):
+            raise ValueError()
+    with tracer.span('post_finished', command='echo'):
+        pass
+
+    statuses = [e['status'] for e in tracer.events]
+    assert statuses == [0, 1, 'ValueError', None]
+    assert all(e['start'] <= e['end'] for e in tracer.events)
+
+    summary = tracer.summary()
+    assert sorted(summary['stages']) == [
+        'encode', 'post_finished', 'rip', 'tag']
+    assert summary['stages']['encode']['failed'] == 1
+    assert summary['stages']['tag']['failed'] == 1
+    assert summary['stages']['rip']['failed'] == 0
+    assert summary['wall'] == tracer.events[-1]['end']
+
+    events = tracer.chrome_trace()['traceEvents']
+    spans = [e for e in events if e['ph'] == 'X']
+    assert [(e['name'], e['tid']) for e in spans] == [
+        ('rip cdparanoia', 1), ('encode lame', 1), ('tag', 2),
+        ('post_finished echo', 0)]
+    assert spans[1]['args'] == {'command': 'lame', 'status': 1}
+    rows = {e['tid']: e['args']['name'] for e in events if e['ph'] == 'M'}
+    assert rows == {0: 'disc', 1: 'track 1', 2: 'track 2'}
+
+    tracer.write(str(tmpdir.join('out')), 'disc')
+    with open(str(tmpdir.join('out', 'disc-trace.json'))) as f:
+        assert json.load(f)['traceEvents'] == events
+    with open(str(tmpdir.join('out', 'disc-summary.json'))) as f:
+        assert json.load(f)['stages']['rip']['count'] == 1
+
+
+def test_tracer_from_config():
+    class FakeConfig:
+        def __init__(self, value):
+            self.value = value
+
+        def get(self, key):
+            return self.value
+
+    assert not trace.tracer_from_config(FakeConfig(None)).enabled
+    assert trace.tracer_from_config(FakeConfig('ripdir')).enabled
+    assert trace.trace_directory(FakeConfig('ripdir'), '/rip') == '/rip'
+    assert trace.trace_directory(FakeConfig('/traces'), '/rip') == '/traces'
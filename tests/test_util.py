@@ -0,0 +1,15 @@
+"""Tests for the util module."""
+
+import pytest
+import asyncio
+from cdparacord import util
+
+
+def test_run_process():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(util.run_process('true', [], 'Nothing'))
+    with pytest.raises(util.ProcessError, match='Failing failed:\nbroken'):
+        loop.run_until_complete(util.run_process(
+            'sh', ['-c', 'echo broken >&2; exit 1'], 'Failing'))
+    loop.close()
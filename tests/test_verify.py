@@ -0,0 +1,71 @@
+"""Tests for the verify module."""
+import asyncio
+import hashlib
+import os
+import pytest
+import stat
+import struct
+from cdparacord import image, verify
+
+
+PCM = bytes(range(256)) * 40
+
+
+def test_hash_wav(tmpdir):
+    """Only the PCM counts, not the header."""
+    plain = tmpdir.join('plain.wav')
+    plain.write_binary(image.wav_header(len(PCM)) + PCM)
+    # An extra chunk before the data and some junk after it
+    extra = tmpdir.join('extra.wav')
+    header = image.wav_header(len(PCM))
+    extra.write_binary(header[:36] + b'LIST\x03\x00\x00\x00abc\x00'
+                       + header[36:] + PCM + b'junk')
+
+    expected = hashlib.sha256(PCM).hexdigest()
+    assert verify.hash_wav(str(plain)) == expected
+    assert verify.hash_wav(str(extra)) == expected
+
+
+@pytest.mark.parametrize('size', [len(PCM), 0, 0xffffffff])
+def test_stream_hasher(size):
+    """Any split of the stream gives the same hash."""
+    header = image.wav_header(len(PCM))
+    stream = (header[:36] + b'LIST\x03\x00\x00\x00abc\x00'
+              + b'data' + struct.pack('<I', size) + PCM)
+    for piece in (1, 7, 100, len(stream)):
+        hasher = verify.WavStreamHasher()
+        for n in range(0, len(stream), piece):
+            hasher.update(stream[n:n + piece])
+        assert hasher.hexdigest() == hashlib.sha256(PCM).hexdigest()
+
+    # Whatever comes after a sized data chunk isn't PCM
+    if size == len(PCM):
+        hasher = verify.WavStreamHasher()
+        hasher.update(stream + b'trailing')
+        assert hasher.hexdigest() == hashlib.sha256(PCM).hexdigest()
+
+
+def test_stream_hasher_bad():
+    hasher = verify.WavStreamHasher()
+    with pytest.raises(verify.VerifyError):
+        hasher.update(b'ID3\x03' + bytes(100))
+
+    hasher = verify.WavStreamHasher()
+    hasher.update(image.wav_header(10)[:20])
+    with pytest.raises(verify.VerifyError):
+        hasher.hexdigest()
+
+
+def test_hash_decoded(tmpdir):
+    wav = tmpdir.join('a.wav')
+    wav.write_binary(image.wav_header(len(PCM)) + PCM)
+    failing = tmpdir.join('failing')
+    failing.write('#!/bin/sh\necho broken >&2\nexit 1\n')
+    os.chmod(str(failing), stat.S_IRWXU)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    assert loop.run_until_complete(
+        verify.hash_decoded('cat', [str(wav)])) == verify.hash_wav(str(wav))
+    with pytest.raises(verify.VerifyError, match='broken'):
+        loop.run_until_complete(verify.hash_decoded(str(failing), []))